@@ -0,0 +1,78 @@
+# Floodplain Mapper Toolbox 1.3
+# NumPy inundation engine shared by the toolbox scripts and headless runs
+#
+# The names below are imported from their modules on first use, so
+# "import floodplain_mapper" costs next to nothing and a run only imports
+# what it uses (arcpy and GDAL are imported by their adapters when a workspace
+# of that kind is opened). The script tools themselves are the functions of
+# floodplain_mapper.toolbox. The hypsometry function stays in the
+# floodplain_mapper.hypsometry module, whose name it shares.
+
+import importlib
+import sys
+
+__version__ = "1.3"
+
+# Public name -> module it is defined in
+_EXPORTS = {
+    "ArcpyAdapter": "adapters",
+    "GeoTiffAdapter": "adapters",
+    "NumpyAdapter": "adapters",
+    "get_adapter": "adapters",
+    "read_manifest": "batch",
+    "run_batch": "batch",
+    "ResultCache": "cache",
+    "StageCurves": "curves",
+    "run_curves": "curves",
+    "run_targets": "curves",
+    "DEPTH_THRESHOLD": "engine",
+    "Project": "engine",
+    "analyze": "engine",
+    "depth_grid": "engine",
+    "evaluate_window": "engine",
+    "load_project": "engine",
+    "run_analysis": "engine",
+    "run_stage": "engine",
+    "Grid": "grid",
+    "run_hypsometry": "hypsometry",
+    "Trace": "instrument",
+    "tracing": "instrument",
+    "RunJournal": "journal",
+    "polygon_records": "polygons",
+    "ReachIndex": "reach_index",
+    "open_reach_index": "reach_index",
+    "ResidentProject": "server",
+    "stage_depth": "stage_index",
+    "stage_extent": "stage_index",
+    "ReachStatistics": "statistics",
+    "Subgrid": "subgrid",
+    "build_subgrid": "subgrid",
+    "run_subgrid": "subgrid",
+    "CenterlineSurface": "surface",
+    "TinSurface": "surface",
+    "run_stage_data": "wse",
+    "sample_cross_sections": "wse",
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def _load(name):
+    value = getattr(importlib.import_module("." + _EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name not in _EXPORTS:
+            raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+        return _load(name)
+
+    def __dir__():
+        return sorted(set(globals()) | set(_EXPORTS))
+else:
+    # Module __getattr__ needs Python 3.7; older versions, such as the Python
+    # 2.7 of ArcGIS Desktop, import everything up front
+    for _name in _EXPORTS:
+        _load(_name)
@@ -0,0 +1,303 @@
+# Floodplain Mapper Toolbox 1.3
+# Command line entry point for running the engine without ArcGIS, e.g.
+#
+#   python -m floodplain_mapper analysis project_folder output_folder DEM 1.0
+#       Reaches Cross_Sections Stage_Data "MIN_Z_Value;Stage_2m"
+#
+# Arguments follow the parameter order of the Analysis script tool.
+
+import argparse
+import logging
+import sys
+
+import numpy as np
+
+from . import batch, server
+from .adapters import ADAPTERS, get_adapter
+from .cache import CACHE_SIZE, ResultCache
+from .curves import CURVE_STEPS, run_curves, run_targets
+from .engine import SURFACES, run_analysis
+from .hypsometry import SLICES, run_hypsometry
+from .instrument import tracing
+from .products import DEFAULT_PRODUCTS
+from .pyramid import PYRAMID_BLOCK
+from .subgrid import SUBGRID_FACTOR, SUBGRID_LEVELS, run_subgrid
+from .wse import run_stage_data
+
+# Both models approximate the CreateTin_3d surface of the Analysis tool; the
+# Surface_Model table of each output says how
+SURFACE_HELP = ("Water surface model through the cross sections, approximating the toolbox "
+                "TIN: tin keeps the cross sections as TIN edges but clips to the reaches cell "
+                "by cell; centerline interpolates along each reach")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="floodplain_mapper")
+    parser.add_argument("--trace", help="Write the time and memory of every step as JSON")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Trace the peak memory of each step with tracemalloc")
+    parser.add_argument("--profile", help="Write cProfile statistics of the run")
+    commands = parser.add_subparsers(dest="command")
+
+    analysis = commands.add_parser("analysis", help="Run the floodplain analysis for each stage")
+    analysis.add_argument("input_geodatabase")
+    analysis.add_argument("output_file_path")
+    analysis.add_argument("dem")
+    analysis.add_argument("cell_size", type=float)
+    analysis.add_argument("reaches")
+    analysis.add_argument("cross_sections")
+    analysis.add_argument("table")
+    analysis.add_argument("stages", help="Stage fields separated by ';'")
+    analysis.add_argument("--keep-intermediate-data", action="store_true")
+    analysis.add_argument("--products",
+                          help="Products to write separated by ';' (default: {0})".format(
+                              ";".join(DEFAULT_PRODUCTS)))
+    analysis.add_argument("--simplify", type=float,
+                          help="Simplify Polygon outlines to this tolerance in map units")
+    analysis.add_argument("--format", choices=sorted(ADAPTERS), default="npy",
+                          help="Workspace format of the input and output data")
+    analysis.add_argument("--surface", choices=SURFACES, default="tin",
+                          help=SURFACE_HELP)
+    analysis.add_argument("--tile-size", type=int,
+                          help="Process the DEM in square tiles of this many cells")
+    analysis.add_argument("--workers", type=int,
+                          help="Run stages in parallel over this many processes")
+    analysis.add_argument("--stage-index", action="store_true",
+                          help="Write one First_Stage raster instead of a depth grid per stage")
+    analysis.add_argument("--cache",
+                          help="Folder of cached stage results reused when inputs are unchanged")
+    analysis.add_argument("--cache-size", type=float, default=CACHE_SIZE / 1024 ** 3,
+                          help="Size limit of the cache folder in GB")
+    analysis.add_argument("--pyramid", type=int, nargs="?", const=PYRAMID_BLOCK,
+                          help="Evaluate depth grids coarse to fine over blocks of this many "
+                               "cells a side (default: {0})".format(PYRAMID_BLOCK))
+    analysis.add_argument("--output-name",
+                          help="Fixed name of the output workspace, kept with a run journal")
+    analysis.add_argument("--resume", action="store_true",
+                          help="Skip the stages an earlier run of --output-name completed")
+
+    hypsometry = commands.add_parser("hypsometry", help="Calculate hypsometry for one stage")
+    hypsometry.add_argument("input_geodatabase")
+    hypsometry.add_argument("output_file_path")
+    hypsometry.add_argument("dem")
+    hypsometry.add_argument("cell_size", type=float)
+    hypsometry.add_argument("reaches")
+    hypsometry.add_argument("cross_sections")
+    hypsometry.add_argument("table")
+    hypsometry.add_argument("stage")
+    hypsometry.add_argument("--format", choices=sorted(ADAPTERS), default="npy",
+                            help="Workspace format of the input and output data")
+    hypsometry.add_argument("--surface", choices=SURFACES, default="tin",
+                            help=SURFACE_HELP)
+    hypsometry.add_argument("--tile-size", type=int,
+                            help="Process the DEM in square tiles of this many cells")
+    hypsometry.add_argument("--slices", type=int, default=SLICES,
+                            help="Number of equal-interval elevation slices")
+
+    curves = commands.add_parser("curves",
+                                 help="Stage-area-volume curves for offsets above one stage")
+    curves.add_argument("input_geodatabase")
+    curves.add_argument("output_file_path")
+    curves.add_argument("dem")
+    curves.add_argument("cell_size", type=float)
+    curves.add_argument("reaches")
+    curves.add_argument("cross_sections")
+    curves.add_argument("table")
+    curves.add_argument("stage", help="Base stage field the offsets are added to")
+    curves.add_argument("--format", choices=sorted(ADAPTERS), default="npy",
+                        help="Workspace format of the input and output data")
+    curves.add_argument("--surface", choices=SURFACES, default="tin",
+                        help=SURFACE_HELP)
+    curves.add_argument("--tile-size", type=int,
+                        help="Process the DEM in square tiles of this many cells")
+    curves.add_argument("--max-offset", type=float,
+                        help="Highest offset above the stage (default: every reach inundated)")
+    curves.add_argument("--steps", type=int, default=CURVE_STEPS,
+                        help="Number of equal offset steps from zero to the highest offset")
+
+    targets = commands.add_parser("targets",
+                                  help="Stage offset at which each reach meets a target")
+    targets.add_argument("input_geodatabase")
+    targets.add_argument("output_file_path")
+    targets.add_argument("dem")
+    targets.add_argument("cell_size", type=float)
+    targets.add_argument("reaches")
+    targets.add_argument("cross_sections")
+    targets.add_argument("table")
+    targets.add_argument("stage", help="Base stage field the offsets are added to")
+    targets.add_argument("--format", choices=sorted(ADAPTERS), default="npy",
+                         help="Workspace format of the input and output data")
+    targets.add_argument("--surface", choices=SURFACES, default="tin",
+                         help=SURFACE_HELP)
+    targets.add_argument("--tile-size", type=int,
+                         help="Process the DEM in square tiles of this many cells")
+    targets.add_argument("--targets",
+                         help="Table of ReachID, Target_Percent and Target_Volume values")
+    targets.add_argument("--percent", type=float,
+                         help="Target fraction inundated (0 to 1) for every reach")
+    targets.add_argument("--volume", type=float, help="Target inundation volume for every reach")
+
+    subgrid = commands.add_parser("subgrid",
+                                  help="Subgrid table of one stage and statistics from it")
+    subgrid.add_argument("input_geodatabase")
+    subgrid.add_argument("output_file_path")
+    subgrid.add_argument("dem")
+    subgrid.add_argument("cell_size", type=float)
+    subgrid.add_argument("reaches")
+    subgrid.add_argument("cross_sections")
+    subgrid.add_argument("table")
+    subgrid.add_argument("stage", help="Base stage field of the subgrid table")
+    subgrid.add_argument("--stages", help="Stage fields to write statistics for separated by ';'")
+    subgrid.add_argument("--subgrid",
+                         help="Existing subgrid table of the stage in the input workspace")
+    subgrid.add_argument("--factor", type=int, default=SUBGRID_FACTOR,
+                         help="DEM cells along each side of a coarse cell")
+    subgrid.add_argument("--levels", type=int, default=SUBGRID_LEVELS,
+                         help="Histogram bins of each coarse cell")
+    subgrid.add_argument("--format", choices=sorted(ADAPTERS), default="npy",
+                         help="Workspace format of the input and output data")
+    subgrid.add_argument("--surface", choices=SURFACES, default="tin",
+                         help=SURFACE_HELP)
+    subgrid.add_argument("--tile-size", type=int,
+                         help="Process the DEM in square tiles of this many cells")
+
+    wse = commands.add_parser("wse", help="Create or update Stage_Data from the DEM (Get WSE)")
+    wse.add_argument("input_geodatabase")
+    wse.add_argument("dem")
+    wse.add_argument("cross_sections")
+    wse.add_argument("--table", default="Stage_Data", help="Name of the stage table")
+    wse.add_argument("--offsets", default="",
+                     help="Offsets above MIN_Z_Value separated by ';', one stage column each")
+    wse.add_argument("--percentiles", default="",
+                     help="Percentiles of the cross-section elevations separated by ';'")
+    wse.add_argument("--cell-size", type=float, help="Sample the DEM resampled to this cell size")
+    wse.add_argument("--all", action="store_true",
+                     help="Sample every cross section, not only added or edited ones")
+    wse.add_argument("--replace", action="store_true",
+                     help="Overwrite fields added by hand that have the name of a generated "
+                          "field")
+    wse.add_argument("--format", choices=sorted(ADAPTERS), default="npy",
+                     help="Workspace format of the input data")
+
+    batch_runs = commands.add_parser("batch", help="Run the steps of every project in a manifest")
+    batch_runs.add_argument("manifest", help="JSON list of projects and the steps to run")
+    batch_runs.add_argument("--output", help="Folder of the projects' outputs, one per project")
+    batch_runs.add_argument("--workers", type=int,
+                            help="Projects run at once (default: one per CPU)")
+    batch_runs.add_argument("--retries", type=int, default=batch.RETRIES,
+                            help="Attempts after the first failure of a project")
+    batch_runs.add_argument("--retry-delay", type=float, default=batch.RETRY_DELAY,
+                            help="Seconds between attempts")
+    batch_runs.add_argument("--log-folder", help="Folder of the per-project logs")
+    batch_runs.add_argument("--report", help="Write the summary of every project as JSON")
+    batch_runs.add_argument("--resume", action="store_true",
+                            help="Continue the outputs of an earlier run of the manifest")
+
+    serve = commands.add_parser("serve", help="Answer stage queries over HTTP from memory")
+    serve.add_argument("input_geodatabase")
+    serve.add_argument("dem")
+    serve.add_argument("cell_size", type=float)
+    serve.add_argument("reaches")
+    serve.add_argument("cross_sections")
+    serve.add_argument("table")
+    serve.add_argument("--stages",
+                       help="Stage fields to prepare before serving separated by ';' "
+                            "(default: all)")
+    serve.add_argument("--format", choices=sorted(ADAPTERS), default="npy",
+                       help="Workspace format of the input data")
+    serve.add_argument("--surface", choices=SURFACES, default="tin",
+                       help=SURFACE_HELP)
+    serve.add_argument("--host", default=server.HOST, help="Address to listen on")
+    serve.add_argument("--port", type=int, default=server.PORT, help="Port to listen on")
+    serve.add_argument("--cache-entries", type=int, default=server.RESULT_CACHE,
+                       help="Number of recent answers kept in memory")
+
+    bench = commands.add_parser("benchmark", help="Time each step on synthetic projects")
+    bench.add_argument("--quick", action="store_true", help="Small DEMs only")
+    bench.add_argument("--output", help="Write the results as JSON, e.g. to store a baseline")
+    bench.add_argument("--baseline", help="Results of an earlier run to check for regressions")
+    bench.add_argument("--tolerance", type=float,
+                       help="Fraction slower than the baseline reported as a regression "
+                            "(default: 0.25)")
+    bench.add_argument("--surface", choices=SURFACES, default="tin",
+                       help=SURFACE_HELP)
+    bench.add_argument("--tile-size", type=int,
+                       help="Process the DEM in square tiles of this many cells")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.trace or args.trace_memory or args.profile:
+        with tracing(args.trace, args.trace_memory, args.profile):
+            return run(parser, args)
+    return run(parser, args)
+
+
+def run(parser, args):
+    if args.command == "analysis":
+        if args.resume and not args.output_name:
+            parser.error("--resume needs the --output-name of the run to resume")
+        source = get_adapter(args.format)(args.input_geodatabase)
+        cache = None
+        if args.cache:
+            cache = ResultCache(args.cache, int(args.cache_size * 1024 ** 3))
+        run_analysis(source, args.output_file_path, args.dem, args.cell_size, args.reaches,
+                     args.cross_sections, args.table, args.stages.split(";"),
+                     delete_intermediate_data=not args.keep_intermediate_data,
+                     tile_size=args.tile_size, workers=args.workers, cache=cache,
+                     stage_index=args.stage_index, surface=args.surface,
+                     products=args.products.split(";") if args.products else None,
+                     simplify=args.simplify, output_name=args.output_name, resume=args.resume,
+                     pyramid=args.pyramid)
+    elif args.command == "hypsometry":
+        source = get_adapter(args.format)(args.input_geodatabase)
+        run_hypsometry(source, args.output_file_path, args.dem, args.cell_size, args.reaches,
+                       args.cross_sections, args.table, args.stage, tile_size=args.tile_size,
+                       slices=args.slices, surface=args.surface)
+    elif args.command == "curves":
+        source = get_adapter(args.format)(args.input_geodatabase)
+        offsets = None
+        if args.max_offset is not None:
+            offsets = np.linspace(0.0, args.max_offset, args.steps + 1)
+        run_curves(source, args.output_file_path, args.dem, args.cell_size, args.reaches,
+                   args.cross_sections, args.table, args.stage, offsets, tile_size=args.tile_size,
+                   steps=args.steps, surface=args.surface)
+    elif args.command == "targets":
+        source = get_adapter(args.format)(args.input_geodatabase)
+        target_rows = None
+        if args.targets:
+            target_rows = [(row["ReachID"], row.get("Target_Percent"), row.get("Target_Volume"))
+                           for row in source.read_table(args.targets)]
+        elif args.percent is None and args.volume is None:
+            parser.error("targets needs --targets, --percent or --volume")
+        run_targets(source, args.output_file_path, args.dem, args.cell_size, args.reaches,
+                    args.cross_sections, args.table, args.stage, target_rows, args.percent,
+                    args.volume, tile_size=args.tile_size, surface=args.surface)
+    elif args.command == "subgrid":
+        source = get_adapter(args.format)(args.input_geodatabase)
+        run_subgrid(source, args.output_file_path, args.dem, args.cell_size, args.reaches,
+                    args.cross_sections, args.table, args.stage,
+                    args.stages.split(";") if args.stages else None, args.subgrid,
+                    tile_size=args.tile_size, factor=args.factor, levels=args.levels,
+                    surface=args.surface)
+    elif args.command == "wse":
+        source = get_adapter(args.format)(args.input_geodatabase)
+        offsets = [float(value) for value in args.offsets.split(";") if value]
+        percentiles = [float(value) for value in args.percentiles.split(";") if value]
+        run_stage_data(source, args.dem, args.cross_sections, args.table, offsets, percentiles,
+                       args.cell_size, update=not args.all, replace=args.replace)
+    elif args.command == "batch":
+        return batch.main(args)
+    elif args.command == "serve":
+        server.main(args)
+    elif args.command == "benchmark":
+        # The benchmark pulls in every step of the engine, so it is only
+        # imported when run
+        from . import benchmark
+        return benchmark.main(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
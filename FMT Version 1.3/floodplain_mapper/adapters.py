@@ -0,0 +1,479 @@
+# Floodplain Mapper Toolbox 1.3
+# I/O adapters between workspaces on disk and the in-memory NumPy engine
+#
+# Every adapter wraps one workspace (a folder, or a file geodatabase for
+# arcpy) and exposes the same small set of reads and writes, so the engine
+# never needs to know where rasters, features and tables are stored.
+
+from __future__ import division
+
+import csv
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from .grid import Grid
+
+# CreateFeatureclass geometry type of each GeoJSON geometry type
+GEOMETRY_TYPES = {
+    "Point": "POINT",
+    "MultiPoint": "MULTIPOINT",
+    "LineString": "POLYLINE",
+    "MultiLineString": "POLYLINE",
+    "Polygon": "POLYGON",
+    "MultiPolygon": "POLYGON",
+}
+
+# Intermediate data of the script tools is kept in memory up to this many
+# bytes and spills to the scratch geodatabase beyond it
+SCRATCH_BUDGET = 2 * 1024 ** 3
+
+
+class NumpyAdapter(object):
+    """Folder workspace: rasters as .npy plus a .json georeference sidecar,
+    features as GeoJSON and tables as CSV. Needs nothing beyond NumPy."""
+
+    raster_extension = ".npy"
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+
+    @classmethod
+    def create(cls, parent, name):
+        workspace = os.path.join(parent, name)
+        if not os.path.isdir(workspace):
+            os.makedirs(workspace)
+        return cls(workspace)
+
+    def path(self, name, extension):
+        return os.path.join(self.workspace, name + extension)
+
+    def _sidecar(self, name):
+        return self.path(name, ".json")
+
+    def exists(self, name):
+        for extension in (self.raster_extension, ".geojson", ".csv"):
+            if os.path.exists(self.path(name, extension)):
+                return True
+        return False
+
+    def delete(self, name):
+        for extension in (self.raster_extension, ".json", ".geojson", ".csv"):
+            path = self.path(name, extension)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def move(self, source, name):
+        # Take over a dataset from another workspace of the same format; a
+        # rename when both folders are on one disk
+        self.delete(name)
+        for extension in (self.raster_extension, ".json", ".geojson", ".csv"):
+            if os.path.exists(source.path(name, extension)):
+                shutil.move(source.path(name, extension), self.path(name, extension))
+
+    def rename(self, name, new_name):
+        # Replaces any dataset called new_name; each file is renamed in one step
+        self.delete(new_name)
+        for extension in (self.raster_extension, ".json", ".geojson", ".csv"):
+            if os.path.exists(self.path(name, extension)):
+                os.rename(self.path(name, extension), self.path(new_name, extension))
+
+    def stat(self, name):
+        # (size, modification time) of a raster file, used to tell whether it
+        # changed since it was last read
+        info = os.stat(self.path(name, self.raster_extension))
+        return info.st_size, info.st_mtime
+
+    # Rasters
+    def open_raster(self, name):
+        # Memory-mapped, so blocks are only read from disk when sliced
+        with open(self._sidecar(name)) as f:
+            header = json.load(f)
+        array = np.load(self.path(name, ".npy"), mmap_mode="r")
+        return Grid(array, header["x_min"], header["y_max"], header["cell_size"],
+                    header.get("spatial_reference"), header.get("nodata"))
+
+    def read_raster(self, name):
+        return self.open_raster(name).load()
+
+    def create_raster(self, name, grid, dtype=np.float32):
+        # Writer that receives the raster block by block; integer rasters
+        # have no NoData
+        header = {"x_min": grid.x_min, "y_max": grid.y_max, "cell_size": grid.cell_size,
+                  "nodata": None, "spatial_reference": grid.spatial_reference}
+        with open(self._sidecar(name), "w") as f:
+            json.dump(header, f)
+        array = np.lib.format.open_memmap(self.path(name, ".npy"), mode="w+", dtype=dtype,
+                                          shape=grid.shape)
+        return _ArrayWriter(array)
+
+    def write_raster(self, name, grid):
+        writer = self.create_raster(name, grid)
+        writer.write(grid.full_window(), grid.array)
+        writer.close()
+
+    # Features
+    def read_features(self, name, id_field):
+        # Returns (id, parts) pairs; parts are lists of (x, y) vertices, one per
+        # polygon ring or polyline part
+        with open(self.path(name, ".geojson")) as f:
+            collection = json.load(f)
+        features = []
+        for feature in collection["features"]:
+            geometry = feature["geometry"]
+            kind = geometry["type"]
+            coordinates = geometry["coordinates"]
+            if kind in ("Polygon", "MultiLineString"):
+                parts = coordinates
+            elif kind == "MultiPolygon":
+                parts = [ring for polygon in coordinates for ring in polygon]
+            elif kind == "LineString":
+                parts = [coordinates]
+            else:
+                raise RuntimeError("{0} has unsupported geometry type {1}".format(name, kind))
+            parts = [[(point[0], point[1]) for point in part] for part in parts]
+            features.append((feature["properties"].get(id_field), parts))
+        return features
+
+    def read_records(self, name, fields):
+        # (properties, geometry) pairs as taken by write_features
+        with open(self.path(name, ".geojson")) as f:
+            collection = json.load(f)
+        return [(tuple(feature["properties"].get(field) for field, field_type in fields),
+                 feature["geometry"]) for feature in collection["features"]]
+
+    def write_features(self, name, fields, records, spatial_reference=None):
+        # fields are (name, type) pairs as for write_table; records are
+        # (properties, geometry) pairs with GeoJSON geometries. GeoJSON has
+        # no spatial reference, so spatial_reference is not kept.
+        names = [field for field, field_type in fields]
+        features = []
+        for properties, geometry in records:
+            features.append({"type": "Feature", "properties": dict(zip(names, properties)),
+                             "geometry": geometry})
+        with open(self.path(name, ".geojson"), "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+
+    # Tables
+    def read_table(self, name):
+        with open(self.path(name, ".csv")) as f:
+            rows = []
+            for row in csv.DictReader(f):
+                rows.append(dict((k, (v if v != "" else None)) for k, v in row.items()))
+        return rows
+
+    def write_table(self, name, fields, rows):
+        # fields are (name, type) pairs using the AddField type keywords
+        with open(self.path(name, ".csv"), "w") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow([field for field, field_type in fields])
+            for row in rows:
+                writer.writerow(["" if value is None else value for value in row])
+
+
+class GeoTiffAdapter(NumpyAdapter):
+    """Folder workspace with rasters stored as GeoTIFF through GDAL."""
+
+    raster_extension = ".tif"
+
+    def __init__(self, workspace):
+        NumpyAdapter.__init__(self, workspace)
+        from osgeo import gdal
+        self.gdal = gdal
+
+    def delete(self, name):
+        NumpyAdapter.delete(self, name)
+        if os.path.exists(self.path(name, ".tif.aux.xml")):
+            os.remove(self.path(name, ".tif.aux.xml"))
+
+    def open_raster(self, name):
+        dataset = self.gdal.Open(self.path(name, ".tif"))
+        band = dataset.GetRasterBand(1)
+        x_min, cell_size, _, y_max, _, _ = dataset.GetGeoTransform()
+        return Grid(_BandArray(dataset, band), x_min, y_max, cell_size,
+                    dataset.GetProjection() or None, band.GetNoDataValue())
+
+    def create_raster(self, name, grid, dtype=np.float32):
+        integer = np.issubdtype(dtype, np.integer)
+        data_type = self.gdal.GDT_Int16 if integer else self.gdal.GDT_Float32
+        driver = self.gdal.GetDriverByName("GTiff")
+        dataset = driver.Create(self.path(name, ".tif"), grid.cols, grid.rows, 1, data_type,
+                                ["TILED=YES", "BIGTIFF=IF_SAFER"])
+        dataset.SetGeoTransform((grid.x_min, grid.cell_size, 0.0, grid.y_max, 0.0, -grid.cell_size))
+        if grid.spatial_reference:
+            dataset.SetProjection(grid.spatial_reference)
+        band = dataset.GetRasterBand(1)
+        if integer:
+            return _BandWriter(dataset, band, None)
+        band.SetNoDataValue(-9999.0)
+        return _BandWriter(dataset, band, -9999.0)
+
+
+class _ArrayWriter(object):
+
+    def __init__(self, array):
+        self.array = array
+
+    def write(self, window, block):
+        row_start, row_stop, col_start, col_stop = window
+        self.array[row_start:row_stop, col_start:col_stop] = block
+
+    def close(self):
+        self.array.flush()
+        self.array = None
+
+
+class _BandArray(object):
+    # Block reads from a GDAL band through slicing
+
+    def __init__(self, dataset, band):
+        self.dataset = dataset
+        self.band = band
+        self.shape = (dataset.RasterYSize, dataset.RasterXSize)
+
+    def __getitem__(self, key):
+        rows = range(*key[0].indices(self.shape[0]))
+        cols = range(*key[1].indices(self.shape[1]))
+        return self.band.ReadAsArray(cols[0], rows[0], len(cols), len(rows))
+
+
+class _BandWriter(object):
+
+    def __init__(self, dataset, band, nodata):
+        self.dataset = dataset
+        self.band = band
+        self.nodata = nodata
+
+    def write(self, window, block):
+        row_start, row_stop, col_start, col_stop = window
+        if self.nodata is not None:
+            block = np.where(np.isnan(block), self.nodata, block)
+        self.band.WriteArray(block, col_start, row_start)
+
+    def close(self):
+        self.band.FlushCache()
+        self.band = None
+        self.dataset = None
+
+
+class ArcpyMessageHandler(logging.Handler):
+    # Forwards engine log records to the geoprocessing messages window
+
+    def __init__(self, arcpy):
+        logging.Handler.__init__(self)
+        self.arcpy = arcpy
+
+    def emit(self, record):
+        message = self.format(record)
+        if record.levelno >= logging.ERROR:
+            self.arcpy.AddError(message)
+        elif record.levelno >= logging.WARNING:
+            self.arcpy.AddWarning(message)
+        else:
+            self.arcpy.AddMessage(message)
+
+
+class ArcpyAdapter(object):
+    """File geodatabase workspace read and written through arcpy."""
+
+    NODATA = -9999.0
+
+    def __init__(self, workspace):
+        import arcpy
+        self.arcpy = arcpy
+        self.workspace = workspace
+
+    @classmethod
+    def create(cls, parent, name):
+        # An existing geodatabase is reused, as when a run is resumed
+        import arcpy
+        if not arcpy.Exists(os.path.join(parent, name + ".gdb")):
+            arcpy.CreateFileGDB_management(parent, name)
+        return cls(os.path.join(parent, name + ".gdb"))
+
+    @classmethod
+    def scratch(cls, size, budget=SCRATCH_BUDGET):
+        # Workspace for intermediate data of about size bytes: in_memory
+        # while it fits within budget, otherwise the scratch geodatabase
+        import arcpy
+        if size <= budget:
+            return cls("in_memory")
+        return cls(arcpy.env.scratchGDB)
+
+    def path(self, name):
+        return os.path.join(self.workspace, name)
+
+    def exists(self, name):
+        return self.arcpy.Exists(self.path(name))
+
+    def delete(self, name):
+        if self.exists(name):
+            self.arcpy.Delete_management(self.path(name))
+
+    def move(self, source, name):
+        self.delete(name)
+        self.arcpy.Copy_management(source.path(name), self.path(name))
+        source.delete(name)
+
+    def rename(self, name, new_name):
+        self.delete(new_name)
+        self.arcpy.Rename_management(self.path(name), self.path(new_name))
+
+    def stat(self, name):
+        # Geodatabase rasters have no single file to check
+        return None
+
+    # Rasters
+    def open_raster(self, name):
+        raster = self.arcpy.Raster(self.path(name))
+        return Grid(_ArcpyRasterArray(self.arcpy, raster), raster.extent.XMin, raster.extent.YMax,
+                    raster.meanCellWidth, raster.spatialReference, raster.noDataValue)
+
+    def read_raster(self, name):
+        return self.open_raster(name).load()
+
+    def create_raster(self, name, grid, dtype=np.float32):
+        return _ArcpyRasterWriter(self, name, grid, dtype)
+
+    def write_raster(self, name, grid):
+        writer = self.create_raster(name, grid)
+        writer.write(grid.full_window(), grid.array)
+        writer.close()
+
+    # Features
+    def read_features(self, name, id_field):
+        features = []
+        with self.arcpy.da.SearchCursor(self.path(name), [id_field, "SHAPE@"]) as cursor:
+            for row in cursor:
+                parts = []
+                for part in row[1]:
+                    # Interior rings are separated by None within a part
+                    ring = []
+                    for point in part:
+                        if point is None:
+                            parts.append(ring)
+                            ring = []
+                        else:
+                            ring.append((point.X, point.Y))
+                    parts.append(ring)
+                features.append((row[0], parts))
+        return features
+
+    def read_records(self, name, fields):
+        names = [field for field, field_type in fields] + ["SHAPE@"]
+        with self.arcpy.da.SearchCursor(self.path(name), names) as cursor:
+            return [(tuple(row[:-1]), row[-1].__geo_interface__) for row in cursor]
+
+    def write_features(self, name, fields, records, spatial_reference=None):
+        # The feature class takes its geometry type from the first record
+        arcpy = self.arcpy
+        records = list(records)
+        kind = records[0][1]["type"] if records else "Polygon"
+        arcpy.CreateFeatureclass_management(self.workspace, name, GEOMETRY_TYPES[kind],
+                                            spatial_reference=spatial_reference)
+        for field, field_type in fields:
+            arcpy.AddField_management(self.path(name), field, field_type)
+        names = [field for field, field_type in fields] + ["SHAPE@"]
+        with arcpy.da.InsertCursor(self.path(name), names) as cursor:
+            for properties, geometry in records:
+                shape = arcpy.AsShape(geometry)
+                cursor.insertRow(list(properties) + [shape])
+
+    # Tables
+    def read_table(self, name):
+        with self.arcpy.da.SearchCursor(self.path(name), "*") as cursor:
+            fields = cursor.fields
+            return [dict(zip(fields, row)) for row in cursor]
+
+    def write_table(self, name, fields, rows):
+        arcpy = self.arcpy
+        arcpy.CreateTable_management(self.workspace, name)
+        for field, field_type in fields:
+            arcpy.AddField_management(self.path(name), field, field_type)
+        names = [field for field, field_type in fields]
+        with arcpy.da.InsertCursor(self.path(name), names) as cursor:
+            for row in rows:
+                cursor.insertRow(row)
+
+
+class _ArcpyRasterArray(object):
+    # Block reads through RasterToNumPyArray's lower-left corner and size
+
+    def __init__(self, arcpy, raster):
+        self.arcpy = arcpy
+        self.raster = raster
+        self.shape = (raster.height, raster.width)
+
+    def __getitem__(self, key):
+        rows = range(*key[0].indices(self.shape[0]))
+        cols = range(*key[1].indices(self.shape[1]))
+        cell_size = self.raster.meanCellWidth
+        lower_left = self.arcpy.Point(self.raster.extent.XMin + cols[0] * cell_size,
+                                      self.raster.extent.YMax - (rows[-1] + 1) * cell_size)
+        return self.arcpy.RasterToNumPyArray(self.raster, lower_left, len(cols), len(rows))
+
+
+class _ArcpyRasterWriter(object):
+    # Blocks are saved as scratch rasters and mosaicked into the final raster
+    # on close; a single whole-grid block is saved directly
+
+    def __init__(self, adapter, name, grid, dtype=np.float32):
+        self.adapter = adapter
+        self.arcpy = adapter.arcpy
+        self.name = name
+        self.grid = grid
+        self.integer = np.issubdtype(dtype, np.integer)
+        self.tiles = []
+
+    def _raster(self, window, block):
+        row_start, row_stop, col_start, col_stop = window
+        cell_size = self.grid.cell_size
+        lower_left = self.arcpy.Point(self.grid.x_min + col_start * cell_size,
+                                      self.grid.y_max - row_stop * cell_size)
+        if self.integer:
+            return self.arcpy.NumPyArrayToRaster(np.asarray(block, dtype=np.int16), lower_left,
+                                                 cell_size, cell_size)
+        array = np.where(np.isnan(block), ArcpyAdapter.NODATA, block).astype(np.float32)
+        return self.arcpy.NumPyArrayToRaster(array, lower_left, cell_size, cell_size,
+                                             ArcpyAdapter.NODATA)
+
+    def write(self, window, block):
+        raster = self._raster(window, block)
+        if tuple(window) == self.grid.full_window():
+            raster.save(self.adapter.path(self.name))
+        else:
+            tile = os.path.join(self.arcpy.env.scratchGDB,
+                                "{0}_Tile{1}".format(self.name, len(self.tiles)))
+            raster.save(tile)
+            self.tiles.append(tile)
+
+    def close(self):
+        arcpy = self.arcpy
+        if self.tiles:
+            pixel_type = "16_BIT_SIGNED" if self.integer else "32_BIT_FLOAT"
+            arcpy.MosaicToNewRaster_management(self.tiles, self.adapter.workspace, self.name,
+                                               self.grid.spatial_reference, pixel_type,
+                                               self.grid.cell_size, 1)
+            for tile in self.tiles:
+                arcpy.Delete_management(tile)
+            self.tiles = []
+        elif self.grid.spatial_reference is not None:
+            arcpy.DefineProjection_management(self.adapter.path(self.name),
+                                              self.grid.spatial_reference)
+
+
+ADAPTERS = {
+    "npy": NumpyAdapter,
+    "tif": GeoTiffAdapter,
+    "arcpy": ArcpyAdapter,
+}
+
+
+def get_adapter(kind):
+    if kind not in ADAPTERS:
+        raise RuntimeError("Unknown workspace format {0}, expected one of {1}".format(
+            kind, ", ".join(sorted(ADAPTERS))))
+    return ADAPTERS[kind]
@@ -0,0 +1,241 @@
+# Floodplain Mapper Toolbox 1.3
+# Headless batch runs of the toolbox steps over many project workspaces
+#
+# A JSON manifest lists the projects, each with its input workspace, DEM,
+# Reaches, Cross_Sections, Stage_Data and stages, and the steps to run on it:
+# Get WSE ("wse"), the Analysis ("analysis") and the Hypsometry
+# ("hypsometry"). Projects run in parallel over a bounded pool of processes,
+# one process per project, each with its own log file. A failed project is
+# retried; steps and hypsometry stages it already finished are not repeated,
+# and the Analysis has a fixed output name so a retry resumes from the stage
+# that failed. An Analysis left by an earlier batch is only continued, and
+# its finished hypsometry stages kept, when the batch is run with resume. A
+# summary of every project is logged and written as JSON at the end.
+#
+#   {"defaults": {"dem": "DEM", "cell_size": 1.0, "steps": ["wse", "analysis"]},
+#    "projects": [{"name": "Creek_A", "input": "Creek_A",
+#                  "stages": ["MIN_Z_Value", "Stage_2m"]}]}
+#
+# Create Inputs is not a batch step: it creates the empty Reaches and
+# Cross_Sections feature classes that are then drawn by hand.
+
+from __future__ import division
+
+import json
+import logging
+import os
+import time
+import traceback
+
+from .adapters import get_adapter
+from .engine import run_analysis
+from .hypsometry import run_hypsometry
+from .journal import journal_path
+from .wse import run_stage_data
+
+log = logging.getLogger(__name__)
+
+STEPS = ("wse", "analysis", "hypsometry")
+
+# Settings of a project when neither it nor the manifest's defaults give them
+DEFAULTS = {
+    "format": "npy",
+    "dem": "DEM",
+    "cell_size": None,
+    "reaches": "Reaches",
+    "cross_sections": "Cross_Sections",
+    "table": "Stage_Data",
+    "stages": ["MIN_Z_Value"],
+    "steps": ["analysis"],
+    "offsets": [],
+    "percentiles": [],
+    "products": None,
+    "surface": "tin",
+    "tile_size": None,
+    "pyramid": None,
+    "hypsometry_stages": None,
+}
+
+# Attempts after the first failure of a project, and seconds between them
+RETRIES = 2
+RETRY_DELAY = 10.0
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+# Output names of a project's Analysis and of the Hypsometry of each stage
+ANALYSIS_NAME = "FMT_{0}"
+HYPSOMETRY_NAME = "FMT_{0}_Hypsometry_{1}"
+
+
+def read_manifest(path, output_root=None):
+    # The projects of a manifest with defaults filled in. Relative paths are
+    # taken from the manifest's folder, and each project's output goes to
+    # output_root/<name> unless it gives an output folder.
+    with open(path) as f:
+        manifest = json.load(f)
+    folder = os.path.dirname(os.path.abspath(path))
+    output_root = output_root or os.path.join(folder, "output")
+    projects = []
+    names = set()
+    for index, entry in enumerate(manifest["projects"]):
+        project = dict(DEFAULTS)
+        project.update(manifest.get("defaults", {}))
+        project.update(entry)
+        if "input" not in project:
+            raise RuntimeError("Project {0} of {1} has no input workspace".format(index + 1, path))
+        project.setdefault("name", os.path.splitext(os.path.basename(project["input"]))[0])
+        if project["name"] in names:
+            raise RuntimeError("Project name {0} is used twice in {1}".format(project["name"],
+                                                                             path))
+        names.add(project["name"])
+        for step in project["steps"]:
+            if step not in STEPS:
+                raise RuntimeError("Unknown step {0} for {1}, expected one of {2}".format(
+                    step, project["name"], ", ".join(STEPS)))
+        project["input"] = os.path.join(folder, project["input"])
+        project["output"] = os.path.join(folder, project.get("output") or
+                                         os.path.join(output_root, project["name"]))
+        projects.append(project)
+    return projects
+
+
+def run_step(project, step, resume=False, finished=None, retry=False):
+    # resume continues the Analysis of an earlier batch and keeps the
+    # hypsometry stages it completed; retry continues the Analysis this batch
+    # started. finished lists the hypsometry stages completed by this batch,
+    # which are skipped, and is added to as stages complete.
+    source = get_adapter(project["format"])(project["input"])
+    if step == "wse":
+        run_stage_data(source, project["dem"], project["cross_sections"], project["table"],
+                       project["offsets"], project["percentiles"], project["cell_size"])
+    elif step == "analysis":
+        # Nested process pools are not allowed, so stages run in this process
+        run_analysis(source, project["output"], project["dem"], project["cell_size"],
+                     project["reaches"], project["cross_sections"], project["table"],
+                     project["stages"], tile_size=project["tile_size"],
+                     surface=project["surface"], products=project["products"],
+                     pyramid=project["pyramid"],
+                     output_name=ANALYSIS_NAME.format(project["name"]), resume=resume or retry)
+    elif step == "hypsometry":
+        finished = [] if finished is None else finished
+        for stage in project["hypsometry_stages"] or project["stages"]:
+            if stage in finished:
+                continue
+            name = HYPSOMETRY_NAME.format(project["name"], stage)
+            # Hypsometry_all is the last output written
+            if resume and type(source)(os.path.join(project["output"], name)).exists(
+                    "Hypsometry_all"):
+                log.info("Keeping the hypsometry of {0} from an earlier batch".format(stage))
+            else:
+                run_hypsometry(source, project["output"], project["dem"], project["cell_size"],
+                               project["reaches"], project["cross_sections"], project["table"],
+                               stage, tile_size=project["tile_size"], surface=project["surface"],
+                               output_name=name)
+            finished.append(stage)
+
+
+def run_project(job):
+    # Runs every step of one project, logging to its own file; returns the
+    # project's summary
+    project, log_folder, retries, retry_delay, resume = job
+    log_path = os.path.join(log_folder, "{0}.log".format(project["name"]))
+    handler = logging.FileHandler(log_path, mode="w")
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    # Only the summary of each project reaches the console
+    root = logging.getLogger()
+    handlers = root.handlers
+    level = root.level
+    root.handlers = [handler]
+    root.setLevel(logging.INFO)
+    summary = {"name": project["name"], "status": "failed", "attempts": 0, "steps": [],
+               "hypsometry_stages": [], "error": None, "log": log_path}
+    start = time.time()
+    # Retries continue the Analysis this batch starts; one already in the
+    # output is only continued with resume, and is refused otherwise
+    started = not os.path.exists(journal_path(project["output"],
+                                              ANALYSIS_NAME.format(project["name"])))
+    try:
+        if not os.path.isdir(project["output"]):
+            os.makedirs(project["output"])
+        while summary["attempts"] <= retries:
+            summary["attempts"] += 1
+            try:
+                for step in project["steps"]:
+                    if step in summary["steps"]:
+                        continue
+                    log.info("Running {0} for {1}".format(step, project["name"]))
+                    run_step(project, step, resume, summary["hypsometry_stages"],
+                             started and summary["attempts"] > 1)
+                    summary["steps"].append(step)
+                summary["status"] = "ok"
+                summary["error"] = None
+                break
+            except Exception as error:
+                log.error(traceback.format_exc())
+                summary["error"] = "{0}: {1}".format(type(error).__name__, error)
+                if summary["attempts"] <= retries:
+                    log.info("Retrying {0} in {1:g} s".format(project["name"], retry_delay))
+                    time.sleep(retry_delay)
+    finally:
+        summary["seconds"] = time.time() - start
+        root.handlers = handlers
+        root.setLevel(level)
+        handler.close()
+    return summary
+
+
+def run_batch(projects, log_folder, workers=None, retries=RETRIES, retry_delay=RETRY_DELAY,
+              resume=False):
+    # Summaries of every project in manifest order. Each project runs in a
+    # fresh process, so memory held by one project (or by arcpy) is released
+    # before the next starts. With resume the outputs of an earlier batch are
+    # continued.
+    import multiprocessing
+    if not os.path.isdir(log_folder):
+        os.makedirs(log_folder)
+    workers = min(workers or multiprocessing.cpu_count(), len(projects)) or 1
+    jobs = [(project, log_folder, retries, retry_delay, resume) for project in projects]
+    log.info("Running {0} project(s) over {1} worker(s)".format(len(projects), workers))
+    summaries = {}
+    pool = multiprocessing.Pool(workers, maxtasksperchild=1)
+    try:
+        for summary in pool.imap_unordered(run_project, jobs):
+            log.info("{0}: {1} after {2} attempt(s), {3:.1f} s".format(
+                summary["name"], summary["status"], summary["attempts"], summary["seconds"]))
+            summaries[summary["name"]] = summary
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return [summaries[project["name"]] for project in projects]
+
+
+def format_summary(summaries):
+    lines = ["{0:<30} {1:<8} {2:>8} {3:>10}  {4}".format("Project", "Status", "Attempts",
+                                                        "Seconds", "Error")]
+    for summary in summaries:
+        lines.append("{name:<30} {status:<8} {attempts:>8} {seconds:>10.1f}  {0}".format(
+            summary["error"] or "", **summary))
+    failed = len([summary for summary in summaries if summary["status"] != "ok"])
+    lines.append("{0} project(s) finished, {1} failed".format(len(summaries) - failed, failed))
+    return "\n".join(lines)
+
+
+def main(args):
+    # Entry point of "python -m floodplain_mapper batch"
+    projects = read_manifest(args.manifest, args.output)
+    log_folder = args.log_folder or os.path.join(os.path.dirname(os.path.abspath(args.manifest)),
+                                                 "logs")
+    start = time.time()
+    summaries = run_batch(projects, log_folder, args.workers, args.retries, args.retry_delay,
+                          args.resume)
+    print(format_summary(summaries))
+    report = args.report or os.path.join(log_folder, "Batch_Report.json")
+    with open(report, "w") as f:
+        json.dump({"manifest": os.path.abspath(args.manifest), "seconds": time.time() - start,
+                   "projects": summaries}, f, indent=2)
+    if any(summary["status"] != "ok" for summary in summaries):
+        return 1
+    return 0
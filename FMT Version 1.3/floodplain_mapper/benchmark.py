@@ -0,0 +1,244 @@
+# Floodplain Mapper Toolbox 1.3
+# Benchmarks of each toolbox step on synthetic projects, without ArcGIS
+#
+# Every configuration (DEM size, stage count, reach count) is generated into
+# a temporary folder and each step is timed on its own: cross-section
+# sampling (Get WSE), surface generation, depth grids (at full resolution
+# and through the pyramid overview), reach statistics, polygons and
+# hypsometry. The Delaunay triangulation behind the TIN surface is also
+# timed on its own over growing point counts, so a loss of its near-linear
+# scaling shows up as a regression. Results carry throughput in DEM cells
+# per second and the peak memory traced during the step, and can be stored
+# as a baseline that later runs are compared against. Each step is run
+# twice: once timed, and once with tracemalloc measuring its peak memory,
+# whose per-allocation hooks would otherwise slow the timed run down.
+
+from __future__ import division
+
+import gc
+import json
+import logging
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from .adapters import NumpyAdapter
+from .engine import evaluate_window, load_project
+from .hypsometry import hypsometry
+from .polygons import polygon_records
+from .pyramid import PYRAMID_BLOCK
+from .statistics import ReachStatistics
+from .synthetic import make_project
+from .triangulation import delaunay
+from .wse import sample_cross_sections
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+log = logging.getLogger(__name__)
+
+# Configuration every scaling curve varies one parameter away from
+BASE_CONFIG = {"size": 1000, "stages": 5, "reaches": 4}
+SIZES = [250, 500, 1000, 2000]
+STAGE_COUNTS = [1, 5, 20]
+REACH_COUNTS = [1, 4, 16]
+# Point counts of the triangulation scaling curve
+TRIANGULATION_POINTS = [1000, 4000, 16000, 64000]
+
+# A step slower than its baseline by more than this fraction is a regression
+TOLERANCE = 0.25
+
+
+def _measure(function, prepare=None):
+    # (result, seconds, peak traced bytes or None). prepare, when given,
+    # undoes any caching by the first run before the second.
+    gc.collect()
+    start = time.time()
+    result = function()
+    seconds = time.time() - start
+    peak = None
+    if tracemalloc is not None:
+        if prepare is not None:
+            prepare()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def configurations(sizes=SIZES, stage_counts=STAGE_COUNTS, reach_counts=REACH_COUNTS,
+                   base=BASE_CONFIG):
+    # Scaling curves over DEM size, stage count and reach count, each varying
+    # one parameter of the base configuration
+    configs = []
+    for key, values in (("size", sizes), ("stages", stage_counts), ("reaches", reach_counts)):
+        for value in values:
+            config = dict(base)
+            config[key] = value
+            if config not in configs:
+                configs.append(config)
+    return configs
+
+
+def config_key(config):
+    return "size={size} stages={stages} reaches={reaches}".format(**config)
+
+
+def benchmark(config, tile_size=None, surface="tin"):
+    # Timings of each step for one configuration
+    folder = tempfile.mkdtemp(prefix="FMT_Benchmark_")
+    try:
+        adapter = NumpyAdapter(folder)
+        rows = config["size"]
+        cols = config["size"] * 2
+        stages = make_project(adapter, rows, cols, config["stages"], config["reaches"])
+        project = load_project(adapter, "DEM", "Reaches", "Cross_Sections", "Stage_Data",
+                               surface=surface)
+        cells = project.dem.rows * project.dem.cols
+        results = []
+
+        def record(step, seconds, peak, work):
+            results.append({"config": config_key(config), "step": step, "seconds": seconds,
+                            "cells_per_second": work / seconds if seconds else None,
+                            "peak_bytes": peak})
+
+        grid = project.dem.load()
+        result, seconds, peak = _measure(
+            lambda: sample_cross_sections(grid, project.cross_sections))
+        record("wse_sampling", seconds, peak, cells)
+
+        def surfaces():
+            values = project.stage_values(stages[0])
+            model = project.surface_model(set(values))
+            return model, model.locate()
+        (model, location), seconds, peak = _measure(surfaces, project._surfaces.clear)
+        record("surface", seconds, peak, cells)
+
+        def depths():
+            blocks = []
+            for window in project.dem.windows(tile_size):
+                for stage, labels, surface_block, subtracted, depth in \
+                        evaluate_window(project, stages, window):
+                    blocks.append((window, stage, labels, depth))
+            return blocks
+        blocks, seconds, peak = _measure(depths)
+        record("depth", seconds, peak, cells * len(stages))
+
+        def pyramid_depths():
+            for window in project.dem.windows(tile_size):
+                for block in evaluate_window(project, stages, window, pyramid=PYRAMID_BLOCK):
+                    pass
+        result, seconds, peak = _measure(pyramid_depths)
+        record("pyramid_depth", seconds, peak, cells * len(stages))
+
+        def statistics():
+            for window, stage, labels, depth in blocks:
+                ReachStatistics(len(project.reaches)).add(labels, depth)
+        result, seconds, peak = _measure(statistics)
+        record("statistics", seconds, peak, cells * len(stages))
+
+        def polygons():
+            wet = np.zeros((project.dem.rows, project.dem.cols), dtype=bool)
+            for window, stage, labels, depth in blocks:
+                if stage == stages[0]:
+                    wet[window[0]:window[1], window[2]:window[3]] = ~np.isnan(depth)
+            return polygon_records(project, project.dem.like(wet))
+        result, seconds, peak = _measure(polygons)
+        record("polygons", seconds, peak, cells)
+        # Emptied rather than deleted, as the functions above refer to it
+        blocks[:] = []
+
+        result, seconds, peak = _measure(lambda: hypsometry(project, stages[0], tile_size))
+        record("hypsometry", seconds, peak, cells)
+        return results
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def benchmark_triangulation(counts=TRIANGULATION_POINTS):
+    # Timings of the Delaunay triangulation of uniformly scattered points at
+    # projected coordinates; throughput is in points per second
+    results = []
+    for count in counts:
+        points = np.random.RandomState(count).rand(count, 2) * 10000.0 + [500000.0, 4000000.0]
+        result, seconds, peak = _measure(lambda: delaunay(points))
+        results.append({"config": "points={0}".format(count), "step": "triangulation",
+                        "seconds": seconds,
+                        "cells_per_second": count / seconds if seconds else None,
+                        "peak_bytes": peak})
+    return results
+
+
+def run_benchmarks(configs=None, tile_size=None, surface="tin",
+                   triangulation_points=TRIANGULATION_POINTS):
+    configs = configs or configurations()
+    results = []
+    for config in configs:
+        log.info("Benchmarking {0}".format(config_key(config)))
+        results.extend(benchmark(config, tile_size, surface))
+    log.info("Benchmarking triangulation")
+    results.extend(benchmark_triangulation(triangulation_points))
+    return {"machine": platform.platform(), "python": platform.python_version(),
+            "results": results}
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    # Steps slower than the baseline by more than tolerance, as
+    # (config, step, seconds, baseline seconds)
+    previous = dict(((result["config"], result["step"]), result["seconds"])
+                    for result in baseline["results"])
+    regressions = []
+    for result in report["results"]:
+        before = previous.get((result["config"], result["step"]))
+        if before and result["seconds"] > before * (1.0 + tolerance):
+            regressions.append((result["config"], result["step"], result["seconds"], before))
+    return regressions
+
+
+def format_report(report):
+    lines = ["{0:<36} {1:<14} {2:>10} {3:>14} {4:>10}".format(
+        "Configuration", "Step", "Seconds", "Cells/s", "Peak MB")]
+    for result in report["results"]:
+        peak = result["peak_bytes"]
+        rate = result["cells_per_second"]
+        lines.append("{0:<36} {1:<14} {2:>10.3f} {3:>14} {4:>10}".format(
+            result["config"], result["step"], result["seconds"],
+            "{0:.3g}".format(rate) if rate else "-",
+            "{0:.1f}".format(peak / 1024.0 ** 2) if peak is not None else "-"))
+    return "\n".join(lines)
+
+
+def main(args):
+    # Entry point of "python -m floodplain_mapper benchmark"
+    if args.quick:
+        configs = configurations([250, 500], [1, 5], [1, 4], {"size": 250, "stages": 5,
+                                                                "reaches": 4})
+        points = [1000, 4000]
+    else:
+        configs = configurations()
+        points = TRIANGULATION_POINTS
+    report = run_benchmarks(configs, args.tile_size, args.surface, points)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        tolerance = TOLERANCE if args.tolerance is None else args.tolerance
+        regressions = compare(report, baseline, tolerance)
+        for config, step, seconds, before in regressions:
+            log.warning("Regression in {0} ({1}): {2:.3f} s against {3:.3f} s".format(
+                step, config, seconds, before))
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,220 @@
+# Floodplain Mapper Toolbox 1.3
+# Content-addressed cache of per-stage Analysis results
+#
+# A stage's depth grid and statistics only depend on the DEM, the cell size,
+# the Reaches and Cross_Sections geometry, the surface model and its version
+# and that stage's column of Stage_Data. Those inputs are hashed into a key,
+# and the results of every computed stage are kept in a folder named after
+# the key, so rerunning the Analysis after editing or adding one stage only
+# evaluates that stage.
+# Entries are evicted least recently used first once the cache grows past
+# its size limit.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .adapters import NumpyAdapter
+from .engine import DEPTH_THRESHOLD, FEATURE_FIELDS
+from .grid import Grid
+from .surface import DENSIFY_CELLS, SURFACE_VERSION
+
+log = logging.getLogger(__name__)
+
+# Default size limit of a cache folder, in bytes
+CACHE_SIZE = 10 * 1024 ** 3
+
+# Rows of the DEM hashed at a time
+HASH_ROWS = 1024
+
+
+def features_fingerprint(features):
+    digest = hashlib.sha1()
+    for feature_id, parts in features:
+        digest.update(repr(str(feature_id)).encode("utf-8"))
+        for part in parts:
+            digest.update(np.asarray(part, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def raster_fingerprint(grid):
+    # Hash of the georeference and every cell value, read a band of rows at
+    # a time
+    digest = hashlib.sha1()
+    header = (grid.x_min, grid.y_max, grid.cell_size, grid.rows, grid.cols)
+    digest.update(repr(header).encode("utf-8"))
+    for row_start in range(0, grid.rows, HASH_ROWS):
+        window = (row_start, min(row_start + HASH_ROWS, grid.rows), 0, grid.cols)
+        digest.update(np.ascontiguousarray(grid.read(window), dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def _folder_size(path):
+    total = 0
+    for root, folders, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class ResultCache(object):
+    """Folder of cached stage results, one subfolder per stage key.
+
+    Each entry holds the stage's rasters as NumPy arrays and its feature
+    classes as GeoJSON, keyed by product name (DepthGrid, Polygon,
+    RasterFromTIN, Subtracted), and an entry.json with its tables and size.
+    The modification time of entry.json records when the entry was last
+    used.
+    """
+
+    def __init__(self, path, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def dem_fingerprint(self, source, dem, grid):
+        # Hashing reads the whole DEM, so the hash is remembered against the
+        # file's size and modification time where the adapter reports them
+        stat = source.stat(dem)
+        memo_path = os.path.join(self.path, "dem_fingerprints.json")
+        memo = self._read_json(memo_path) or {}
+        memo_key = "{0}|{1}".format(os.path.abspath(source.workspace), dem)
+        if stat is not None and memo.get(memo_key, {}).get("stat") == list(stat):
+            content = memo[memo_key]["fingerprint"]
+        else:
+            log.info("Fingerprinting {0}".format(dem))
+            content = raster_fingerprint(source.open_raster(dem))
+            if stat is not None:
+                memo[memo_key] = {"stat": list(stat), "fingerprint": content}
+                with open(memo_path, "w") as f:
+                    json.dump(memo, f)
+        # The header of the (possibly resampled) grid carries the Cell_Size
+        header = (grid.x_min, grid.y_max, grid.cell_size, grid.rows, grid.cols)
+        return hashlib.sha1((content + repr(header)).encode("utf-8")).hexdigest()
+
+    def stage_keys(self, source, dem, project, stages, simplify=None):
+        # {stage: key} for every stage of an Analysis run. Simplified polygons
+        # are kept apart from unsimplified ones.
+        digest = hashlib.sha1()
+        digest.update(self.dem_fingerprint(source, dem, project.dem).encode("utf-8"))
+        digest.update(features_fingerprint(project.reaches).encode("utf-8"))
+        digest.update(features_fingerprint(project.cross_sections).encode("utf-8"))
+        digest.update(repr((DEPTH_THRESHOLD, DENSIFY_CELLS, SURFACE_VERSION,
+                            project.surface)).encode("utf-8"))
+        if simplify:
+            digest.update(repr(float(simplify)).encode("utf-8"))
+        inputs = digest.hexdigest()
+        keys = {}
+        for stage in stages:
+            values = sorted(project.stage_values(stage).items())
+            keys[stage] = hashlib.sha1((inputs + repr(values)).encode("utf-8")).hexdigest()
+        return keys
+
+    def lookup(self, key, products):
+        # The entry's description if it holds every product, marking it as
+        # used; otherwise None
+        entry = self._read_json(os.path.join(self._entry(key), "entry.json"))
+        if entry is None or not set(products) <= set(entry["rasters"]) | set(
+                entry.get("features", [])):
+            return None
+        os.utime(os.path.join(self._entry(key), "entry.json"), None)
+        return entry
+
+    def restore(self, key, entry, grid, output, names, tile_size=None):
+        # Copy the cached rasters and feature classes into output as
+        # {product: output name} on the cells and spatial reference of grid,
+        # and return the cached tables
+        workspace = NumpyAdapter(self._entry(key))
+        for product, name in names.items():
+            if product in FEATURE_FIELDS:
+                fields = FEATURE_FIELDS[product]
+                output.write_features(name, fields, workspace.read_records(product, fields),
+                                      grid.spatial_reference)
+            else:
+                _copy_raster(workspace.open_raster(product), output, name, grid, tile_size)
+        return dict((table, [tuple(row) for row in rows])
+                    for table, rows in entry["tables"].items())
+
+    def store(self, key, output, names, tables, tile_size=None):
+        # Copy {product: output name} rasters and feature classes of output
+        # and the tables into a new entry, then evict old entries over the
+        # size limit. An entry missing some of the products (intermediates not
+        # kept) is replaced.
+        existing = self._read_json(os.path.join(self._entry(key), "entry.json"))
+        if existing is not None and set(names) <= set(existing["rasters"]) | set(
+                existing.get("features", [])):
+            return
+        scratch = tempfile.mkdtemp(prefix=".tmp_", dir=self.path)
+        try:
+            workspace = NumpyAdapter(scratch)
+            for product, name in names.items():
+                if product in FEATURE_FIELDS:
+                    fields = FEATURE_FIELDS[product]
+                    workspace.write_features(product, fields, output.read_records(name, fields))
+                    continue
+                raster = output.open_raster(name)
+                # The spatial reference is not kept, as arcpy's cannot be
+                # written to the .json sidecar
+                header = Grid(raster.array, raster.x_min, raster.y_max, raster.cell_size)
+                _copy_raster(raster, workspace, product, header, tile_size)
+            size = _folder_size(scratch)
+            if size > self.max_size:
+                log.info("Results are larger than the cache size limit and were not cached")
+                return
+            entry = {"rasters": sorted(product for product in names
+                                       if product not in FEATURE_FIELDS),
+                     "features": sorted(product for product in names if product in FEATURE_FIELDS),
+                     "tables": tables, "size": size}
+            with open(os.path.join(scratch, "entry.json"), "w") as f:
+                json.dump(entry, f)
+            # Entries appear complete or not at all
+            if existing is not None:
+                shutil.rmtree(self._entry(key), ignore_errors=True)
+            os.rename(scratch, self._entry(key))
+        except OSError:
+            # Another run stored the same key first
+            if not os.path.isdir(self._entry(key)):
+                raise
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.path):
+            path = os.path.join(self._entry(key), "entry.json")
+            entry = self._read_json(path) if not key.startswith(".") else None
+            if entry is not None:
+                entries.append((os.path.getmtime(path), entry["size"], key))
+        total = sum(size for used, size, key in entries)
+        for used, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            log.info("Evicting cached results {0}".format(key))
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+
+def _copy_raster(grid, target, name, header, tile_size=None):
+    # Block by block copy of grid into a new raster of target created on the
+    # cells of header
+    writer = target.create_raster(name, header)
+    for window in grid.windows(tile_size):
+        writer.write(window, grid.read(window))
+    writer.close()
@@ -0,0 +1,218 @@
+# Floodplain Mapper Toolbox 1.3
+# Continuous stage-area-volume curves above a base water surface
+#
+# A stage h above the base stage (e.g. MIN_Z_Value + h at every cross
+# section) gives the water surface base + h, so a cell is wet when its
+# relative elevation r = DEM - base is below h - 0.01 and its depth is h - r.
+# Sorting each reach's relative elevations once, the inundated area of any
+# offset is a binary search and its volume a difference of the cumulative
+# sum, so thousands of offsets cost less than one extra Analysis stage.
+# The same sorted values answer the inverse question directly: the offset at
+# which a reach reaches a target percent inundated or inundation volume,
+# found from only the cells inside that reach's window.
+
+from __future__ import division
+
+import logging
+
+import numpy as np
+
+from .engine import DEPTH_THRESHOLD, evaluate_window, load_project, time_output
+from .hypsometry import normalized_blocks
+
+log = logging.getLogger(__name__)
+
+# Offsets evaluated between zero and the maximum offset by default
+CURVE_STEPS = 1000
+
+TARGET_FIELDS = [
+    ("ReachID", "TEXT"),
+    ("Target_Percent", "FLOAT"),
+    ("Target_Volume", "FLOAT"),
+    ("Stage_Offset", "FLOAT"),
+]
+
+CURVE_FIELDS = [
+    ("ReachID", "TEXT"),
+    ("Stage_Offset", "FLOAT"),
+    ("Inundated_Area", "FLOAT"),
+    ("Percent_Inundated", "FLOAT"),
+    ("Inundation_Volume", "FLOAT"),
+]
+
+
+def relative_elevations(project, stage, tile_size=None):
+    # Reach labels and relative elevations of every cell under the stage's
+    # water surface model, gathered window by window
+    labels = []
+    values = []
+    for window, block_labels, normalized in normalized_blocks(project, stage, tile_size):
+        valid = (block_labels > 0) & ~np.isnan(normalized)
+        labels.append(block_labels[valid])
+        values.append(normalized[valid])
+    return np.concatenate(labels), np.concatenate(values)
+
+
+def reach_relative_elevations(project, stage, reach, tile_size=None):
+    # Relative elevations of one reach's cells, evaluating only the windows
+    # covering that reach
+    bounds = project.reach_window(reach)
+    values = [np.zeros(0)]
+    if bounds is None:
+        return values[0]
+    row_start, row_stop, col_start, col_stop = bounds
+    step = tile_size or max(row_stop - row_start, col_stop - col_start)
+    for row in range(row_start, row_stop, step):
+        for col in range(col_start, col_stop, step):
+            window = (row, min(row + step, row_stop), col, min(col + step, col_stop))
+            for result in evaluate_window(project, [stage], window):
+                labels, subtracted = result[1], result[3]
+                valid = (labels == reach + 1) & ~np.isnan(subtracted)
+                values.append(-subtracted[valid])
+    return np.concatenate(values)
+
+
+class StageCurves(object):
+    """Relative elevations sorted within each reach, with their running sum.
+
+    labels are reach numbers (reach index + 1) and relative the matching DEM
+    minus base water surface values.
+    """
+
+    def __init__(self, labels, relative, reach_count):
+        order = np.lexsort((relative, labels))
+        self.relative = np.asarray(relative, dtype=np.float64)[order]
+        self.prefix = np.concatenate([[0.0], np.cumsum(self.relative)])
+        # Reach i's cells are self.relative[starts[i]:starts[i + 1]]
+        self.starts = np.searchsorted(np.asarray(labels)[order], np.arange(1, reach_count + 2))
+
+    def evaluate(self, reach, offsets, threshold=DEPTH_THRESHOLD):
+        # Wet cell count and depth sum of reach (a reach index) at each offset
+        start = self.starts[reach]
+        values = self.relative[start:self.starts[reach + 1]]
+        offsets = np.asarray(offsets, dtype=np.float64)
+        count = np.searchsorted(values, offsets - threshold, side="left")
+        total = count * offsets - (self.prefix[start + count] - self.prefix[start])
+        return count, total
+
+    def offset_for_count(self, reach, count, threshold=DEPTH_THRESHOLD):
+        # Lowest offset at which count cells of reach are wet, or None when
+        # the reach has fewer cells under the water surface model
+        start = self.starts[reach]
+        if count <= 0:
+            return 0.0
+        if count > self.starts[reach + 1] - start:
+            return None
+        # Cells are wet strictly below offset - threshold
+        return float(np.nextafter(self.relative[start + count - 1] + threshold, np.inf))
+
+    def offset_for_volume(self, reach, volume, threshold=DEPTH_THRESHOLD):
+        # Lowest offset whose inundation volume (in depth sum units) reaches
+        # volume. Past the i-th sorted cell the volume grows with slope i + 1,
+        # so the offset is found on the first segment ending above volume.
+        start = self.starts[reach]
+        values = self.relative[start:self.starts[reach + 1]]
+        if volume <= 0:
+            return 0.0
+        if not len(values):
+            return None
+        prefix = self.prefix[start + 1:start + len(values) + 1] - self.prefix[start]
+        wet = np.arange(1, len(values) + 1)
+        ends = np.append(values[1:] + threshold, np.inf)
+        segment = int(np.searchsorted(wet * ends - prefix, volume, side="left"))
+        offset = (volume + prefix[segment]) / wet[segment]
+        # A volume inside the jump as the next cell turns wet at the threshold
+        return float(max(offset, np.nextafter(values[segment] + threshold, np.inf)))
+
+    def maximum(self):
+        # Offset above which every cell is wet
+        if not len(self.relative):
+            return 0.0
+        return float(self.relative.max()) + DEPTH_THRESHOLD
+
+
+def curve_rows(curves, reach_ids, total_areas, cell_size, offsets):
+    # Rows in CURVE_FIELDS order, rounded as the Analysis statistics are
+    rows = []
+    for index, reach_id in enumerate(reach_ids):
+        count, total = curves.evaluate(index, offsets)
+        total_area = round(total_areas[index])
+        for offset, cells, depth in zip(offsets, count, total):
+            area = int(cells) * cell_size * cell_size
+            percent = round(area / total_area, 4) if total_area else None
+            rows.append((reach_id, float(offset), area, percent,
+                         round(float(depth) * cell_size * cell_size, 2)))
+    return rows
+
+
+def target_offsets(project, stage, targets, tile_size=None):
+    # Stage offset per (ReachID, target percent, target volume) target; the
+    # percent is a fraction of the reach area as in Percent_Inundated and
+    # the volume is in the units of Inundation_Volume
+    cell_area = project.dem.cell_area
+    total_areas = project.total_areas
+    reach_ids = [str(reach_id) for reach_id in project.reach_ids]
+    rows = []
+    curves = {}
+    for reach_id, percent, volume in targets:
+        if str(reach_id) not in reach_ids:
+            raise RuntimeError("ReachID {0} is not in the Reaches feature class".format(reach_id))
+        reach = reach_ids.index(str(reach_id))
+        if reach not in curves:
+            log.info("Searching stage offsets for {0}".format(reach_id))
+            values = reach_relative_elevations(project, stage, reach, tile_size)
+            labels = np.full(len(values), reach + 1, dtype=np.intp)
+            curves[reach] = StageCurves(labels, values, len(project.reaches))
+        offsets = []
+        if percent is not None:
+            cells = int(np.ceil(float(percent) * round(total_areas[reach]) / cell_area - 1e-9))
+            offsets.append(curves[reach].offset_for_count(reach, cells))
+        if volume is not None:
+            offsets.append(curves[reach].offset_for_volume(reach, float(volume) / cell_area))
+        if None in offsets:
+            log.warning("Target for {0} is not reached under the water surface model".format(
+                reach_id))
+            offset = None
+        else:
+            offset = max(offsets) if offsets else None
+        rows.append((project.reach_ids[reach],
+                     None if percent is None else float(percent),
+                     None if volume is None else float(volume), offset))
+    return rows
+
+
+def run_targets(source, output_path, dem, cell_size, reaches, cross_sections, table, stage,
+                targets=None, percent=None, volume=None, output_adapter=None, tile_size=None,
+                surface="tin"):
+    # Writes {stage}_Targets with the offset above stage that meets each
+    # target; without a targets list, percent and volume apply to every reach
+    project = load_project(source, dem, reaches, cross_sections, table, cell_size, surface)
+    output_adapter = output_adapter or type(source)
+    output = output_adapter.create(output_path, "FMT_{0}".format(time_output()))
+    if targets is None:
+        targets = [(reach_id, percent, volume) for reach_id in project.reach_ids]
+    rows = target_offsets(project, stage, targets, tile_size)
+    output.write_table("{0}_Targets".format(stage), TARGET_FIELDS, rows)
+    log.info("Script finished")
+    return output
+
+
+def run_curves(source, output_path, dem, cell_size, reaches, cross_sections, table, stage,
+               offsets=None, output_adapter=None, tile_size=None, steps=CURVE_STEPS,
+               surface="tin"):
+    # Writes {stage}_Curves for offsets above stage; without offsets, steps
+    # equal offsets from zero to where every reach is fully inundated
+    project = load_project(source, dem, reaches, cross_sections, table, cell_size, surface)
+    output_adapter = output_adapter or type(source)
+    output = output_adapter.create(output_path, "FMT_{0}".format(time_output()))
+
+    log.info("Calculating stage curves above {0}".format(stage))
+    labels, relative = relative_elevations(project, stage, tile_size)
+    curves = StageCurves(labels, relative, len(project.reaches))
+    if offsets is None:
+        offsets = np.linspace(0.0, curves.maximum(), steps + 1)
+    rows = curve_rows(curves, project.reach_ids, project.total_areas, project.dem.cell_size,
+                      offsets)
+    output.write_table("{0}_Curves".format(stage), CURVE_FIELDS, rows)
+    log.info("Script finished")
+    return output
@@ -0,0 +1,577 @@
+# Floodplain Mapper Toolbox 1.3
+# In-memory inundation engine: WSE surface minus DEM, thresholded depth grid
+#
+# Mirrors the arcpy chain in the Analysis tool (CreateTin_3d, TinRaster_3d,
+# Minus_3d, Reclassify_3d, ExtractByAttributes, ExtractByMask) without
+# writing any intermediate raster. With a tile size the DEM is read window by
+# window, so peak memory follows the tile size rather than the DEM size.
+
+from __future__ import division
+
+import datetime
+import logging
+import shutil
+import tempfile
+
+import numpy as np
+
+from .geometry import polygon_area, polygon_window, rasterize_polygons
+from .instrument import step, window_size
+from .journal import RunJournal, stage_fingerprint
+from .polygons import POLYGON_FIELDS, polygon_records
+from .products import INTERMEDIATE_PRODUCTS, plan, requested_products
+from .pyramid import DRY, MIXED, WET, Overview, SurfaceOverview
+from .reach_index import open_reach_index
+from .stage_index import (RELATIVE_ELEVATION_RASTER, STAGE_INDEX_DTYPE, STAGE_INDEX_FIELDS,
+                          STAGE_INDEX_RASTER, STAGE_INDEX_TABLE, StageIndex, stage_index_rows,
+                          stage_offsets)
+from .statistics import STATISTICS_FIELDS, ReachStatistics
+from .surface import CenterlineSurface, TinSurface
+
+log = logging.getLogger(__name__)
+
+# Reclassify_3d remap "-999 0.01 1;0.01 999 0": depths above this are wet
+DEPTH_THRESHOLD = 0.01
+
+# Scratch raster of the wet cells of one stage, kept until its polygons are
+# traced
+WET_CELLS_NAME = "WetCells_{0}"
+
+# Water surface models: the TIN of the Analysis tool, or 1-D interpolation
+# along each reach between its cross sections
+SURFACES = ("tin", "centerline")
+
+# Table in every output workspace recording the surface model of the run.
+# Neither model reproduces CreateTin_3d exactly: the TIN keeps the cross
+# sections as edges, but the Reaches are applied to the cells afterwards
+# rather than inserted into the TIN as its Soft_Clip.
+SURFACE_TABLE = "Surface_Model"
+SURFACE_FIELDS = [("Surface", "TEXT"), ("Description", "TEXT")]
+SURFACE_DESCRIPTIONS = {
+    "tin": "Approximation of the CreateTin_3d surface: a Delaunay TIN conforming to the cross "
+           "sections, clipped to the reaches cell by cell instead of by Soft_Clip",
+    "centerline": "Approximation of the CreateTin_3d surface: stages interpolated along each "
+                  "reach between consecutive cross sections",
+}
+
+
+class Project(object):
+    """Inputs of one Analysis run, loaded once from a workspace adapter."""
+
+    def __init__(self, dem, reaches, cross_sections, stage_data, reach_index=None, surface="tin"):
+        if surface not in SURFACES:
+            raise RuntimeError("Unknown surface {0}, expected one of {1}".format(
+                surface, ", ".join(SURFACES)))
+        self.dem = dem
+        self.reaches = reaches
+        self.cross_sections = cross_sections
+        self.stage_data = stage_data
+        self.reach_index = reach_index
+        self.surface = surface
+        self._labels = None
+        self._surfaces = {}
+
+    @property
+    def reach_ids(self):
+        return [reach_id for reach_id, rings in self.reaches]
+
+    @property
+    def total_areas(self):
+        return [polygon_area(rings) for reach_id, rings in self.reaches]
+
+    def labels(self, window=None):
+        # Soft_Clip: cells outside every reach polygon are never evaluated.
+        # Labels come from the stored reach index when there is one; the
+        # whole-grid label raster is kept in memory once read.
+        window = tuple(window or self.dem.full_window())
+        whole = window == self.dem.full_window()
+        if whole and self._labels is not None:
+            return self._labels
+        if self.reach_index is not None:
+            labels = self.reach_index.labels(window)
+        else:
+            labels = rasterize_polygons([rings for reach_id, rings in self.reaches], self.dem,
+                                        window)
+        if whole:
+            self._labels = labels
+        return labels
+
+    def reach_window(self, reach):
+        # Bounding window of the reach with index reach, None if it misses
+        # the DEM
+        if self.reach_index is not None:
+            return self.reach_index.windows[reach]
+        return polygon_window(self.reaches[reach][1], self.dem)
+
+    def stage_values(self, stage):
+        # Cross sections without a value for this stage (a KEEP_ALL join miss
+        # or a Null cell) are left out of the surface, as CreateTin_3d does
+        values = {}
+        for row in self.stage_data:
+            value = row.get(stage)
+            if value is not None:
+                values[str(row["XS_ID"])] = float(value)
+        return values
+
+    def surface_model(self, xs_ids):
+        # The surface model only depends on which cross sections take part,
+        # so stages sharing the same set reuse one model
+        key = tuple(sorted(xs_ids))
+        if key not in self._surfaces:
+            cross_sections = [(xs_id, parts) for xs_id, parts in self.cross_sections
+                              if str(xs_id) in xs_ids]
+            if self.surface == "centerline":
+                self._surfaces[key] = CenterlineSurface(cross_sections, self.dem, self.reaches,
+                                                        self.labels)
+            else:
+                self._surfaces[key] = TinSurface(cross_sections, self.dem)
+        return self._surfaces[key]
+
+
+def write_surface_model(output, surface):
+    # Record the surface model in the output workspace, once per workspace
+    if not output.exists(SURFACE_TABLE):
+        output.write_table(SURFACE_TABLE, SURFACE_FIELDS,
+                           [(surface, SURFACE_DESCRIPTIONS[surface])])
+
+
+def load_project(adapter, dem, reaches, cross_sections, table, cell_size=None, surface="tin"):
+    with step("read_features") as details:
+        reach_features = adapter.read_features(reaches, "ReachID")
+        xs_features = adapter.read_features(cross_sections, "XS_ID")
+        details.update(reaches=len(reach_features), cross_sections=len(xs_features))
+    for reach_id, rings in reach_features:
+        if reach_id == "" or reach_id is None:
+            raise RuntimeError("Reaches feature class has Null values in the ReachID field")
+    for xs_id, parts in xs_features:
+        if xs_id == "" or xs_id is None:
+            raise RuntimeError("Cross_Sections feature class has Null values in the XS_ID field")
+    # The DEM stays on disk; blocks are read as they are evaluated
+    with step("open_dem") as details:
+        grid = adapter.open_raster(dem)
+        if cell_size and float(cell_size) != grid.cell_size:
+            grid = grid.resample(cell_size)
+        details.update(window_size(grid.full_window()))
+    with step("reach_index"):
+        reach_index = open_reach_index(adapter, reaches, reach_features, grid)
+    with step("read_table"):
+        stage_data = adapter.read_table(table)
+    return Project(grid, reach_features, xs_features, stage_data, reach_index, surface)
+
+
+def depth_grid(surface, dem, threshold=DEPTH_THRESHOLD):
+    # Subtracted raster and the depth grid masked to cells deeper than threshold
+    subtracted = surface - dem
+    with np.errstate(invalid="ignore"):
+        wet = subtracted > threshold
+    return subtracted, np.where(wet, subtracted, np.nan)
+
+
+def evaluate_window(project, stages, window, depth=True, pyramid=None):
+    # Yields (stage, labels, surface, subtracted, depth) blocks for one window.
+    # The DEM block, reach labels and each surface's cell locations are
+    # computed once and shared by every stage. Without depth the threshold
+    # is not applied and None is yielded for the depth block. With pyramid,
+    # a block size, only the depth is evaluated, coarse to fine over a
+    # min/max overview of the DEM, and None is yielded for the surface and
+    # the subtracted raster.
+    size = window_size(window)
+    with step("read_dem", **size):
+        dem = project.dem.read(window)
+    with step("labels", **size):
+        labels = project.labels(window)
+    if pyramid:
+        for block in _pyramid_window(project, stages, window, dem, labels, pyramid):
+            yield block
+        return
+    outside = labels == 0
+    locations = {}
+    for stage in stages:
+        values = project.stage_values(stage)
+        if not values:
+            raise RuntimeError("No cross sections have values for {0}".format(stage))
+        with step("surface_model"):
+            model = project.surface_model(set(values))
+        if id(model) not in locations:
+            with step("locate", **size):
+                locations[id(model)] = model.locate(window)
+        with step("surface", **size):
+            surface = model.evaluate(values, locations[id(model)])
+            surface[outside] = np.nan
+        if depth:
+            with step("depth", **size):
+                subtracted, depth_block = depth_grid(surface, dem)
+        else:
+            subtracted = surface - dem
+            depth_block = None
+        yield stage, labels, surface, subtracted, depth_block
+
+
+def _pyramid_window(project, stages, window, dem, labels, block_size):
+    # Pyramid blocks of evaluate_window. The overview is built once for the
+    # window, and each surface model only locates the cells of blocks that
+    # its cross sections leave wet or mixed at one of the stages at least.
+    size = window_size(window)
+    with step("overview", **size):
+        overview = Overview(dem, labels, block_size)
+    evaluated = []
+    models = {}
+    for stage in stages:
+        values = project.stage_values(stage)
+        if not values:
+            raise RuntimeError("No cross sections have values for {0}".format(stage))
+        with step("surface_model"):
+            model = project.surface_model(set(values))
+        z = np.array([values[xs_id] for xs_id in model.xs_ids], dtype=float)
+        evaluated.append((stage, model, z))
+        models.setdefault(id(model), (model, []))[1].append(z)
+    surfaces = {}
+    for key, (model, zs) in models.items():
+        with step("locate", **size) as details:
+            bounds = overview.sections(*model.block_sections(window, block_size),
+                                       xs_count=len(model.xs_ids))
+            needed = overview.needed(bounds, zs, DEPTH_THRESHOLD)
+            details.update(located=int(np.count_nonzero(needed)))
+            surfaces[key] = SurfaceOverview(overview, model.locate(window, needed),
+                                            len(model.xs_ids))
+    for stage, model, z in evaluated:
+        with step("pyramid_depth", **size) as details:
+            depth_block, classes = surfaces[id(model)].depth(z, DEPTH_THRESHOLD)
+            details.update(dry=int(np.count_nonzero(classes == DRY)),
+                           mixed=int(np.count_nonzero(classes == MIXED)),
+                           wet=int(np.count_nonzero(classes == WET)))
+        yield stage, labels, None, None, depth_block
+
+
+def run_stage(project, stage):
+    # Whole-grid results for one stage
+    dem = project.dem
+    for stage, labels, surface, subtracted, depth in evaluate_window(project, [stage],
+                                                                     dem.full_window()):
+        return {"RasterFromTIN": dem.like(surface),
+                "Subtracted": dem.like(subtracted),
+                "DepthGrid": dem.like(depth)}
+
+
+def time_output(now=None):
+    # Same month-day-year_hour-minute-AM/PM stamp the toolbox scripts use
+    time = now or datetime.datetime.now()
+    hour = time.hour
+    minute = time.minute
+    if hour > 12:
+        hour = hour - 12
+        am_pm = "PM"
+    else:
+        am_pm = "AM"
+    if hour < 10:
+        hour = "0{0}".format(hour)
+    if minute < 10:
+        minute = "0{0}".format(minute)
+    return "{0}{1}{2}_{3}{4}{5}".format(time.month, time.day, time.year, hour, minute, am_pm)
+
+
+# Output name pattern of each raster product
+RASTER_NAMES = {
+    "DepthGrid": "{0}_DepthGrid",
+    "RasterFromTIN": "RasterFromTIN_{0}",
+    "Subtracted": "Subtracted_{0}",
+}
+
+
+# Output name pattern and fields of each feature class product
+FEATURE_NAMES = {
+    "Polygon": "{0}_Polygon",
+}
+FEATURE_FIELDS = {
+    "Polygon": POLYGON_FIELDS,
+}
+
+
+def feature_names(products=None):
+    # (product, output name pattern) pairs of the feature classes written
+    # for each stage
+    return [(product, FEATURE_NAMES[product]) for product in requested_products(products)
+            if product in FEATURE_NAMES]
+
+
+def raster_names(delete_intermediate_data=True, stage_index=False, products=None):
+    # (product, output name pattern) pairs written for each stage; the
+    # stage index replaces the depth grids
+    return [(product, RASTER_NAMES[product])
+            for product in requested_products(products, delete_intermediate_data)
+            if product in RASTER_NAMES and not (stage_index and product == "DepthGrid")]
+
+
+def analyze(project, stages, output, delete_intermediate_data=True, tile_size=None,
+            stage_index=False, products=None, simplify=None, pyramid=None, on_stage=None):
+    # Evaluate stages into the rasters of output; returns the statistics
+    # table rows of each stage, None when Statistics is not among products.
+    # With stage_index the First_Stage and Base_Relative_Elevation rasters
+    # are written instead of depth grids. Polygons are traced once every
+    # window is evaluated from a mask of wet cells, one byte per cell per
+    # stage. A single window keeps the masks in memory; tiled runs write them
+    # to scratch rasters in output, so memory still follows the tile size.
+    # With pyramid, a block size, depths are evaluated coarse
+    # to fine; the intermediate rasters and the stage index need every cell
+    # and turn it off. on_stage(stage, rows) is called as soon as each
+    # stage's outputs are complete, so they can be committed one by one.
+    grid = project.dem
+    products = requested_products(products, delete_intermediate_data)
+    names = raster_names(delete_intermediate_data, stage_index, products)
+    depth = stage_index or "depth" in plan(products)
+    if pyramid and (stage_index or not depth or
+                    any(product in INTERMEDIATE_PRODUCTS for product, name in names)):
+        log.info("The stage index and intermediate rasters need every cell; evaluating at "
+                 "full resolution")
+        pyramid = None
+    windows = list(grid.windows(tile_size))
+    spill = len(windows) > 1
+    writers = {}
+    statistics = {}
+    wet = {}
+    for stage in stages:
+        for product, name in names:
+            writers[(stage, product)] = output.create_raster(name.format(stage), grid)
+        if "Statistics" in products:
+            statistics[stage] = ReachStatistics(len(project.reaches))
+        if "Polygon" in products and spill:
+            wet[stage] = output.create_raster(WET_CELLS_NAME.format(stage), grid, np.uint8)
+            writers[(stage, "WetCells")] = wet[stage]
+        elif "Polygon" in products:
+            wet[stage] = np.zeros((grid.rows, grid.cols), dtype=bool)
+    if stage_index:
+        index = StageIndex()
+        writers[STAGE_INDEX_RASTER] = output.create_raster(STAGE_INDEX_RASTER, grid,
+                                                           STAGE_INDEX_DTYPE)
+        writers[RELATIVE_ELEVATION_RASTER] = output.create_raster(RELATIVE_ELEVATION_RASTER, grid)
+
+    # Rasters are written block by block as each window is evaluated
+    log.info("Evaluating {0} stages over {1} window(s) of the DEM".format(len(stages),
+                                                                        len(windows)))
+    for window in windows:
+        size = window_size(window)
+        with step("window", **size):
+            depths = []
+            for stage, labels, surface, subtracted, depth_block in \
+                    evaluate_window(project, stages, window, depth, pyramid):
+                blocks = {"DepthGrid": depth_block, "RasterFromTIN": surface,
+                          "Subtracted": subtracted}
+                with step("write_rasters", **size):
+                    for product, name in names:
+                        writers[(stage, product)].write(window, blocks[product])
+                if stage in statistics:
+                    with step("statistics", **size):
+                        statistics[stage].add(labels, depth_block)
+                if stage in wet and spill:
+                    wet[stage].write(window, (~np.isnan(depth_block)).astype(np.uint8))
+                elif stage in wet:
+                    row_start, row_stop, col_start, col_stop = window
+                    wet[stage][row_start:row_stop, col_start:col_stop] = ~np.isnan(depth_block)
+                if stage_index:
+                    if not depths:
+                        writers[RELATIVE_ELEVATION_RASTER].write(window, -subtracted)
+                    depths.append(depth_block)
+            if stage_index:
+                with step("stage_index", **size):
+                    writers[STAGE_INDEX_RASTER].write(window, index.block(depths))
+    with step("close_rasters", rasters=len(writers)):
+        for writer in writers.values():
+            writer.close()
+    total_areas = project.total_areas
+    rows = {}
+    for stage in stages:
+        if stage in wet:
+            log.info("Tracing inundation polygons for {0}".format(stage))
+            with step("polygons", stage=stage, **window_size(grid.full_window())) as details:
+                if spill:
+                    cells = output.open_raster(WET_CELLS_NAME.format(stage))
+                else:
+                    cells = grid.like(wet.pop(stage))
+                records = polygon_records(project, cells, simplify)
+                details["features"] = len(records)
+                output.write_features(FEATURE_NAMES["Polygon"].format(stage), POLYGON_FIELDS,
+                                      records, grid.spatial_reference)
+            del cells
+            if spill:
+                output.delete(WET_CELLS_NAME.format(stage))
+        rows[stage] = None
+        if stage in statistics:
+            rows[stage] = statistics[stage].rows(project.reach_ids, total_areas, grid.cell_size)
+        if on_stage is not None:
+            on_stage(stage, rows[stage])
+    if stage_index:
+        if index.unnested:
+            log.warning("{0} cells are dry at a higher stage than the first stage inundating "
+                        "them; list stages from lowest to highest".format(index.unnested))
+        output.write_table(STAGE_INDEX_TABLE, STAGE_INDEX_FIELDS,
+                           stage_index_rows(stages, stage_offsets(project, stages)))
+    return rows
+
+
+# Project loaded once per pool worker by _start_worker
+_worker_project = None
+
+
+def _start_worker(adapter, workspace, dem, cell_size, reaches, cross_sections, table, surface):
+    global _worker_project
+    _worker_project = load_project(adapter(workspace), dem, reaches, cross_sections, table,
+                                   cell_size, surface)
+
+
+def _analyze_stage(job):
+    # Each stage is written to its own scratch workspace so workers never
+    # share intermediate names
+    output_adapter, scratch_path, index, stage, products, tile_size, simplify, pyramid = job
+    scratch = output_adapter.create(scratch_path, "Stage{0}".format(index))
+    rows = analyze(_worker_project, [stage], scratch, tile_size=tile_size, products=products,
+                   simplify=simplify, pyramid=pyramid)
+    return stage, scratch.workspace, rows[stage]
+
+
+def run_analysis(source, output_path, dem, cell_size, reaches, cross_sections, table, stages,
+                 delete_intermediate_data=True, output_adapter=None, tile_size=None, workers=None,
+                 cache=None, stage_index=False, surface="tin", products=None, simplify=None,
+                 output_name=None, resume=False, pyramid=None):
+    # source is an adapter on the input workspace; the output workspace is
+    # created next to output_path as FMT_<timestamp> with the same adapter type.
+    # products selects what is written (DepthGrid and Statistics by default);
+    # steps only needed for other products are skipped. Polygon outlines are
+    # simplified to the simplify tolerance in map units when given.
+    # With workers > 1 stages are fanned out over a process pool and their
+    # outputs merged into the output workspace as they finish. With a
+    # ResultCache, stages whose inputs are unchanged are copied from the cache
+    # and only the others are evaluated. The stage index needs every stage's
+    # depth in each window, so it is built in one process without the cache.
+    # With output_name the output workspace has that fixed name and a run
+    # journal: stages are evaluated together into a staging workspace, each
+    # moved into the output and recorded as soon as it is complete, and with
+    # resume the stages recorded by an earlier run are skipped. pyramid, a block size,
+    # evaluates the depth grids coarse to fine with identical results.
+    if stage_index and resume:
+        raise RuntimeError("A stage index is built from every stage at once and cannot be resumed")
+    # Loading validates the inputs and builds the reach index before any
+    # worker starts
+    with step("load_project"):
+        project = load_project(source, dem, reaches, cross_sections, table, cell_size, surface)
+    output_adapter = output_adapter or type(source)
+    products = requested_products(products, delete_intermediate_data)
+    journal = None
+    if output_name and not stage_index:
+        settings = {"dem": dem, "cell_size": cell_size, "reaches": reaches,
+                    "cross_sections": cross_sections, "table": table,
+                    "products": list(products), "surface": surface, "simplify": simplify}
+        journal = RunJournal.open(output_path, output_name, settings, resume)
+        fingerprints = dict((stage, stage_fingerprint(project.stage_values(stage)))
+                            for stage in stages)
+        done = [stage for stage in stages if journal.completed(stage, fingerprints[stage])]
+        if done:
+            log.info("Skipping completed stages {0}".format(", ".join(done)))
+        stale = [stage for stage in stages if journal.stale(stage, fingerprints[stage])]
+        if stale:
+            log.warning("Stage_Data values of {0} changed since they were completed; running "
+                        "them again".format(", ".join(stale)))
+        stages = [stage for stage in stages if stage not in done]
+    output = output_adapter.create(output_path, output_name or "FMT_{0}".format(time_output()))
+    write_surface_model(output, surface)
+    names = raster_names(stage_index=stage_index, products=products) + feature_names(products)
+    if stage_index:
+        cache = None
+        workers = None
+    # Cache entries always hold the statistics, so they can serve any later run
+    computed_products = products
+    if cache is not None and "Statistics" not in products:
+        computed_products = products + ("Statistics",)
+    scratch_path = None
+    if journal is not None or (workers and workers > 1):
+        scratch_path = tempfile.mkdtemp(prefix="FMT_Scratch_", dir=output_path)
+
+    def staging(name):
+        # Workspace a stage is written to before it is moved into the output
+        if journal is None:
+            return output
+        return output_adapter.create(scratch_path, name)
+
+    def finish(stage, rows, workspace=output, key=None):
+        # Write the stage's table, move its products from workspace into the
+        # output, store them in the cache under key and record the stage
+        outputs = [name.format(stage) for product, name in names]
+        if "Statistics" in products:
+            log.info("Creating output table for {0}".format(stage))
+            with step("write_table", stage=stage):
+                workspace.write_table("{0}_Statistics".format(stage), STATISTICS_FIELDS, rows)
+            outputs.append("{0}_Statistics".format(stage))
+        if workspace is not output:
+            log.info("Merging outputs for {0}".format(stage))
+            with step("merge", stage=stage):
+                for name in outputs:
+                    output.move(workspace, name)
+        if key is not None:
+            stage_names = dict((product, name.format(stage)) for product, name in names)
+            with step("cache_store", stage=stage):
+                cache.store(key, output, stage_names, {"Statistics": rows}, tile_size)
+        if journal is not None:
+            journal.record(stage, outputs, fingerprints[stage])
+
+    try:
+        computed = list(stages)
+        if cache is not None:
+            keys = cache.stage_keys(source, dem, project, stages, simplify)
+            for index, stage in enumerate(stages):
+                entry = cache.lookup(keys[stage], [product for product, name in names])
+                if entry is not None:
+                    log.info("Using cached results for {0}".format(stage))
+                    stage_names = dict((product, name.format(stage)) for product, name in names)
+                    workspace = staging("Cached{0}".format(index))
+                    with step("cache_restore", stage=stage):
+                        tables = cache.restore(keys[stage], entry, project.dem, workspace,
+                                               stage_names, tile_size)
+                    finish(stage, tables["Statistics"], workspace)
+                    computed.remove(stage)
+
+        def key(stage):
+            return keys[stage] if cache is not None else None
+
+        if workers and workers > 1 and len(computed) > 1:
+            initargs = (type(source), source.workspace, dem, cell_size, reaches, cross_sections,
+                        table, surface)
+            jobs = [(output_adapter, scratch_path, index, stage, computed_products, tile_size,
+                     simplify, pyramid) for index, stage in enumerate(computed)]
+            # Steps run inside the workers are not traced; the pool is one step.
+            # multiprocessing is only imported by runs that use it.
+            import multiprocessing
+            pool = multiprocessing.Pool(min(workers, len(computed)), _start_worker, initargs)
+            try:
+                with step("worker_pool", stages=len(computed), workers=workers):
+                    for stage, workspace, rows in pool.imap_unordered(_analyze_stage, jobs):
+                        finish(stage, rows, output_adapter(workspace), key(stage))
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        elif computed and journal is not None:
+            # Every stage in one pass over the DEM, staged out of sight; each
+            # stage is moved into the output and recorded as soon as its
+            # outputs are complete
+            workspace = staging("Stages")
+
+            def commit(stage, rows):
+                finish(stage, rows, workspace, key(stage))
+
+            with step("analyze", stages=len(computed), **window_size(project.dem.full_window())):
+                analyze(project, computed, workspace, tile_size=tile_size,
+                        products=computed_products, simplify=simplify, pyramid=pyramid,
+                        on_stage=commit)
+        elif computed:
+            with step("analyze", stages=len(computed), **window_size(project.dem.full_window())):
+                statistics = analyze(project, computed, output, tile_size=tile_size,
+                                     stage_index=stage_index, products=computed_products,
+                                     simplify=simplify, pyramid=pyramid)
+            for stage in computed:
+                finish(stage, statistics[stage], key=key(stage))
+    finally:
+        if scratch_path is not None:
+            shutil.rmtree(scratch_path, ignore_errors=True)
+    log.info("Script finished")
+    return output
@@ -0,0 +1,158 @@
+# Floodplain Mapper Toolbox 1.3
+# Vector helpers: polyline densification and polygon rasterization onto a Grid
+
+from __future__ import division
+
+import math
+
+import numpy as np
+
+
+def densify(vertices, spacing):
+    # Insert vertices so no segment of the polyline is longer than spacing
+    points = np.asarray(vertices, dtype=float)
+    if len(points) < 2 or spacing <= 0:
+        return points
+    output = [points[:1]]
+    for start, end in zip(points[:-1], points[1:]):
+        length = math.hypot(end[0] - start[0], end[1] - start[1])
+        steps = max(int(math.ceil(length / spacing)), 1)
+        t = (np.arange(1, steps + 1) / steps)[:, None]
+        output.append(start + (end - start) * t)
+    return np.vstack(output)
+
+
+def _ring_edges(rings):
+    x0 = []
+    y0 = []
+    x1 = []
+    y1 = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=float)
+        if len(ring) < 3:
+            continue
+        closed = np.vstack([ring, ring[:1]])
+        x0.append(closed[:-1, 0])
+        y0.append(closed[:-1, 1])
+        x1.append(closed[1:, 0])
+        y1.append(closed[1:, 1])
+    if not x0:
+        empty = np.zeros(0)
+        return empty, empty, empty, empty
+    return np.concatenate(x0), np.concatenate(y0), np.concatenate(x1), np.concatenate(y1)
+
+
+def points_in_polygon(points, rings):
+    # Even-odd test of (n, 2) points against all rings of a polygon
+    points = np.asarray(points, dtype=float)
+    x0, y0, x1, y1 = _ring_edges(rings)
+    inside = np.zeros(len(points), dtype=bool)
+    x = points[:, 0]
+    y = points[:, 1]
+    for index in range(len(x0)):
+        if y0[index] == y1[index]:
+            continue
+        crosses = (y0[index] <= y) != (y1[index] <= y)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x_cross = x0[index] + (y - y0[index]) * (x1[index] - x0[index]) / \
+                (y1[index] - y0[index])
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def polygon_window(rings, grid):
+    # Row/column bounds (start inclusive, stop exclusive) of the cells whose
+    # centers can fall inside the polygon, or None if it misses the grid
+    points = np.vstack([np.asarray(ring, dtype=float) for ring in rings if len(ring)])
+    cs = grid.cell_size
+    row_start = max(int(math.floor((grid.y_max - points[:, 1].max()) / cs)), 0)
+    row_stop = min(int(math.ceil((grid.y_max - points[:, 1].min()) / cs)), grid.rows)
+    col_start = max(int(math.floor((points[:, 0].min() - grid.x_min) / cs)), 0)
+    col_stop = min(int(math.ceil((points[:, 0].max() - grid.x_min) / cs)), grid.cols)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return row_start, row_stop, col_start, col_stop
+
+
+def polygon_mask(rings, grid, window=None):
+    # Even-odd scanline fill of cell centers; holes and multipart reaches are
+    # handled by treating all rings as one edge set
+    if window is None:
+        window = polygon_window(rings, grid)
+    if window is None:
+        return None, np.zeros((0, 0), dtype=bool)
+    row_start, row_stop, col_start, col_stop = window
+    rows = row_stop - row_start
+    cols = col_stop - col_start
+    cs = grid.cell_size
+
+    x0, y0, x1, y1 = _ring_edges(rings)
+    keep = y0 != y1
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+    y_low = np.minimum(y0, y1)
+    y_high = np.maximum(y0, y1)
+
+    # Rows whose center satisfies y_low <= y < y_high, so shared vertices
+    # are only counted once
+    first = np.floor((grid.y_max - y_high) / cs - 0.5).astype(np.intp) + 1
+    last = np.floor((grid.y_max - y_low) / cs - 0.5).astype(np.intp)
+    first = np.maximum(first, row_start)
+    last = np.minimum(last, row_stop - 1)
+    counts = np.maximum(last - first + 1, 0)
+
+    diff = np.zeros((rows, cols + 1), dtype=np.int32)
+    total = int(counts.sum())
+    if total:
+        edge = np.repeat(np.arange(len(counts)), counts)
+        offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        row = first[edge] + offset
+        y = grid.y_max - (row + 0.5) * cs
+        x = x0[edge] + (y - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+        order = np.lexsort((x, row))
+        row = row[order]
+        x = x[order]
+
+        # Crossings pair up left to right within each row
+        span_row = row[0::2] - row_start
+        span_start = np.ceil((x[0::2] - grid.x_min) / cs - 0.5).astype(np.intp) - col_start
+        span_stop = np.ceil((x[1::2] - grid.x_min) / cs - 0.5).astype(np.intp) - col_start
+        span_start = np.clip(span_start, 0, cols)
+        span_stop = np.clip(span_stop, 0, cols)
+        filled = span_stop > span_start
+        np.add.at(diff, (span_row[filled], span_start[filled]), 1)
+        np.add.at(diff, (span_row[filled], span_stop[filled]), -1)
+    mask = np.cumsum(diff[:, :-1], axis=1) > 0
+    return window, mask
+
+
+def rasterize_polygons(polygons, grid, window=None):
+    # Label grid where cell value i + 1 marks the i-th polygon and 0 is outside,
+    # for the whole grid or only the cells of window
+    row_start, row_stop, col_start, col_stop = window or grid.full_window()
+    labels = np.zeros((row_stop - row_start, col_stop - col_start), dtype=np.int32)
+    for index, rings in enumerate(polygons):
+        bounds = polygon_window(rings, grid)
+        if bounds is None:
+            continue
+        bounds = (max(bounds[0], row_start), min(bounds[1], row_stop),
+                  max(bounds[2], col_start), min(bounds[3], col_stop))
+        if bounds[0] >= bounds[1] or bounds[2] >= bounds[3]:
+            continue
+        bounds, mask = polygon_mask(rings, grid, bounds)
+        labels[bounds[0] - row_start:bounds[1] - row_start,
+               bounds[2] - col_start:bounds[3] - col_start][mask] = index + 1
+    return labels
+
+
+def polygon_area(rings):
+    # Shape_Area of a polygon; outer rings and holes wind in opposite
+    # directions in both geodatabase and GeoJSON geometry
+    total = 0.0
+    for ring in rings:
+        ring = np.asarray(ring, dtype=float)
+        if len(ring) < 3:
+            continue
+        x = ring[:, 0] - ring[0, 0]
+        y = ring[:, 1] - ring[0, 1]
+        total += (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2.0
+    return abs(total)
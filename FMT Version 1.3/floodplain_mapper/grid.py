@@ -0,0 +1,121 @@
+# Floodplain Mapper Toolbox 1.3
+# Raster grid shared by the NumPy engine and the I/O adapters
+
+from __future__ import division
+
+import numpy as np
+
+
+class Grid(object):
+    """Raster values plus the georeferencing needed to line them up with the DEM.
+
+    Cells are stored row-major from the top (north) edge. array is either an
+    in-memory NumPy array with NaN for NoData, or any object that can be
+    sliced into 2-D blocks (a memory-mapped .npy, a GDAL band) in which case
+    nodata gives the value to mask while reading.
+    """
+
+    def __init__(self, array, x_min, y_max, cell_size, spatial_reference=None, nodata=None):
+        self.array = array
+        self.x_min = float(x_min)
+        self.y_max = float(y_max)
+        self.cell_size = float(cell_size)
+        self.spatial_reference = spatial_reference
+        self.nodata = nodata
+
+    @property
+    def shape(self):
+        return tuple(self.array.shape)
+
+    @property
+    def rows(self):
+        return self.array.shape[0]
+
+    @property
+    def cols(self):
+        return self.array.shape[1]
+
+    @property
+    def x_max(self):
+        return self.x_min + self.cols * self.cell_size
+
+    @property
+    def y_min(self):
+        return self.y_max - self.rows * self.cell_size
+
+    @property
+    def cell_area(self):
+        return self.cell_size * self.cell_size
+
+    def like(self, array):
+        # New grid on the same cells, e.g. a depth grid for this DEM
+        return Grid(array, self.x_min, self.y_max, self.cell_size, self.spatial_reference)
+
+    def full_window(self):
+        return 0, self.rows, 0, self.cols
+
+    def windows(self, tile_size=None):
+        # (row_start, row_stop, col_start, col_stop) tiles covering the grid;
+        # without a tile size the whole grid is one window
+        if not tile_size:
+            yield self.full_window()
+            return
+        for row_start in range(0, self.rows, tile_size):
+            for col_start in range(0, self.cols, tile_size):
+                yield (row_start, min(row_start + tile_size, self.rows),
+                       col_start, min(col_start + tile_size, self.cols))
+
+    def read(self, window=None):
+        # Float copy of one block with NoData as NaN; only this block is
+        # pulled from a memory-mapped or on-disk array
+        row_start, row_stop, col_start, col_stop = window or self.full_window()
+        block = np.array(self.array[row_start:row_stop, col_start:col_stop], dtype=float)
+        if self.nodata is not None:
+            block[block == self.nodata] = np.nan
+        return block
+
+    def load(self):
+        # Fully in-memory copy of this grid
+        if isinstance(self.array, np.ndarray) and self.nodata is None:
+            return self
+        return self.like(self.read())
+
+    def cell_centers(self, window=None):
+        row_start, row_stop, col_start, col_stop = window or self.full_window()
+        xs = self.x_min + (np.arange(col_start, col_stop) + 0.5) * self.cell_size
+        ys = self.y_max - (np.arange(row_start, row_stop) + 0.5) * self.cell_size
+        return xs, ys
+
+    def resample(self, cell_size):
+        # Nearest-neighbour resample, matching the default used by Minus_3d
+        # when the TIN raster and the DEM have different cell sizes. The
+        # result reads from this grid block by block.
+        cell_size = float(cell_size)
+        if cell_size == self.cell_size:
+            return self
+        rows = int(round(self.rows * self.cell_size / cell_size))
+        cols = int(round(self.cols * self.cell_size / cell_size))
+        row_index = ((np.arange(rows) + 0.5) * cell_size / self.cell_size).astype(np.intp)
+        col_index = ((np.arange(cols) + 0.5) * cell_size / self.cell_size).astype(np.intp)
+        row_index = np.clip(row_index, 0, self.rows - 1)
+        col_index = np.clip(col_index, 0, self.cols - 1)
+        array = _Resampled(self.array, row_index, col_index)
+        return Grid(array, self.x_min, self.y_max, cell_size, self.spatial_reference, self.nodata)
+
+
+class _Resampled(object):
+    # Lazily gathers nearest cells from a source array when sliced
+
+    def __init__(self, source, row_index, col_index):
+        self.source = source
+        self.row_index = row_index
+        self.col_index = col_index
+        self.shape = (len(row_index), len(col_index))
+
+    def __getitem__(self, key):
+        rows = self.row_index[key[0]]
+        cols = self.col_index[key[1]]
+        if not len(rows) or not len(cols):
+            return np.zeros((len(rows), len(cols)))
+        block = np.asarray(self.source[rows.min():rows.max() + 1, cols.min():cols.max() + 1])
+        return block[(rows - rows.min())[:, None], (cols - cols.min())[None, :]]
@@ -0,0 +1,152 @@
+# Floodplain Mapper Toolbox 1.3
+# Hypsometry of the DEM relative to a stage's water surface
+#
+# Follows the Hypsometry tool: the normalized grid is DEM minus the water
+# surface, sliced into equal intervals (Slice_3d), with cumulative counts and
+# percent of area per slice, for all reaches together and for every reach on
+# its own. Instead of extracting and slicing one raster per reach, each cell
+# is binned once into a (reach x slice) histogram. One pass over the grid
+# finds every reach's value range, a second fills the histogram; both read
+# the DEM window by window.
+
+from __future__ import division
+
+import logging
+
+import numpy as np
+
+from .engine import evaluate_window, load_project, time_output
+from .instrument import step, window_size
+
+log = logging.getLogger(__name__)
+
+# Slice_3d zone count used by the Hypsometry tool
+SLICES = 100
+
+HYPSOMETRY_FIELDS = [
+    ("Value", "LONG"),
+    ("Count", "LONG"),
+    ("Percent_Elevation", "FLOAT"),
+    ("Cumulative", "LONG"),
+    ("Percent_Area", "FLOAT"),
+]
+
+
+def normalized_blocks(project, stage, tile_size=None):
+    # (window, labels, normalized) blocks, NaN outside the soft-clipped surface
+    for window in project.dem.windows(tile_size):
+        for stage, labels, surface, subtracted, depth in evaluate_window(project, [stage], window):
+            yield window, labels, -subtracted
+
+
+def value_ranges(blocks, reach_count):
+    # Minimum and maximum normalized value per reach; index 0 holds the range
+    # over all reaches together
+    low = np.full(reach_count + 1, np.inf)
+    high = np.full(reach_count + 1, -np.inf)
+    for labels, normalized in blocks:
+        valid = (labels > 0) & ~np.isnan(normalized)
+        labels = labels[valid]
+        values = normalized[valid]
+        if not len(values):
+            continue
+        np.minimum.at(low, labels, values)
+        np.maximum.at(high, labels, values)
+        low[0] = min(low[0], values.min())
+        high[0] = max(high[0], values.max())
+    return low, high
+
+
+def slice_values(normalized, low, high, slices=SLICES):
+    # EQUAL_INTERVAL zones numbered from 1, the maximum falling in the top
+    # zone; low and high may be arrays giving each cell its own range
+    span = high - low
+    span = np.where(span > 0, span, 1.0)
+    zones = np.floor((normalized - low) / span * slices).astype(np.intp)
+    return np.clip(zones, 0, slices - 1) + 1
+
+
+def joint_histogram(blocks, low, high, slices=SLICES):
+    # Cell counts per (reach, slice); row 0 is all reaches together, sliced
+    # over the overall range, and row i over reach i's own range
+    reach_count = len(low) - 1
+    counts = np.zeros((reach_count + 1) * slices, dtype=np.int64)
+    for labels, normalized in blocks:
+        valid = (labels > 0) & ~np.isnan(normalized)
+        labels = labels[valid]
+        values = normalized[valid]
+        total = slice_values(values, low[0], high[0], slices) - 1
+        own = slice_values(values, low[labels], high[labels], slices) - 1
+        counts += np.bincount(total, minlength=len(counts))
+        counts += np.bincount(labels * slices + own, minlength=len(counts))
+    return counts.reshape(reach_count + 1, slices)
+
+
+def hypsometry(project, stage, tile_size=None, writer=None, slices=SLICES):
+    # Histogram of the normalized grid for the whole reach set and each reach;
+    # the normalized grid is written to writer during the first pass
+    def blocks(write):
+        for window, labels, normalized in normalized_blocks(project, stage, tile_size):
+            if write:
+                with step("write_raster", **window_size(window)):
+                    writer.write(window, normalized)
+            yield labels, normalized
+
+    size = window_size(project.dem.full_window())
+    with step("value_ranges", **size):
+        low, high = value_ranges(blocks(writer is not None), len(project.reaches))
+        if writer is not None:
+            writer.close()
+    if low[0] > high[0]:
+        raise RuntimeError("Water surface for {0} does not overlap the DEM".format(stage))
+    with step("histogram", slices=slices, **size):
+        return joint_histogram(blocks(False), low, high, slices)
+
+
+def hypsometry_tables(reach_ids, counts):
+    # Hypsometry rows for all reaches and the Hypsometry_all fields and rows,
+    # with a percent-area column per reach when there is more than one
+    slices = counts.shape[1]
+    cumulative = np.cumsum(counts, axis=1)
+    totals = cumulative[:, -1:].astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        percent_area = np.where(totals > 0, cumulative / totals, np.nan)
+    values = np.arange(1, slices + 1)
+    percent_elevation = values / slices
+
+    rows = []
+    for index in range(slices):
+        rows.append((int(values[index]), int(counts[0, index]), float(percent_elevation[index]),
+                     int(cumulative[0, index]), float(percent_area[0, index])))
+
+    fields = [("Percent_Elevation", "FLOAT"), ("Total_Percent_Area", "FLOAT")]
+    columns = [percent_elevation, percent_area[0]]
+    if len(reach_ids) > 1:
+        for index, reach_id in enumerate(reach_ids):
+            fields.append(("{0}_Percent_Area".format(reach_id), "FLOAT"))
+            columns.append(percent_area[index + 1])
+    all_rows = []
+    for index in range(slices):
+        all_rows.append(tuple(None if np.isnan(column[index]) else float(column[index])
+                              for column in columns))
+    return rows, fields, all_rows
+
+
+def run_hypsometry(source, output_path, dem, cell_size, reaches, cross_sections, table, stage,
+                   output_adapter=None, tile_size=None, slices=SLICES, surface="tin",
+                   output_name=None):
+    # The output workspace is FMT_<timestamp> unless output_name is given
+    with step("load_project"):
+        project = load_project(source, dem, reaches, cross_sections, table, cell_size, surface)
+    output_adapter = output_adapter or type(source)
+    output = output_adapter.create(output_path, output_name or "FMT_{0}".format(time_output()))
+
+    log.info("Calculating hypsometry for {0}".format(stage))
+    writer = output.create_raster("{0}_Normalized".format(stage), project.dem)
+    counts = hypsometry(project, stage, tile_size, writer, slices)
+    rows, all_fields, all_rows = hypsometry_tables(project.reach_ids, counts)
+    with step("write_tables"):
+        output.write_table("Hypsometry", HYPSOMETRY_FIELDS, rows)
+        output.write_table("Hypsometry_all", all_fields, all_rows)
+    log.info("Script finished")
+    return output
@@ -0,0 +1,225 @@
+# Floodplain Mapper Toolbox 1.3
+# Per-step timing and memory instrumentation with a JSON trace per run
+#
+# Pipeline steps are wrapped in "with step(name, **details):". While a run
+# is being traced (inside "with tracing(path):") every step records its wall
+# and CPU time, the peak memory and any details given, such as raster
+# dimensions and cell counts; otherwise step() does nothing. At the end of
+# the run the trace is written as JSON and the steps taking the most time
+# are logged. cProfile and tracemalloc capture can be switched on per run.
+
+from __future__ import division
+
+import contextlib
+import json
+import logging
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+log = logging.getLogger(__name__)
+
+# Hot steps listed in the summary at the end of a run
+SUMMARY_STEPS = 10
+
+# Calls of each step kept one by one in the trace; further calls, such as
+# the per-window steps of a large DEM, only add to the step's totals
+DETAIL_CALLS = 100
+
+_cpu_time = getattr(time, "process_time", None) or time.clock
+
+
+def _peak_memory():
+    # Peak resident memory of the process in bytes, where the platform
+    # reports it. ru_maxrss is in kilobytes on Linux and in bytes on macOS;
+    # Windows has no resource module and reports the peak working set.
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    if sys.platform == "win32":
+        return _peak_working_set()
+    return None
+
+
+def _peak_working_set():
+    # PeakWorkingSetSize from GetProcessMemoryInfo, None if it fails
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD),
+                    ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t),
+                    ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t),
+                    ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    kernel32 = ctypes.windll.kernel32
+    try:
+        # Exported by kernel32 since Windows 7, otherwise only by psapi
+        get_info = kernel32.K32GetProcessMemoryInfo
+    except AttributeError:
+        get_info = ctypes.windll.psapi.GetProcessMemoryInfo
+    # Handles are pointer sized, so the types are declared for 64-bit Python
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    get_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    get_info.restype = wintypes.BOOL
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if not get_info(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+class Trace(object):
+    """Steps recorded during one run, in the order they finished.
+
+    Steps are named by their path below the enclosing steps, e.g.
+    "analyze/window/surface", and totalled per path. With memory, tracemalloc
+    is running and each step records the peak of memory allocated while it
+    ran; otherwise the process's peak resident memory at the end of the step
+    is recorded.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory and tracemalloc is not None
+        self.steps = []
+        self._totals = {}
+        self._stack = []
+        self._peaks = []
+        self.started = time.time()
+
+    # tracemalloc keeps a single peak, so each step resets it on entry and
+    # the enclosing steps keep the highest peak seen before the reset. Before
+    # Python 3.9 the peak cannot be reset and every step records the peak of
+    # the run so far.
+    def _start_peak(self):
+        if not hasattr(tracemalloc, "reset_peak"):
+            return
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self._peaks.append(0)
+
+    def _stop_peak(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        if not hasattr(tracemalloc, "reset_peak"):
+            return peak
+        peak = max(self._peaks.pop(), peak)
+        tracemalloc.reset_peak()
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        return peak
+
+    @contextlib.contextmanager
+    def step(self, name, **details):
+        self._stack.append(name)
+        path = "/".join(self._stack)
+        if self.memory:
+            self._start_peak()
+        wall = time.time()
+        cpu = _cpu_time()
+        try:
+            yield details
+        finally:
+            record = {"step": path, "start": wall - self.started,
+                      "wall_seconds": time.time() - wall, "cpu_seconds": _cpu_time() - cpu}
+            if self.memory:
+                record["peak_traced_bytes"] = self._stop_peak()
+            else:
+                record["peak_resident_bytes"] = _peak_memory()
+            record.update(details)
+            self._stack.pop()
+
+            total = self._totals.setdefault(path, {"step": path, "calls": 0, "wall_seconds": 0.0,
+                                                   "cpu_seconds": 0.0, "cells": 0})
+            total["calls"] += 1
+            total["wall_seconds"] += record["wall_seconds"]
+            total["cpu_seconds"] += record["cpu_seconds"]
+            total["cells"] += details.get("cells", 0)
+            if total["calls"] <= DETAIL_CALLS:
+                self.steps.append(record)
+
+    def totals(self):
+        # Calls, time and cells of every step path, slowest first
+        return sorted(self._totals.values(), key=lambda total: -total["wall_seconds"])
+
+    def summary(self, count=SUMMARY_STEPS):
+        lines = ["Slowest steps:"]
+        for total in self.totals()[:count]:
+            lines.append("  {step:<40} {calls:>6} call(s) {wall_seconds:>9.3f} s wall "
+                         "{cpu_seconds:>9.3f} s cpu".format(**total))
+        return lines
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump({"wall_seconds": time.time() - self.started, "totals": self.totals(),
+                       "steps": self.steps}, f, indent=2)
+
+
+def window_size(window):
+    # Step details of a (row_start, row_stop, col_start, col_stop) window
+    rows = window[1] - window[0]
+    cols = window[3] - window[2]
+    return {"rows": rows, "cols": cols, "cells": rows * cols}
+
+
+_active = None
+
+
+def active_trace():
+    return _active
+
+
+@contextlib.contextmanager
+def step(name, **details):
+    # Records a step of the active trace; a no-op when no run is traced
+    if _active is None:
+        yield details
+    else:
+        with _active.step(name, **details) as record:
+            yield record
+
+
+@contextlib.contextmanager
+def tracing(path=None, memory=False, profile=None):
+    # Traces everything run inside; the JSON trace is written to path and
+    # cProfile statistics to profile when given
+    global _active
+    trace = Trace(memory)
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    if trace.memory:
+        tracemalloc.start()
+    previous = _active
+    _active = trace
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield trace
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        _active = previous
+        if trace.memory:
+            tracemalloc.stop()
+        if path:
+            trace.write(path)
+        for line in trace.summary():
+            log.info(line)
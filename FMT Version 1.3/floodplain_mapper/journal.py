@@ -0,0 +1,97 @@
+# Floodplain Mapper Toolbox 1.3
+# Run journal of the stages an Analysis run has completed, for resuming
+#
+# A run with a fixed output name keeps <name>_Journal.json next to its output
+# workspace. Each stage's products are written out of sight (a staging
+# workspace, or a temporary name) and only moved into the output once they
+# are complete, after which the stage and its outputs are added to the
+# journal. The journal itself is replaced in one rename, so a run that dies
+# at any point leaves the journal listing exactly the stages whose products
+# are whole. Rerunning with resume skips those stages and redoes the rest.
+# Each stage is recorded with a fingerprint of its Stage_Data values, so a
+# stage edited since it was completed is run again.
+
+import hashlib
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def journal_path(output_path, name):
+    return os.path.join(output_path, "{0}_Journal.json".format(name))
+
+
+def stage_fingerprint(values):
+    # Hash of one stage's {XS_ID: elevation} values
+    return hashlib.sha1(repr(sorted(values.items())).encode("utf-8")).hexdigest()
+
+
+def _replace(source, target):
+    # os.replace where it exists; older Pythons cannot rename over a file on
+    # Windows, so the target is removed first
+    if hasattr(os, "replace"):
+        os.replace(source, target)
+    else:
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+
+class RunJournal(object):
+    """Completed stages of one run and the settings the run was started with.
+
+    Stages are kept as {stage: {"outputs": [output names], "fingerprint":
+    stage_fingerprint of its values}}. Resuming with different settings
+    (products, cell size, surface model and so on) is refused, as the
+    finished stages would not match the rest.
+    """
+
+    def __init__(self, path, settings, stages=None):
+        self.path = path
+        self.settings = settings
+        self.stages = stages or {}
+
+    @classmethod
+    def open(cls, output_path, name, settings, resume=False):
+        path = journal_path(output_path, name)
+        if not os.path.exists(path):
+            journal = cls(path, settings)
+            journal.write()
+            return journal
+        if not resume:
+            raise RuntimeError("{0} already holds a run; resume it or choose another output "
+                               "name".format(name))
+        with open(path) as f:
+            previous = json.load(f)
+        if previous["settings"] != settings:
+            changed = sorted(key for key in set(settings) | set(previous["settings"])
+                             if settings.get(key) != previous["settings"].get(key))
+            raise RuntimeError("{0} was started with different settings ({1}) and cannot be "
+                               "resumed".format(name, ", ".join(changed)))
+        journal = cls(path, settings, previous["stages"])
+        if journal.stages:
+            log.info("Resuming {0}: {1} stage(s) already complete".format(name,
+                                                                           len(journal.stages)))
+        return journal
+
+    def completed(self, stage, fingerprint):
+        # Recorded with the same stage values; journals written before
+        # fingerprints were kept never match
+        entry = self.stages.get(stage)
+        return isinstance(entry, dict) and entry.get("fingerprint") == fingerprint
+
+    def stale(self, stage, fingerprint):
+        # Recorded, but with stage values that have changed since
+        return stage in self.stages and not self.completed(stage, fingerprint)
+
+    def record(self, stage, outputs, fingerprint):
+        self.stages[stage] = {"outputs": list(outputs), "fingerprint": fingerprint}
+        self.write()
+
+    def write(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"settings": self.settings, "stages": self.stages}, f, indent=2)
+        _replace(temporary, self.path)
@@ -0,0 +1,248 @@
+# Floodplain Mapper Toolbox 1.3
+# Inundation polygons traced straight from the wet cells of each reach
+#
+# Replaces RasterToPolygon_conversion followed by Intersect_analysis with
+# Reaches. Every boundary edge between a wet cell of a reach and any other
+# cell is found in one vectorized pass over the reach's window and oriented
+# with the wet cell on its left. The edges are chained into rings (cells
+# touching only at a corner are kept apart, as RasterToPolygon does), rings
+# are put in order by pointer jumping rather than walked one edge at a time,
+# and vertices along straight runs of edges are dropped. Outer rings run
+# counter-clockwise and holes clockwise; each hole is matched to its outer
+# ring through the row of cells west of it, without any geometric test. The
+# polygons cover exactly the wet cells, so their area equals the
+# Inundated_Area of the statistics table. Optional Douglas-Peucker
+# simplification smooths the cell staircase.
+
+from __future__ import division
+
+import numpy as np
+
+# Fields of the {stage}_Polygon feature class
+POLYGON_FIELDS = [
+    ("ReachID", "TEXT"),
+    ("Inundated_Area", "FLOAT"),
+]
+
+# Edge directions E, N, W, S as (row, column) steps; turning left from
+# direction d gives direction (d + 1) % 4
+_ROW_STEP = np.array([0, -1, 0, 1])
+_COL_STEP = np.array([1, 0, -1, 0])
+
+
+def _boundary_edges(mask):
+    # (row, column) start vertex and direction of every boundary edge of the
+    # True cells, with the cell on the left of the edge. Vertex (r, c) is the
+    # top-left corner of cell (r, c).
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=bool)
+    padded[1:-1, 1:-1] = mask
+    above = padded[:-1, 1:-1]
+    below = padded[1:, 1:-1]
+    left = padded[1:-1, :-1]
+    right = padded[1:-1, 1:]
+    rows = []
+    cols = []
+    directions = []
+    # Bottom of a cell, eastward; top of a cell, westward; left side of a
+    # cell, southward; right side of a cell, northward
+    for edges, row_offset, col_offset, direction in ((above & ~below, 0, 0, 0),
+                                                     (below & ~above, 0, 1, 2),
+                                                     (right & ~left, 0, 0, 3),
+                                                     (left & ~right, 1, 0, 1)):
+        r, c = np.nonzero(edges)
+        rows.append(r + row_offset)
+        cols.append(c + col_offset)
+        directions.append(np.full(len(r), direction, dtype=np.intp))
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(directions)
+
+
+def _cycles(following):
+    # Cycle of each element of the permutation following, named by its
+    # smallest element, and the element's distance to the end of the cycle
+    # when it is broken just before that smallest element
+    count = len(following)
+    first = np.arange(count)
+    jump = following.copy()
+    while True:
+        reached = np.minimum(first, first[jump])
+        if np.array_equal(reached, first):
+            break
+        first = reached
+        jump = jump[jump]
+    # Pointer jumping list ranking along the broken cycles
+    jump = np.where(following == first, -1, following)
+    distance = (jump >= 0).astype(np.intp)
+    while (jump >= 0).any():
+        active = jump >= 0
+        target = jump[active]
+        distance[active] += distance[target]
+        jump[active] = jump[target]
+    return first, distance
+
+
+def trace_rings(mask):
+    # Boundary rings of the True cells of mask as closed rings of (row,
+    # column) vertices concatenated into one array, with the offset of each
+    # ring in it and the index of the polygon each ring belongs to. A
+    # polygon's outer ring runs counter-clockwise as seen on a map (rows
+    # increasing southward) and comes before its holes, which run clockwise.
+    rows, cols, directions = _boundary_edges(mask)
+    if not len(rows):
+        return np.zeros((0, 2), dtype=np.intp), np.zeros(1, dtype=np.intp), \
+            np.zeros(0, dtype=np.intp)
+    width = mask.shape[1] + 1
+    start = rows * width + cols
+    end = (rows + _ROW_STEP[directions]) * width + cols + _COL_STEP[directions]
+    order = np.argsort(start, kind="mergesort")
+    rows = rows[order]
+    cols = cols[order]
+    directions = directions[order]
+    start = start[order]
+    end = end[order]
+
+    # Each edge continues with the edge starting at its end; where two cells
+    # touch only at that corner there are two, and turning left keeps to the
+    # current cell
+    following = np.searchsorted(start, end, side="left")
+    count = np.searchsorted(start, end, side="right") - following
+    fork = np.flatnonzero(count == 2)
+    turn_left = directions[following[fork]] != (directions[fork] + 1) % 4
+    following[fork[turn_left]] += 1
+
+    # Edges in ring order, rings numbered from 0
+    first, distance = _cycles(following)
+    order = np.lexsort((-distance, first))
+    rows = rows[order]
+    cols = cols[order]
+    directions = directions[order]
+    starts = np.flatnonzero(np.r_[True, first[order][1:] != first[order][:-1]])
+    stops = np.r_[starts[1:], len(order)]
+    ring = np.repeat(np.arange(len(starts)), stops - starts)
+
+    # Signed area of each ring in cells from its east and west edges:
+    # positive for outer rings, negative for holes
+    area = np.bincount(ring, weights=_COL_STEP[directions] * rows, minlength=len(starts))
+    hole = area < 0
+
+    # The westmost northward edge of a hole has a cell of the surrounding
+    # polygon just west of it. The run of cells along that row starts at a
+    # southward edge whose ring belongs to the same polygon and lies further
+    # west, so following these links from hole to ring ends at the outer ring.
+    owner = np.arange(len(starts))
+    northward = np.flatnonzero((directions == 1) & hole[ring])
+    if len(northward):
+        northward = northward[np.lexsort((cols[northward], ring[northward]))]
+        northward = northward[np.r_[True, ring[northward][1:] != ring[northward][:-1]]]
+        southward = np.flatnonzero(directions == 3)
+        keys = rows[southward] * width + cols[southward]
+        sort = np.argsort(keys)
+        run = np.searchsorted(keys[sort], (rows[northward] - 1) * width + cols[northward] - 1,
+                              side="right") - 1
+        owner[ring[northward]] = ring[southward[sort[run]]]
+        while hole[owner].any():
+            owner = np.where(hole[owner], owner[owner], owner)
+
+    # Only corners are kept: edges whose direction differs from the edge
+    # before them in the ring. Each ring is closed by repeating its first
+    # corner, and rings are put in polygon order.
+    previous = np.roll(directions, 1)
+    previous[starts] = directions[stops - 1]
+    corner = np.flatnonzero(directions != previous)
+    counts = np.bincount(ring[corner], minlength=len(starts))
+    first_corner = np.cumsum(counts) - counts
+    rings = np.lexsort((hole, owner))
+    closed = counts[rings] + 1
+    offsets = np.r_[0, np.cumsum(closed)]
+    which = np.repeat(rings, closed)
+    position = np.arange(offsets[-1]) - np.repeat(offsets[:-1], closed)
+    position[position == counts[which]] = 0
+    vertices = np.column_stack([rows, cols])[corner[first_corner[which] + position]]
+    polygon = np.cumsum(~hole[rings]) - 1
+    return vertices, offsets, polygon
+
+
+def reach_polygons(mask, grid, window, simplify=None):
+    # GeoJSON MultiPolygon coordinates of the True cells of mask, the block
+    # of grid covering window, or None when no cell is True. With simplify,
+    # rings are simplified to that tolerance in map units and rings that
+    # collapse are left out.
+    row_start, row_stop, col_start, col_stop = window
+    vertices, offsets, polygon = trace_rings(mask)
+    coordinates = np.column_stack(
+        [grid.x_min + (vertices[:, 1] + col_start) * grid.cell_size,
+         grid.y_max - (vertices[:, 0] + row_start) * grid.cell_size])
+    if not simplify:
+        coordinates = coordinates.tolist()
+    polygons = []
+    current = None
+    for index in range(len(polygon)):
+        ring = coordinates[offsets[index]:offsets[index + 1]]
+        if simplify:
+            ring = simplify_ring(ring, simplify)
+            if ring is not None:
+                ring = ring.tolist()
+        if index == 0 or polygon[index] != polygon[index - 1]:
+            # A new polygon; its holes are dropped with it if it collapses
+            current = None if ring is None else [ring]
+            if current is not None:
+                polygons.append(current)
+        elif current is not None and ring is not None:
+            current.append(ring)
+    return polygons or None
+
+
+def simplify_ring(ring, tolerance):
+    # Douglas-Peucker simplification of a closed ring, None if it collapses
+    if tolerance <= 0 or len(ring) <= 4:
+        return ring
+    # Split the ring at its first vertex and the vertex farthest from it
+    far = int(np.argmax(((ring - ring[0]) ** 2).sum(axis=1)))
+    keep = np.zeros(len(ring), dtype=bool)
+    keep[[0, far, len(ring) - 1]] = True
+    stack = [(0, far), (far, len(ring) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a = ring[first]
+        b = ring[last]
+        points = ring[first + 1:last]
+        segment = b - a
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(points[:, 0] - a[0], points[:, 1] - a[1])
+        else:
+            distances = np.abs(segment[0] * (points[:, 1] - a[1]) -
+                               segment[1] * (points[:, 0] - a[0])) / length
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            middle = first + 1 + index
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    ring = ring[keep]
+    if len(ring) < 4:
+        return None
+    return ring
+
+
+def polygon_records(project, wet, simplify=None):
+    # (properties, geometry) records of the {stage}_Polygon feature class,
+    # one MultiPolygon per reach with inundated cells. wet is a grid whose
+    # inundated cells are non-zero; only the window of one reach is read from
+    # it at a time, so it can stay on disk.
+    records = []
+    cell_area = project.dem.cell_size ** 2
+    for reach, reach_id in enumerate(project.reach_ids):
+        window = project.reach_window(reach)
+        if window is None:
+            continue
+        mask = (wet.read(window) > 0) & (project.labels(window) == reach + 1)
+        cells = int(np.count_nonzero(mask))
+        if not cells:
+            continue
+        coordinates = reach_polygons(mask, project.dem, window, simplify)
+        if coordinates is not None:
+            records.append(((reach_id, cells * cell_area),
+                            {"type": "MultiPolygon", "coordinates": coordinates}))
+    return records
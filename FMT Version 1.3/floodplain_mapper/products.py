@@ -0,0 +1,58 @@
+# Floodplain Mapper Toolbox 1.3
+# Products of the Analysis tool and the steps each product depends on
+#
+# A run is asked for a set of products and executes only the steps those
+# products need, found by walking a dependency graph of steps. A
+# statistics-only run, for example, never writes a depth grid. The graph
+# below is the NumPy engine's; the Analysis script tool walks its own graph
+# of arcpy steps with the same plan function.
+
+from __future__ import division
+
+# Per-stage products in the order they are written
+PRODUCTS = ("DepthGrid", "Polygon", "Statistics", "RasterFromTIN", "Subtracted")
+DEFAULT_PRODUCTS = ("DepthGrid", "Statistics")
+INTERMEDIATE_PRODUCTS = ("RasterFromTIN", "Subtracted")
+
+# Step or product -> steps it needs. "surface" evaluates the water surface
+# and subtracts the DEM, "depth" applies the depth threshold.
+ANALYSIS_STEPS = {
+    "surface": (),
+    "depth": ("surface",),
+    "RasterFromTIN": ("surface",),
+    "Subtracted": ("surface",),
+    "DepthGrid": ("depth",),
+    "Polygon": ("depth",),
+    "Statistics": ("depth",),
+}
+
+
+def plan(products, steps=ANALYSIS_STEPS):
+    # Every step needed for products, each after the steps it depends on
+    order = []
+
+    def visit(name):
+        if name in order:
+            return
+        if name not in steps:
+            raise RuntimeError("Unknown product {0}, expected one of {1}".format(
+                name, ", ".join(sorted(step for step in steps if step[0].isupper()))))
+        for dependency in steps[name]:
+            visit(dependency)
+        order.append(name)
+
+    for product in products:
+        visit(product)
+    return order
+
+
+def requested_products(products=None, delete_intermediate_data=True):
+    # Products of a run: the depth grid and statistics unless others are
+    # asked for, plus the intermediate rasters when they are kept
+    if products is None:
+        products = DEFAULT_PRODUCTS
+    products = list(products)
+    if not delete_intermediate_data:
+        products += INTERMEDIATE_PRODUCTS
+    plan(products)
+    return tuple(product for product in PRODUCTS if product in products)
@@ -0,0 +1,172 @@
+# Floodplain Mapper Toolbox 1.3
+# Coarse-to-fine depth grids from a min/max overview of the DEM
+#
+# The water surface at a cell is a weighted average of the stages of the
+# cross sections it is interpolated between (the corners of its TIN
+# triangle, or the cross sections up and down the reach), so over a block of
+# cells it lies between the lowest and highest stage of the cross sections
+# that block's cells use. The overview keeps the lowest and highest DEM
+# cell of each block. A block is certainly dry when even its highest water
+# surface is within the depth threshold of its lowest ground, and certainly
+# wet when its lowest water surface is above the threshold over its highest
+# ground. Dry blocks are never evaluated, wet blocks are evaluated without
+# the threshold, and only mixed blocks along the shoreline are thresholded
+# cell by cell. Every evaluated cell gets the same value as in the
+# full-resolution path, so depth grids, statistics and polygons are
+# identical.
+#
+# Before any cell is located, each surface model bounds the cross sections
+# a block's cells can use from its geometry alone (the triangles reaching
+# the block, or the reaches crossing it). Blocks dry at every stage under
+# that wider bound are never located in the model at all.
+
+from __future__ import division
+
+import numpy as np
+
+# Cells along each side of an overview block
+PYRAMID_BLOCK = 32
+
+# Bounds are widened by this much (in DEM units) so rounding in the weighted
+# sums can never carry a cell across the threshold unseen
+MARGIN = 1e-6
+
+DRY = 0
+MIXED = 1
+WET = 2
+
+
+def block_shape(shape, block_size):
+    # Overview blocks down and across a window of the given shape
+    rows, cols = shape
+    return -(-rows // block_size), -(-cols // block_size)
+
+
+def cell_blocks(shape, block_size):
+    # Overview block of every cell of a window
+    rows, cols = shape
+    block_cols = block_shape(shape, block_size)[1]
+    return (np.arange(rows) // block_size)[:, None] * block_cols + \
+        (np.arange(cols) // block_size)[None, :]
+
+
+def rectangle_blocks(row_low, row_high, col_low, col_high, shape, block_size):
+    # (rectangle, block) pairs of every overview block touched by each
+    # rectangle of window cells, given by inclusive row and column ranges
+    # that may reach past the window
+    rows, cols = shape
+    block_cols = block_shape(shape, block_size)[1]
+    row_low = np.maximum(row_low, 0)
+    row_high = np.minimum(row_high, rows - 1)
+    col_low = np.maximum(col_low, 0)
+    col_high = np.minimum(col_high, cols - 1)
+    owner = np.flatnonzero((row_low <= row_high) & (col_low <= col_high))
+    first_row = row_low[owner].astype(np.intp) // block_size
+    first_col = col_low[owner].astype(np.intp) // block_size
+    widths = col_high[owner].astype(np.intp) // block_size - first_col + 1
+    counts = (row_high[owner].astype(np.intp) // block_size - first_row + 1) * widths
+    offset = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    widths = np.repeat(widths, counts)
+    block = (np.repeat(first_row, counts) + offset // widths) * block_cols + \
+        np.repeat(first_col, counts) + offset % widths
+    return np.repeat(owner, counts), block
+
+
+class BlockSections(object):
+    """Cross sections the cells of each overview block are interpolated
+    between: the (block, cross section) pairs in block order, and the
+    blocks they cover. The extra block of cells outside the reaches is
+    left out."""
+
+    def __init__(self, block, xs, count, xs_count):
+        used = np.zeros((count + 1, xs_count), dtype=bool)
+        used[block, xs] = True
+        used[count] = False
+        pair_block, self.pair_xs = np.nonzero(used)
+        self.occupied = np.flatnonzero(used.any(axis=1))
+        self.starts = np.searchsorted(pair_block, self.occupied)
+
+
+class Overview(object):
+    """Min/max overview of one window of the DEM.
+
+    Keeps the overview block of every cell and the lowest and highest DEM
+    value of each block. Nothing here depends on the surface model or the
+    stage, so one overview serves every stage evaluated in the window.
+    """
+
+    def __init__(self, dem, labels, block_size=PYRAMID_BLOCK):
+        self.shape = dem.shape
+        rows, cols = self.shape
+        block_rows, block_cols = block_shape(self.shape, block_size)
+        self.block_size = block_size
+        self.count = block_rows * block_cols
+        # Cells outside the reaches fall in an extra block that is always dry
+        self.cell_block = np.where(labels > 0, cell_blocks(self.shape, block_size),
+                                   self.count).astype(np.int32).ravel()
+        self.dem = dem.ravel()
+        # Lowest and highest DEM cell of each block inside the reaches. Blocks
+        # without any (NaN) can never be wet.
+        padded = np.full((block_rows * block_size, block_cols * block_size), np.nan)
+        padded[:rows, :cols] = np.where(labels > 0, dem, np.nan)
+        blocks = padded.reshape(block_rows, block_size, block_cols, block_size)
+        low = np.fmin.reduce(np.fmin.reduce(blocks, axis=3), axis=1).ravel()
+        high = np.fmax.reduce(np.fmax.reduce(blocks, axis=3), axis=1).ravel()
+        self.dem_low = np.append(np.where(np.isnan(low), np.inf, low), np.inf)
+        self.dem_high = np.append(np.where(np.isnan(high), np.inf, high), np.inf)
+
+    def sections(self, block, xs, xs_count):
+        return BlockSections(block, xs, self.count, xs_count)
+
+    def classify(self, sections, z, threshold):
+        # DRY, MIXED or WET for each block given the stage z of every cross
+        # section of the model
+        classes = np.full(self.count + 1, DRY, dtype=np.int8)
+        if not len(sections.occupied):
+            return classes
+        stages = z[sections.pair_xs]
+        low = np.minimum.reduceat(stages, sections.starts)
+        high = np.maximum.reduceat(stages, sections.starts)
+        occupied = np.full(len(sections.occupied), MIXED, dtype=np.int8)
+        occupied[high - self.dem_low[sections.occupied] <= threshold - MARGIN] = DRY
+        occupied[low - self.dem_high[sections.occupied] > threshold + MARGIN] = WET
+        classes[sections.occupied] = occupied
+        return classes
+
+    def needed(self, sections, stages, threshold):
+        # Cells of the window in blocks that are not dry at every one of the
+        # stages, each a z array over the model's cross sections
+        keep = np.zeros(self.count + 1, dtype=bool)
+        for z in stages:
+            keep |= self.classify(sections, z, threshold) != DRY
+        return keep[self.cell_block].reshape(self.shape)
+
+
+class SurfaceOverview(object):
+    """The cells of one window located in one water surface model, with
+    their cross sections, weights, DEM values and overview block, and the
+    cross sections each block's cells use."""
+
+    def __init__(self, overview, location, xs_count):
+        self.overview = overview
+        self.cells = location.cells
+        self.cell_xs = location.cell_xs
+        self.weights = location.weights
+        self.cell_block = overview.cell_block[self.cells]
+        self.dem = overview.dem[self.cells]
+        self.sections = overview.sections(self.cell_block[:, None], self.cell_xs, xs_count)
+
+    def depth(self, z, threshold):
+        # Depth grid of the window (NaN where dry) and the classes of its
+        # blocks
+        classes = self.overview.classify(self.sections, z, threshold)
+        cell_classes = classes[self.cell_block]
+        index = np.flatnonzero(cell_classes != DRY)
+        subtracted = (self.weights[index] * z[self.cell_xs[index]]).sum(axis=1) - self.dem[index]
+        with np.errstate(invalid="ignore"):
+            dry = (cell_classes[index] == MIXED) & ~(subtracted > threshold)
+        subtracted[dry] = np.nan
+        shape = self.overview.shape
+        depth = np.full(shape[0] * shape[1], np.nan)
+        depth[self.cells[index]] = subtracted
+        return depth.reshape(shape), classes
@@ -0,0 +1,122 @@
+# Floodplain Mapper Toolbox 1.3
+# Persistent rasterized Reaches index stored in the input workspace
+#
+# The reach label raster (cell value = reach number, 0 outside every reach)
+# and each reach's bounding window are built once per DEM grid and reused by
+# every tool. A fingerprint of the Reaches geometry and the grid is stored
+# with the index, so editing the Reaches feature class or changing the cell
+# size rebuilds it on the next run.
+
+import hashlib
+import logging
+
+import numpy as np
+
+from .geometry import polygon_window, rasterize_polygons
+
+log = logging.getLogger(__name__)
+
+# Rows and columns rasterized at a time while building the index
+INDEX_TILE_SIZE = 4096
+
+INDEX_FIELDS = [
+    ("ReachID", "TEXT"),
+    ("Label", "LONG"),
+    ("Row_Start", "LONG"),
+    ("Row_Stop", "LONG"),
+    ("Col_Start", "LONG"),
+    ("Col_Stop", "LONG"),
+    ("Fingerprint", "TEXT"),
+]
+
+
+def fingerprint(reach_features, grid):
+    digest = hashlib.sha1()
+    header = (grid.x_min, grid.y_max, grid.cell_size, grid.rows, grid.cols)
+    digest.update(repr(header).encode("utf-8"))
+    for reach_id, rings in reach_features:
+        digest.update(repr(reach_id).encode("utf-8"))
+        for ring in rings:
+            digest.update(np.asarray(ring, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class ReachIndex(object):
+    """Reach label raster on a grid plus each reach's (row_start, row_stop,
+    col_start, col_stop) window, or None for reaches that miss the grid."""
+
+    def __init__(self, reach_features, labels, windows):
+        self.reach_features = reach_features
+        self.reach_ids = [reach_id for reach_id, rings in reach_features]
+        self.grid = labels
+        self.windows = windows
+
+    def labels(self, window=None):
+        return self.grid.read(window).astype(np.int32)
+
+    def window(self, reach_id):
+        return self.windows[self.reach_ids.index(reach_id)]
+
+    def labels_for(self, grid, window=None):
+        # Labels on another grid, or one window of it; sliced from the index
+        # when its cells line up with the index cells, otherwise rasterized
+        # from the geometry
+        window = window or grid.full_window()
+        rows = window[1] - window[0]
+        cols = window[3] - window[2]
+        cs = self.grid.cell_size
+        col_offset = (grid.x_min - self.grid.x_min) / cs
+        row_offset = (self.grid.y_max - grid.y_max) / cs
+        aligned = (abs(grid.cell_size - cs) < 1e-9 * cs and
+                   abs(col_offset - round(col_offset)) < 1e-6 and
+                   abs(row_offset - round(row_offset)) < 1e-6)
+        if not aligned:
+            return rasterize_polygons([rings for reach_id, rings in self.reach_features], grid,
+                                      window)
+        row_offset = int(round(row_offset)) + window[0]
+        col_offset = int(round(col_offset)) + window[2]
+        labels = np.zeros((rows, cols), dtype=np.int32)
+        row_start = max(row_offset, 0)
+        row_stop = min(row_offset + rows, self.grid.rows)
+        col_start = max(col_offset, 0)
+        col_stop = min(col_offset + cols, self.grid.cols)
+        if row_start < row_stop and col_start < col_stop:
+            labels[row_start - row_offset:row_stop - row_offset,
+                   col_start - col_offset:col_stop - col_offset] = \
+                self.labels((row_start, row_stop, col_start, col_stop))
+        return labels
+
+
+def build_reach_index(adapter, reaches, reach_features, grid, tile_size=INDEX_TILE_SIZE):
+    polygons = [rings for reach_id, rings in reach_features]
+    writer = adapter.create_raster("{0}_Labels".format(reaches), grid)
+    for window in grid.windows(tile_size):
+        writer.write(window, rasterize_polygons(polygons, grid, window))
+    writer.close()
+
+    windows = [polygon_window(rings, grid) for rings in polygons]
+    key = fingerprint(reach_features, grid)
+    rows = []
+    for index, (reach_id, rings) in enumerate(reach_features):
+        window = windows[index] or (-1, -1, -1, -1)
+        rows.append((reach_id, index + 1) + tuple(window) + (key,))
+    adapter.write_table("{0}_Index".format(reaches), INDEX_FIELDS, rows)
+    return ReachIndex(reach_features, adapter.open_raster("{0}_Labels".format(reaches)), windows)
+
+
+def open_reach_index(adapter, reaches, reach_features, grid):
+    # Reuse the stored index when it was built from the same Reaches and grid
+    table = "{0}_Index".format(reaches)
+    if adapter.exists(table) and adapter.exists("{0}_Labels".format(reaches)):
+        rows = adapter.read_table(table)
+        key = fingerprint(reach_features, grid)
+        if rows and all(row["Fingerprint"] == key for row in rows):
+            windows = []
+            for row in sorted(rows, key=lambda row: int(row["Label"])):
+                window = tuple(int(row[field]) for field in
+                               ("Row_Start", "Row_Stop", "Col_Start", "Col_Stop"))
+                windows.append(None if window[0] < 0 else window)
+            return ReachIndex(reach_features, adapter.open_raster("{0}_Labels".format(reaches)),
+                              windows)
+    log.info("Building reach index for {0}".format(reaches))
+    return build_reach_index(adapter, reaches, reach_features, grid)
@@ -0,0 +1,285 @@
+# Floodplain Mapper Toolbox 1.3
+# Resident "what-if" server answering stage queries from a project in memory
+#
+# The project is loaded once: for every reach, the cells inside it, the DEM
+# value of each cell and where the cell falls in the water surface model
+# (the cross sections it is interpolated between and their weights). A
+# query names a stage, an offset added to that stage at every cross section,
+# an optional reach and a product, and costs one weighted sum over the
+# reach's cells. Recent answers are kept in a bounded least recently used
+# cache. The server listens on localhost only and speaks JSON over HTTP:
+#
+#   GET /query?stage=MIN_Z_Value&offset=1.3&reach=R7&product=statistics
+#   GET /project
+#
+# Requests are handled one at a time, so queries never race for the model.
+
+from __future__ import division
+
+import collections
+import json
+import logging
+import time
+
+import numpy as np
+
+from .adapters import get_adapter
+from .engine import DEPTH_THRESHOLD, load_project
+from .polygons import reach_polygons
+from .statistics import STATISTICS_FIELDS, ReachStatistics
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+
+log = logging.getLogger(__name__)
+
+QUERY_PRODUCTS = ("statistics", "polygon", "depth")
+
+# Answers kept in memory
+RESULT_CACHE = 256
+
+HOST = "127.0.0.1"
+PORT = 8750
+
+# Stage_Data fields that are never stages
+_NOT_STAGES = ("XS_ID", "OBJECTID", "OID", "FID")
+
+
+class ReachCells(object):
+    """Cells of one reach in one surface model: flat index into the reach's
+    window, the cross sections each cell is interpolated between, their
+    weights and the DEM value of each cell."""
+
+    def __init__(self, window, cells, cell_xs, weights, dem):
+        self.window = window
+        self.cells = cells
+        self.cell_xs = cell_xs
+        self.weights = weights
+        self.dem = dem
+
+    def depth(self, z):
+        # Wet cells and their depths for cross-section values z, thresholded
+        # as in the Analysis tool
+        subtracted = (self.weights * z[self.cell_xs]).sum(axis=1) - self.dem
+        with np.errstate(invalid="ignore"):
+            wet = subtracted > DEPTH_THRESHOLD
+        return wet, subtracted[wet]
+
+    def block(self, wet, values, fill):
+        # Window-shaped grid of values at the wet cells, fill elsewhere
+        row_start, row_stop, col_start, col_stop = self.window
+        block = np.full((row_stop - row_start, col_stop - col_start), fill, dtype=values.dtype)
+        block.flat[self.cells[wet]] = values
+        return block
+
+
+class ResidentProject(object):
+    """A project held in memory to answer stage, offset, reach and product
+    queries without rereading the DEM or rebuilding the water surface."""
+
+    def __init__(self, project, cache_entries=RESULT_CACHE):
+        self.project = project
+        self.cache_entries = cache_entries
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+        self._reach_cells = {}
+        self._total_areas = project.total_areas
+        # Query parameters are text, so reaches are looked up by str(ReachID)
+        self._reaches = dict((str(reach_id), index) for index, reach_id in
+                             enumerate(project.reach_ids))
+
+    @property
+    def stages(self):
+        if not self.project.stage_data:
+            return []
+        return [field for field in self.project.stage_data[0] if field not in _NOT_STAGES]
+
+    def warm(self, stages=None):
+        # Locates every reach's cells in the surface model of each stage up
+        # front, so no query pays for it
+        start = time.time()
+        for stage in stages or self.stages:
+            values = self.project.stage_values(stage)
+            if values:
+                self.reach_cells(self.project.surface_model(set(values)))
+        log.info("Loaded {0} reach(es) in {1:.1f} s".format(len(self._reaches),
+                                                           time.time() - start))
+
+    def reach_cells(self, model):
+        # ReachCells of every reach in model, None for reaches off the DEM
+        if id(model) not in self._reach_cells:
+            cells = []
+            for reach in range(len(self._reaches)):
+                window = self.project.reach_window(reach)
+                if window is None:
+                    cells.append(None)
+                    continue
+                location = model.locate(window)
+                inside = self.project.labels(window).ravel()[location.cells] == reach + 1
+                flat = location.cells[inside]
+                cells.append(ReachCells(window, flat, location.cell_xs[inside],
+                                        location.weights[inside],
+                                        self.project.dem.read(window).ravel()[flat]))
+            self._reach_cells[id(model)] = cells
+        return self._reach_cells[id(model)]
+
+    def query(self, stage, offset=0.0, reach=None, product="statistics", simplify=None):
+        # JSON-ready answer for one stage raised by offset, for one ReachID
+        # or every reach
+        offset = float(offset or 0.0)
+        reach = None if reach is None else str(reach)
+        simplify = float(simplify) if simplify else None
+        key = (stage, offset, reach, product, simplify if product == "polygon" else None)
+        if key in self._results:
+            self.hits += 1
+            result = self._results.pop(key)
+            self._results[key] = result
+            return result
+        self.misses += 1
+        result = self._evaluate(stage, offset, reach, product, simplify)
+        self._results[key] = result
+        while len(self._results) > self.cache_entries:
+            self._results.popitem(last=False)
+        return result
+
+    def _evaluate(self, stage, offset, reach, product, simplify):
+        if product not in QUERY_PRODUCTS:
+            raise RuntimeError("Unknown product {0}, expected one of {1}".format(
+                product, ", ".join(QUERY_PRODUCTS)))
+        if stage not in self.stages:
+            raise RuntimeError("Unknown stage {0}, expected one of {1}".format(
+                stage, ", ".join(self.stages)))
+        if reach is not None and reach not in self._reaches:
+            raise RuntimeError("Unknown reach {0}".format(reach))
+        if product == "depth" and reach is None:
+            raise RuntimeError("A depth grid is only returned for one reach")
+        values = self.project.stage_values(stage)
+        if not values:
+            raise RuntimeError("No cross sections have values for {0}".format(stage))
+        model = self.project.surface_model(set(values))
+        z = np.array([values[xs_id] for xs_id in model.xs_ids], dtype=float) + offset
+        reaches = [self._reaches[reach]] if reach is not None else range(len(self._reaches))
+        result = {"stage": stage, "offset": offset, "reach": reach, "product": product}
+        all_cells = self.reach_cells(model)
+        grid = self.project.dem
+        if product == "statistics":
+            statistics = ReachStatistics(len(self._reaches))
+            for index in reaches:
+                if all_cells[index] is not None:
+                    wet, depth = all_cells[index].depth(z)
+                    statistics.add(np.full(len(depth), index + 1, dtype=np.intp), depth)
+            rows = statistics.rows(self.project.reach_ids, self._total_areas, grid.cell_size)
+            result["rows"] = [dict(zip([name for name, field_type in STATISTICS_FIELDS], rows[i]))
+                              for i in reaches]
+        elif product == "polygon":
+            features = []
+            for index in reaches:
+                cells = all_cells[index]
+                if cells is None:
+                    continue
+                wet, depth = cells.depth(z)
+                if not len(depth):
+                    continue
+                mask = cells.block(wet, np.ones(len(depth), dtype=bool), False)
+                coordinates = reach_polygons(mask, grid, cells.window, simplify)
+                if coordinates is not None:
+                    features.append({
+                        "type": "Feature",
+                        "properties": {"ReachID": self.project.reach_ids[index],
+                                       "Inundated_Area": len(depth) * grid.cell_area},
+                        "geometry": {"type": "MultiPolygon", "coordinates": coordinates}})
+            result["features"] = {"type": "FeatureCollection", "features": features}
+        else:
+            cells = all_cells[reaches[0]]
+            if cells is None:
+                result["depth"] = None
+            else:
+                wet, depth = cells.depth(z)
+                block = cells.block(wet, depth, np.nan)
+                row_start, row_stop, col_start, col_stop = cells.window
+                # NoData cells are null
+                result["depth"] = {
+                    "x_min": grid.x_min + col_start * grid.cell_size,
+                    "y_max": grid.y_max - row_start * grid.cell_size,
+                    "cell_size": grid.cell_size,
+                    "values": [[None if value != value else value for value in row]
+                               for row in block.tolist()]}
+        return result
+
+    def describe(self):
+        grid = self.project.dem
+        return {"stages": self.stages,
+                "reaches": self.project.reach_ids,
+                "surface": self.project.surface,
+                "cell_size": grid.cell_size,
+                "extent": [grid.x_min, grid.y_min, grid.x_max, grid.y_max],
+                "products": list(QUERY_PRODUCTS),
+                "cache": {"entries": len(self._results), "limit": self.cache_entries,
+                          "hits": self.hits, "misses": self.misses}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parameters = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+        start = time.time()
+        try:
+            if url.path == "/query":
+                if "stage" not in parameters:
+                    raise RuntimeError("A query needs a stage")
+                result = dict(self.server.resident.query(
+                    parameters["stage"], parameters.get("offset"), parameters.get("reach"),
+                    parameters.get("product", "statistics"), parameters.get("simplify")))
+                result["seconds"] = time.time() - start
+                self._send(200, result)
+            elif url.path == "/project":
+                self._send(200, self.server.resident.describe())
+            else:
+                self._send(404, {"error": "Unknown path {0}".format(url.path)})
+        except (RuntimeError, ValueError) as error:
+            self._send(400, {"error": str(error)})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def make_server(resident, host=HOST, port=PORT):
+    # HTTP server answering queries from resident; port 0 picks a free port
+    server = HTTPServer((host, port), _Handler)
+    server.resident = resident
+    return server
+
+
+def serve(resident, host=HOST, port=PORT):
+    server = make_server(resident, host, port)
+    log.info("Serving on http://{0}:{1}/".format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args):
+    # Entry point of "python -m floodplain_mapper serve"
+    adapter = get_adapter(args.format)(args.input_geodatabase)
+    project = load_project(adapter, args.dem, args.reaches, args.cross_sections, args.table,
+                           args.cell_size, args.surface)
+    resident = ResidentProject(project, args.cache_entries)
+    resident.warm(args.stages.split(";") if args.stages else None)
+    serve(resident, args.host, args.port)
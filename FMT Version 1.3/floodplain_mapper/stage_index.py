@@ -0,0 +1,91 @@
+# Floodplain Mapper Toolbox 1.3
+# One raster of the first stage inundating each cell, in place of a depth grid per stage
+#
+# Inundation extents are nested as the stage rises, so a run's extents fit
+# in one small integer raster: First_Stage holds the number (from 1, in the
+# order the stages were given) of the lowest stage whose depth grid covers
+# the cell, 0 where no stage does. Base_Relative_Elevation holds the DEM
+# minus the first stage's water surface. Any stage's extent is then
+# 0 < First_Stage <= its number, and where the stage lies a constant offset
+# above the first stage at every cross section, its depth is that offset
+# minus the relative elevation.
+
+import numpy as np
+
+STAGE_INDEX_RASTER = "First_Stage"
+RELATIVE_ELEVATION_RASTER = "Base_Relative_Elevation"
+STAGE_INDEX_TABLE = "Stage_Index"
+
+STAGE_INDEX_FIELDS = [
+    ("Value", "LONG"),
+    ("Stage", "TEXT"),
+    ("Offset", "FLOAT"),
+]
+
+# Stage numbers are stored as 16-bit integers
+STAGE_INDEX_DTYPE = np.int16
+
+
+class StageIndex(object):
+    """Builds First_Stage blocks from the depth blocks of every stage, in
+    stage order, and counts cells that dry out again at a higher stage."""
+
+    def __init__(self):
+        self.unnested = 0
+
+    def block(self, depths):
+        first = np.zeros(depths[0].shape, dtype=STAGE_INDEX_DTYPE)
+        for value, depth in enumerate(depths):
+            wet = ~np.isnan(depth)
+            if value:
+                self.unnested += int(np.count_nonzero((first > 0) & ~wet))
+            first[wet & (first == 0)] = value + 1
+        return first
+
+
+def stage_offsets(project, stages):
+    # Offset of each stage above the first one, or None where the difference
+    # is not the same at every cross section
+    base = project.stage_values(stages[0])
+    offsets = []
+    for stage in stages:
+        values = project.stage_values(stage)
+        differences = [values[xs_id] - base[xs_id] for xs_id in values if xs_id in base]
+        if (set(values) == set(base) and differences and
+                max(differences) - min(differences) < 1e-6):
+            offsets.append(float(np.mean(differences)))
+        else:
+            offsets.append(None)
+    return offsets
+
+
+def stage_index_rows(stages, offsets):
+    return [(value + 1, stage, offset) for value, (stage, offset) in
+            enumerate(zip(stages, offsets))]
+
+
+def _stage_row(adapter, stage):
+    for row in adapter.read_table(STAGE_INDEX_TABLE):
+        if row["Stage"] == stage:
+            return int(row["Value"]), row["Offset"]
+    raise RuntimeError("{0} is not in the {1} table".format(stage, STAGE_INDEX_TABLE))
+
+
+def stage_extent(adapter, stage, window=None):
+    # Boolean extent of stage from the First_Stage raster in adapter
+    value, offset = _stage_row(adapter, stage)
+    first = adapter.open_raster(STAGE_INDEX_RASTER).read(window)
+    return (first > 0) & (first <= value)
+
+
+def stage_depth(adapter, stage, window=None):
+    # Depth grid of stage, NaN where dry, from the First_Stage and
+    # Base_Relative_Elevation rasters in adapter
+    value, offset = _stage_row(adapter, stage)
+    if offset is None:
+        raise RuntimeError("{0} is not a constant offset above the first stage; "
+                           "run the analysis for it to get its depth grid".format(stage))
+    first = adapter.open_raster(STAGE_INDEX_RASTER).read(window)
+    relative = adapter.open_raster(RELATIVE_ELEVATION_RASTER).read(window)
+    depth = float(offset) - relative
+    return np.where((first > 0) & (first <= value), depth, np.nan)
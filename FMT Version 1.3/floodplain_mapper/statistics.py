@@ -0,0 +1,65 @@
+# Floodplain Mapper Toolbox 1.3
+# Per-reach inundation statistics reduced block by block from a reach label grid
+
+from __future__ import division
+
+import numpy as np
+
+# Fields of the {stage}_Statistics table written by the Analysis tool
+STATISTICS_FIELDS = [
+    ("ReachID", "TEXT"),
+    ("Total_Area", "FLOAT"),
+    ("Inundated_Area", "FLOAT"),
+    ("Percent_Inundated", "FLOAT"),
+    ("Inundation_Volume", "FLOAT"),
+    ("Max_Depth", "FLOAT"),
+    ("Mean_Depth", "FLOAT"),
+]
+
+
+class ReachStatistics(object):
+    """Running inundated cell count, depth sum and maximum depth per reach.
+
+    Blocks of a label grid (reach index + 1, 0 outside) and the matching depth
+    grid (NaN where dry) can be added in any order, so a DEM larger than
+    memory is summarised tile by tile.
+    """
+
+    def __init__(self, reach_count):
+        self.count = np.zeros(reach_count + 1, dtype=np.int64)
+        self.total = np.zeros(reach_count + 1)
+        self.maximum = np.full(reach_count + 1, -np.inf)
+
+    def add(self, labels, depth):
+        wet = (labels > 0) & ~np.isnan(depth)
+        labels = labels[wet]
+        depth = depth[wet]
+        size = len(self.count)
+        self.count += np.bincount(labels, minlength=size)
+        self.total += np.bincount(labels, weights=depth, minlength=size)
+        np.maximum.at(self.maximum, labels, depth)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.maximum = np.maximum(self.maximum, other.maximum)
+
+    def rows(self, reach_ids, total_areas, cell_size):
+        # Rows in STATISTICS_FIELDS order, rounded as in the Analysis tool.
+        # Reaches without any inundated cell report zero area and volume.
+        rows = []
+        for index, reach_id in enumerate(reach_ids):
+            count = int(self.count[index + 1])
+            total_area = round(total_areas[index])
+            inundated_area = count * cell_size * cell_size
+            percent = round(inundated_area / total_area, 4) if total_area else None
+            volume = round(self.total[index + 1] * cell_size * cell_size, 2)
+            if count:
+                max_depth = float(self.maximum[index + 1])
+                mean_depth = float(self.total[index + 1] / count)
+            else:
+                max_depth = None
+                mean_depth = None
+            rows.append((reach_id, total_area, inundated_area, percent, volume, max_depth,
+                         mean_depth))
+        return rows
@@ -0,0 +1,350 @@
+# Floodplain Mapper Toolbox 1.3
+# Subgrid tables: reach statistics of any stage from coarse cells
+#
+# The DEM is divided into coarse cells of factor x factor DEM cells. For the
+# part of each coarse cell inside each reach, the table keeps the
+# cumulative histogram of its relative elevations (DEM minus the water
+# surface of a base stage) as quantiles: the lowest value, the highest value
+# and the values in between, each stored as a byte between the two. Water
+# first fills the lowest cells, so the quantiles are taken at fractions
+# (k / levels) ** 2 of the cells, closest together at the bottom. Between
+# quantiles the cells are taken as evenly spread, so the wet cell count and
+# depth sum of any offset above the base are a few operations per coarse
+# cell. A stage that is not a uniform offset of the base is evaluated at
+# each coarse cell with the offset at the cross sections the cell's water
+# surface is interpolated between, weighted as they are over its DEM cells.
+
+from __future__ import division
+
+import hashlib
+import logging
+
+import numpy as np
+
+from .cache import features_fingerprint
+from .engine import DEPTH_THRESHOLD, load_project, time_output
+from .instrument import step, window_size
+from .statistics import STATISTICS_FIELDS, ReachStatistics
+from .surface import DENSIFY_CELLS, SURFACE_VERSION
+
+log = logging.getLogger(__name__)
+
+# DEM cells along each side of a coarse cell
+SUBGRID_FACTOR = 32
+
+# Bins of each coarse cell's histogram
+SUBGRID_LEVELS = 16
+
+# Cross sections kept per coarse cell for stages that are not uniform offsets
+SUBGRID_SECTIONS = 3
+
+# Quantiles and cross-section weights are stored as fractions of this
+_BYTE = 255
+
+# Table next to a subgrid table recording the base stage it was built for
+# and a fingerprint of the inputs it was built from
+SOURCE_NAME = "{0}_Source"
+SOURCE_FIELDS = [
+    ("Base_Stage", "TEXT"),
+    ("Fingerprint", "TEXT"),
+]
+
+
+def fractions(levels):
+    # Fraction of a coarse cell's cells below each quantile
+    return (np.arange(levels + 1) / float(levels)) ** 2
+
+
+def subgrid_fields(levels=SUBGRID_LEVELS):
+    return ([("ReachID", "TEXT"),
+             ("Coarse_Row", "LONG"),
+             ("Coarse_Col", "LONG"),
+             ("Cell_Count", "LONG"),
+             ("Low", "FLOAT"),
+             ("Span", "FLOAT")] +
+            [("Level_{0}".format(level), "SHORT") for level in range(1, levels)] +
+            [("XS_{0}".format(index), "TEXT") for index in range(1, SUBGRID_SECTIONS + 1)] +
+            [("Weight_{0}".format(index), "SHORT") for index in range(1, SUBGRID_SECTIONS + 1)])
+
+
+def subgrid_fingerprint(project, stage):
+    # Hash of the inputs a subgrid of stage is built from: the DEM
+    # georeference, the Reaches and Cross_Sections geometry, the surface model
+    # and the values of stage. The DEM cells are not hashed, as that would
+    # read the whole DEM every time a stored table is used.
+    grid = project.dem
+    digest = hashlib.sha1()
+    digest.update(repr((grid.x_min, grid.y_max, grid.cell_size, grid.rows, grid.cols,
+                        project.surface, DENSIFY_CELLS, SURFACE_VERSION)).encode("utf-8"))
+    digest.update(features_fingerprint(project.reaches).encode("utf-8"))
+    digest.update(features_fingerprint(project.cross_sections).encode("utf-8"))
+    digest.update(repr(sorted(project.stage_values(stage).items())).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class Subgrid(object):
+    """Relative elevation histograms of the coarse cells of one base stage.
+
+    Each entry is the part of one coarse cell inside one reach: its reach
+    number (reach index + 1), coarse row and column, DEM cell count, lowest
+    relative elevation and span up to the highest, the inner quantiles as
+    bytes of the span, and up to SUBGRID_SECTIONS cross sections (indexes
+    into xs_ids, -1 when unused) with byte weights.
+    """
+
+    def __init__(self, stage, xs_ids, labels, rows, cols, counts, low, span, levels, sections,
+                 weights):
+        self.stage = stage
+        self.xs_ids = list(xs_ids)
+        self.labels = labels
+        self.rows = rows
+        self.cols = cols
+        self.counts = counts
+        self.low = low
+        self.span = span
+        self.levels = levels
+        self.sections = sections
+        self.weights = weights
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.labels, self.rows, self.cols, self.counts,
+                                              self.low, self.span, self.levels, self.sections,
+                                              self.weights))
+
+    def quantiles(self):
+        # Relative elevation at each level, lowest to highest
+        inner = self.levels / float(_BYTE) * self.span[:, None].astype(np.float64)
+        low = self.low.astype(np.float64)[:, None]
+        return np.hstack([low, low + inner, low + self.span[:, None]])
+
+    def offsets(self, stage_data, stage):
+        # Offset of stage above the base stage at every cross section
+        base = {}
+        values = {}
+        for row in stage_data:
+            base[str(row["XS_ID"])] = row.get(self.stage)
+            values[str(row["XS_ID"])] = row.get(stage)
+        missing = [xs_id for xs_id in self.xs_ids
+                   if base.get(xs_id) is None or values.get(xs_id) is None]
+        if missing:
+            raise RuntimeError("{0} and {1} are not both given at cross sections {2}".format(
+                self.stage, stage, ", ".join(missing)))
+        return np.array([float(values[xs_id]) - float(base[xs_id]) for xs_id in self.xs_ids])
+
+    def evaluate(self, offsets, reach_count, threshold=DEPTH_THRESHOLD):
+        # Wet cell count, depth sum and maximum depth per reach number for
+        # offsets above the base, a number or one per cross section
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=np.float64), (len(self.xs_ids),))
+        used = self.sections >= 0
+        weights = np.where(used, self.weights, 0).astype(np.float64)
+        offset = (weights * offsets[np.where(used, self.sections, 0)]).sum(axis=1) / \
+            weights.sum(axis=1)
+        quantiles = self.quantiles()
+        lower = quantiles[:, :-1]
+        upper = quantiles[:, 1:]
+        # Cells are wet below offset - threshold, spread evenly within each bin
+        wet_below = (offset - threshold)[:, None]
+        top = np.clip(wet_below, lower, upper)
+        width = upper - lower
+        fraction = np.where(width > 0, (top - lower) / np.where(width > 0, width, 1.0),
+                            lower < wet_below)
+        cells = fraction * np.diff(fractions(lower.shape[1]))[None, :] * self.counts[:, None]
+        depth = cells * (offset[:, None] - (lower + top) / 2.0)
+        count = np.bincount(self.labels, weights=cells.sum(axis=1), minlength=reach_count + 1)
+        total = np.bincount(self.labels, weights=depth.sum(axis=1), minlength=reach_count + 1)
+        maximum = np.full(reach_count + 1, -np.inf)
+        wet = quantiles[:, 0] < offset - threshold
+        np.maximum.at(maximum, self.labels[wet], (offset - quantiles[:, 0])[wet])
+        return count, total, maximum
+
+    def statistics(self, project, stage=None, offset=0.0):
+        # Rows in STATISTICS_FIELDS order for stage (the base stage when not
+        # given) raised by offset, with the wet cell count rounded to whole
+        # cells
+        offsets = offset
+        if stage is not None and stage != self.stage:
+            offsets = self.offsets(project.stage_data, stage) + offset
+        count, total, maximum = self.evaluate(offsets, len(project.reaches))
+        statistics = ReachStatistics(len(project.reaches))
+        statistics.count = np.rint(count).astype(np.int64)
+        statistics.total = total
+        statistics.maximum = maximum
+        return statistics.rows(project.reach_ids, project.total_areas, project.dem.cell_size)
+
+    def table_rows(self, reach_ids):
+        rows = []
+        for index in range(len(self.counts)):
+            sections = [self.xs_ids[section] if section >= 0 else None
+                        for section in self.sections[index]]
+            weights = [int(weight) if section >= 0 else None
+                       for section, weight in zip(self.sections[index], self.weights[index])]
+            rows.append([reach_ids[self.labels[index] - 1], int(self.rows[index]),
+                         int(self.cols[index]), int(self.counts[index]),
+                         float(self.low[index]), float(self.span[index])] +
+                        [int(level) for level in self.levels[index]] + sections + weights)
+        return rows
+
+    @classmethod
+    def from_table(cls, stage, rows, reach_ids, source, fingerprint):
+        # Subgrid read back from the rows of a {stage}_Subgrid table. source
+        # is the rows of its _Source table, which must name stage as the base
+        # stage and match fingerprint, the subgrid_fingerprint of the inputs.
+        if len(source) != 1:
+            raise RuntimeError("The subgrid table has no source record of its base stage; build "
+                               "it again")
+        if str(source[0]["Base_Stage"]) != stage:
+            raise RuntimeError("The subgrid table was built for base stage {0}, not {1}".format(
+                source[0]["Base_Stage"], stage))
+        if str(source[0]["Fingerprint"]) != fingerprint:
+            raise RuntimeError("The DEM, Reaches, Cross_Sections, surface model or {0} values "
+                               "changed since the subgrid table was built; build it "
+                               "again".format(stage))
+        reach_ids = [str(reach_id) for reach_id in reach_ids]
+        levels = len([field for field in (rows[0] if rows else {})
+                      if field.startswith("Level_")]) + 1
+        xs_ids = []
+        labels, coarse_rows, coarse_cols, counts, low, span = [], [], [], [], [], []
+        quantiles, sections, weights = [], [], []
+        for row in rows:
+            if str(row["ReachID"]) not in reach_ids:
+                raise RuntimeError("ReachID {0} of the subgrid table is not in the Reaches "
+                                   "feature class".format(row["ReachID"]))
+            labels.append(reach_ids.index(str(row["ReachID"])) + 1)
+            coarse_rows.append(int(row["Coarse_Row"]))
+            coarse_cols.append(int(row["Coarse_Col"]))
+            counts.append(int(row["Cell_Count"]))
+            low.append(float(row["Low"]))
+            span.append(float(row["Span"]))
+            quantiles.append([int(row["Level_{0}".format(level)]) for level in range(1, levels)])
+            entry = []
+            entry_weights = []
+            for index in range(1, SUBGRID_SECTIONS + 1):
+                xs_id = row["XS_{0}".format(index)]
+                if xs_id is None or xs_id == "":
+                    entry.append(-1)
+                    entry_weights.append(0)
+                    continue
+                if str(xs_id) not in xs_ids:
+                    xs_ids.append(str(xs_id))
+                entry.append(xs_ids.index(str(xs_id)))
+                entry_weights.append(int(row["Weight_{0}".format(index)]))
+            sections.append(entry)
+            weights.append(entry_weights)
+        return cls(stage, xs_ids, np.array(labels, dtype=np.int32),
+                   np.array(coarse_rows, dtype=np.int32), np.array(coarse_cols, dtype=np.int32),
+                   np.array(counts, dtype=np.int32), np.array(low, dtype=np.float32),
+                   np.array(span, dtype=np.float32),
+                   np.array(quantiles, dtype=np.uint8).reshape(len(rows), levels - 1),
+                   np.array(sections, dtype=np.int32).reshape(len(rows), SUBGRID_SECTIONS),
+                   np.array(weights, dtype=np.uint8).reshape(len(rows), SUBGRID_SECTIONS))
+
+
+def _window_entries(project, model, values, window, factor, levels):
+    # Subgrid arrays of the coarse cells inside one window, which starts on
+    # a coarse cell boundary
+    row_start, row_stop, col_start, col_stop = window
+    cols = col_stop - col_start
+    dem = project.dem.read(window).ravel()
+    labels = project.labels(window).ravel()
+    location = model.locate(window)
+    relative = dem[location.cells] - model.evaluate(values, location).ravel()[location.cells]
+    valid = (labels[location.cells] > 0) & ~np.isnan(relative)
+    cells = location.cells[valid]
+    relative = relative[valid]
+    cell_labels = labels[cells].astype(np.int64)
+    coarse_row = (row_start + cells // cols) // factor
+    coarse_col = (col_start + cells % cols) // factor
+    coarse_cols = -(-project.dem.cols // factor)
+    key = (coarse_row * coarse_cols + coarse_col) * (len(project.reaches) + 1) + cell_labels
+    order = np.lexsort((relative, key))
+    key = key[order]
+    relative = relative[order]
+    entry_key, starts, counts = np.unique(key, return_index=True, return_counts=True)
+    entry = np.repeat(np.arange(len(entry_key)), counts)
+
+    # Quantiles of each entry's sorted values
+    position = starts[:, None] + fractions(levels)[None, :] * (counts[:, None] - 1)
+    below = np.floor(position).astype(np.intp)
+    above = np.minimum(below + 1, (starts + counts - 1)[:, None])
+    quantiles = relative[below] + (position - below) * (relative[above] - relative[below])
+    low = quantiles[:, 0].astype(np.float32)
+    span = (quantiles[:, -1] - low).astype(np.float32)
+    scale = np.where(span > 0, span, 1.0)
+    inner = np.rint((quantiles[:, 1:-1] - low[:, None]) / scale[:, None] * _BYTE)
+    inner = np.clip(inner, 0, _BYTE).astype(np.uint8)
+
+    # Mean weight of each cross section over each entry's cells, keeping
+    # the heaviest
+    cell_xs = location.cell_xs[valid][order]
+    weights = location.weights[valid][order]
+    xs_count = len(model.xs_ids)
+    pair, inverse = np.unique((entry[:, None] * xs_count + cell_xs).ravel(), return_inverse=True)
+    total = np.bincount(inverse.ravel(), weights=weights.ravel())
+    pair_entry, pair_xs = np.divmod(pair, xs_count)
+    ranked = np.lexsort((-total, pair_entry))
+    rank = np.arange(len(ranked)) - np.searchsorted(pair_entry[ranked], pair_entry[ranked])
+    keep = ranked[rank < SUBGRID_SECTIONS]
+    slot = rank[rank < SUBGRID_SECTIONS]
+    sections = np.full((len(entry_key), SUBGRID_SECTIONS), -1, dtype=np.int32)
+    section_weights = np.zeros((len(entry_key), SUBGRID_SECTIONS))
+    sections[pair_entry[keep], slot] = pair_xs[keep]
+    section_weights[pair_entry[keep], slot] = total[keep] / counts[pair_entry[keep]]
+    section_weights = np.clip(np.rint(section_weights * _BYTE), 0, _BYTE).astype(np.uint8)
+    # A weight that rounds to nothing still marks its cross section as used
+    section_weights[(sections >= 0) & (section_weights == 0)] = 1
+
+    coarse, label = np.divmod(entry_key, len(project.reaches) + 1)
+    coarse_row, coarse_col = np.divmod(coarse, coarse_cols)
+    return (label.astype(np.int32), coarse_row.astype(np.int32), coarse_col.astype(np.int32),
+            counts.astype(np.int32), low, span, inner, sections, section_weights)
+
+
+def build_subgrid(project, stage, factor=SUBGRID_FACTOR, levels=SUBGRID_LEVELS, tile_size=None):
+    # Subgrid of stage over coarse cells of factor x factor DEM cells. Tiles
+    # are rounded up to whole coarse cells.
+    values = project.stage_values(stage)
+    if not values:
+        raise RuntimeError("No cross sections have values for {0}".format(stage))
+    model = project.surface_model(set(values))
+    if tile_size:
+        tile_size = -(-tile_size // factor) * factor
+    parts = []
+    for window in project.dem.windows(tile_size):
+        with step("subgrid", **window_size(window)):
+            parts.append(_window_entries(project, model, values, window, factor, levels))
+    arrays = [np.concatenate([part[index] for part in parts]) for index in range(len(parts[0]))]
+    return Subgrid(stage, model.xs_ids, *arrays)
+
+
+def run_subgrid(source, output_path, dem, cell_size, reaches, cross_sections, table, stage,
+                stages=None, subgrid=None, output_adapter=None, tile_size=None,
+                factor=SUBGRID_FACTOR, levels=SUBGRID_LEVELS, surface="tin"):
+    # Writes the {stage}_Subgrid table of base stage, or reads the table
+    # named subgrid from the input workspace, and a {stage}_Subgrid_Statistics
+    # table for each of stages from it
+    project = load_project(source, dem, reaches, cross_sections, table, cell_size, surface)
+    output_adapter = output_adapter or type(source)
+    output = output_adapter.create(output_path, "FMT_{0}".format(time_output()))
+    fingerprint = subgrid_fingerprint(project, stage)
+    if subgrid:
+        source_name = SOURCE_NAME.format(subgrid)
+        source_rows = source.read_table(source_name) if source.exists(source_name) else []
+        table = Subgrid.from_table(stage, source.read_table(subgrid), project.reach_ids,
+                                   source_rows, fingerprint)
+    else:
+        log.info("Building subgrid table of {0}".format(stage))
+        table = build_subgrid(project, stage, factor, levels, tile_size)
+        name = "{0}_Subgrid".format(stage)
+        output.write_table(name, subgrid_fields(levels), table.table_rows(project.reach_ids))
+        output.write_table(SOURCE_NAME.format(name), SOURCE_FIELDS, [(stage, fingerprint)])
+    grid = project.dem
+    dem_bytes = grid.rows * grid.cols * np.dtype(getattr(grid.array, "dtype", np.float32)).itemsize
+    log.info("Subgrid table of {0} coarse cells, {1:.0f} times smaller than the DEM".format(
+        len(table.counts), dem_bytes / max(table.nbytes, 1)))
+    for name in stages or []:
+        log.info("Calculating subgrid statistics for {0}".format(name))
+        output.write_table("{0}_Subgrid_Statistics".format(name), STATISTICS_FIELDS,
+                           table.statistics(project, name))
+    log.info("Script finished")
+    return output
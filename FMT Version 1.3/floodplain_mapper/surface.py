@@ -0,0 +1,287 @@
+# Floodplain Mapper Toolbox 1.3
+# Water surface models through the cross sections, built once per run
+#
+# The Analysis tool rebuilds its TIN for every stage even though only the
+# cross-section z-values change. A TinSurface triangulates the cross sections
+# and locates the DEM cells in that triangulation once; each stage is then a
+# weighted sum of the cross-section elevations. A CenterlineSurface instead
+# interpolates along each reach between consecutive cross sections, which
+# needs no triangulation at all.
+
+from __future__ import division
+
+import math
+
+import numpy as np
+
+from .geometry import densify, points_in_polygon
+from .pyramid import cell_blocks, rectangle_blocks
+from .triangulation import barycentric_weights, conforming_delaunay
+
+# Cross-section vertices are densified to this many DEM cells before they
+# are triangulated
+DENSIFY_CELLS = 10
+
+# Version of the surface models, part of every cached stage's key. Bump it
+# whenever the triangulation or the surface code changes the water surface,
+# so results cached by an earlier version are not served again.
+SURFACE_VERSION = 2
+
+
+class Location(object):
+    """Cells of one window located in a surface: flat cell index, the cross
+    sections at the corners of the containing triangle and their weights."""
+
+    def __init__(self, shape, cells, cell_xs, weights):
+        self.shape = shape
+        self.cells = cells
+        self.cell_xs = cell_xs
+        self.weights = weights
+
+
+class TinSurface(object):
+
+    def __init__(self, cross_sections, grid):
+        # cross_sections are (XS_ID, parts) pairs that take part in the TIN
+        self.grid = grid
+        self.xs_ids = [str(xs_id) for xs_id, parts in cross_sections]
+        spacing = DENSIFY_CELLS * grid.cell_size
+        points = []
+        vertex_xs = []
+        segments = []
+        count = 0
+        for index, (xs_id, parts) in enumerate(cross_sections):
+            for part in parts:
+                vertices = densify(part, spacing)
+                points.append(vertices)
+                vertex_xs.append(np.full(len(vertices), index, dtype=np.intp))
+                segments.append(np.column_stack([np.arange(count, count + len(vertices) - 1),
+                                                 np.arange(count + 1, count + len(vertices))]))
+                count += len(vertices)
+        # The cross sections are Hard_Line breaklines of the Analysis TIN: the
+        # triangulation is made to conform to them by splitting any segment
+        # that is not a triangle edge, so no triangle spans a cross section.
+        # Every vertex of a cross section carries the same stage value, so
+        # cells only need to know which cross section each corner belongs to,
+        # and the split points belong to the cross section they were split from.
+        self.points, self.triangles, source = conforming_delaunay(np.vstack(points),
+                                                                  np.vstack(segments))
+        self.vertex_xs = np.concatenate(vertex_xs)[source]
+        self._location = None
+
+    def locate(self, window=None, mask=None):
+        # Whole-grid locations are cached; tiles are located on demand so
+        # memory stays bounded by the tile size. With mask, a boolean block
+        # of the window, only the cells it marks are located.
+        window = tuple(window or self.grid.full_window())
+        whole = window == self.grid.full_window() and mask is None
+        if whole and self._location is not None:
+            return self._location
+        row_start, row_stop, col_start, col_stop = window
+        cells, vertices, weights = barycentric_weights(self.points, self.triangles, self.grid,
+                                                       window, mask)
+        location = Location((row_stop - row_start, col_stop - col_start), cells,
+                            self.vertex_xs[vertices], weights)
+        if whole:
+            self._location = location
+        return location
+
+    def block_sections(self, window, block_size):
+        # (block, cross section) pairs of the overview blocks of a window:
+        # the cross sections at the corners of every triangle whose bounding
+        # box, widened by a cell, reaches the block
+        row_start, row_stop, col_start, col_stop = window
+        cs = self.grid.cell_size
+        corners = self.points[self.triangles]
+        x = corners[:, :, 0]
+        y = corners[:, :, 1]
+        triangle, block = rectangle_blocks(
+            np.floor((self.grid.y_max - y.max(axis=1)) / cs - 0.5) - row_start,
+            np.ceil((self.grid.y_max - y.min(axis=1)) / cs - 0.5) - row_start,
+            np.floor((x.min(axis=1) - self.grid.x_min) / cs - 0.5) - col_start,
+            np.ceil((x.max(axis=1) - self.grid.x_min) / cs - 0.5) - col_start,
+            (row_stop - row_start, col_stop - col_start), block_size)
+        return np.repeat(block, 3), self.vertex_xs[self.triangles[triangle]].ravel()
+
+    def evaluate(self, values, location=None):
+        # values maps XS_ID to the stage elevation of each cross section
+        return _evaluate(self.xs_ids, values, location or self.locate())
+
+
+def _evaluate(xs_ids, values, location):
+    z = np.array([values[xs_id] for xs_id in xs_ids], dtype=float)
+    surface = np.full(location.shape[0] * location.shape[1], np.nan)
+    surface[location.cells] = (location.weights * z[location.cell_xs]).sum(axis=1)
+    return surface.reshape(location.shape)
+
+
+def _midpoint(parts):
+    # Point halfway along the longest part of a cross section
+    best = None
+    for part in parts:
+        vertices = np.asarray(part, dtype=float)
+        if len(vertices) < 2:
+            continue
+        lengths = np.hypot(*np.diff(vertices, axis=0).T)
+        if best is None or lengths.sum() > best[1].sum():
+            best = (vertices, lengths)
+    if best is None:
+        return np.asarray(parts[0][0], dtype=float)
+    vertices, lengths = best
+    half = lengths.sum() / 2.0
+    distance = np.concatenate([[0.0], np.cumsum(lengths)])
+    segment = min(int(np.searchsorted(distance, half, side="right")) - 1, len(lengths) - 1)
+    t = (half - distance[segment]) / lengths[segment] if lengths[segment] else 0.0
+    return vertices[segment] + (vertices[segment + 1] - vertices[segment]) * t
+
+
+def _chain(points):
+    # Order points along the channel: start from the point farthest from
+    # their centroid and repeatedly step to the nearest remaining point
+    remaining = list(range(len(points)))
+    if not remaining:
+        return []
+    center = points.mean(axis=0)
+    current = max(remaining, key=lambda i: math.hypot(*(points[i] - center)))
+    order = [current]
+    remaining.remove(current)
+    while remaining:
+        current = min(remaining, key=lambda i: math.hypot(*(points[i] - points[current])))
+        order.append(current)
+        remaining.remove(current)
+    return order
+
+
+def _extend(chain, points):
+    # Continue a chain past each end with the nearest cross section outside
+    # it that lies further along the channel and no more than twice the
+    # largest spacing away, so cells between the last cross section of one
+    # reach and the first of the next are still covered
+    chain = list(chain)
+    if not chain or len(chain) == len(points):
+        return chain
+    outside = [index for index in range(len(points)) if index not in chain]
+    if len(chain) > 1:
+        gaps = np.hypot(*np.diff(points[chain], axis=0).T)
+        reach = 2.0 * gaps.max()
+    else:
+        reach = np.inf
+    for end in (0, -1):
+        last = points[chain[end]]
+        direction = last - points[chain[end + 1 if end == 0 else end - 1]] \
+            if len(chain) > 1 else None
+        best = None
+        for index in outside:
+            offset = points[index] - last
+            distance = math.hypot(*offset)
+            if distance > reach or (direction is not None and np.dot(offset, direction) <= 0):
+                continue
+            if best is None or distance < best[0]:
+                best = (distance, index)
+        if best is not None:
+            outside.remove(best[1])
+            if end == 0:
+                chain.insert(0, best[1])
+            else:
+                chain.append(best[1])
+    return chain
+
+
+class CenterlineSurface(object):
+    """Water surface interpolated in 1-D along each reach.
+
+    The cross sections crossing a reach, plus the next one past each end,
+    are chained in channel order through their midpoints. Each cell of the
+    reach is projected onto that chain, giving the upstream and downstream
+    cross section and the weight of the downstream one; cells beyond the end
+    cross sections are left out, like cells outside the TIN. labels(window)
+    gives the reach label block of a window, as Project.labels does.
+    """
+
+    def __init__(self, cross_sections, grid, reaches, labels):
+        self.grid = grid
+        self.labels = labels
+        self.xs_ids = [str(xs_id) for xs_id, parts in cross_sections]
+        self.midpoints = np.array([_midpoint(parts) for xs_id, parts in cross_sections])
+        self.chains = []
+        # Vertices densified to the cell size tell which reaches a cross
+        # section crosses
+        vertices = [np.vstack([densify(part, grid.cell_size) for part in parts])
+                    for xs_id, parts in cross_sections]
+        for reach_id, rings in reaches:
+            members = [index for index in range(len(cross_sections))
+                       if points_in_polygon(vertices[index], rings).any()]
+            order = [members[i] for i in _chain(self.midpoints[members])]
+            self.chains.append(np.array(_extend(order, self.midpoints), dtype=np.intp))
+        self._location = None
+
+    def locate(self, window=None, mask=None):
+        window = tuple(window or self.grid.full_window())
+        whole = window == self.grid.full_window() and mask is None
+        if whole and self._location is not None:
+            return self._location
+        labels = self.labels(window).ravel()
+        if mask is not None:
+            labels = np.where(mask.ravel(), labels, 0)
+        x, y = np.meshgrid(*self.grid.cell_centers(window))
+        x = x.ravel()
+        y = y.ravel()
+        cells = [np.zeros(0, dtype=np.intp)]
+        cell_xs = [np.zeros((0, 2), dtype=np.intp)]
+        weights = [np.zeros((0, 2))]
+        for reach, chain in enumerate(self.chains):
+            if len(chain) < 2:
+                continue
+            flat = np.flatnonzero(labels == reach + 1)
+            if not len(flat):
+                continue
+            px = x[flat]
+            py = y[flat]
+            points = self.midpoints[chain]
+            nearest = np.full(len(flat), np.inf)
+            segment = np.zeros(len(flat), dtype=np.intp)
+            along = np.zeros(len(flat))
+            for k in range(len(chain) - 1):
+                dx, dy = points[k + 1] - points[k]
+                length = dx * dx + dy * dy
+                if not length:
+                    continue
+                t = ((px - points[k, 0]) * dx + (py - points[k, 1]) * dy) / length
+                clipped = np.clip(t, 0.0, 1.0)
+                distance = (px - points[k, 0] - clipped * dx) ** 2 + \
+                    (py - points[k, 1] - clipped * dy) ** 2
+                closer = distance < nearest
+                nearest[closer] = distance[closer]
+                segment[closer] = k
+                along[closer] = t[closer]
+            last = len(chain) - 2
+            inside = ~(((segment == 0) & (along < 0)) | ((segment == last) & (along > 1)))
+            along = np.clip(along[inside], 0.0, 1.0)
+            segment = segment[inside]
+            cells.append(flat[inside])
+            cell_xs.append(np.column_stack([chain[segment], chain[segment + 1]]))
+            weights.append(np.column_stack([1.0 - along, along]))
+        row_start, row_stop, col_start, col_stop = window
+        location = Location((row_stop - row_start, col_stop - col_start), np.concatenate(cells),
+                            np.vstack(cell_xs), np.vstack(weights))
+        if whole:
+            self._location = location
+        return location
+
+    def block_sections(self, window, block_size):
+        # (block, cross section) pairs of the overview blocks of a window:
+        # every cross section chained along each reach the block's cells
+        # belong to
+        labels = self.labels(window)
+        inside = labels > 0
+        reaches = len(self.chains) + 1
+        pairs = np.unique(cell_blocks(labels.shape, block_size)[inside] * reaches +
+                          labels[inside])
+        chains = [self.chains[label - 1] for label in (pairs % reaches).tolist()]
+        if not len(chains):
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        counts = np.array([len(chain) for chain in chains], dtype=np.intp)
+        return np.repeat(pairs // reaches, counts), np.concatenate(chains)
+
+    def evaluate(self, values, location=None):
+        return _evaluate(self.xs_ids, values, location or self.locate())
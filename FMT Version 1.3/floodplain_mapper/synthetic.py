@@ -0,0 +1,80 @@
+# Floodplain Mapper Toolbox 1.3
+# Synthetic projects: a valley DEM with a channel, Reaches, Cross_Sections and Stage_Data
+#
+# The valley runs west to east down a constant slope with a V-shaped cross
+# profile and a narrow channel cut into its floor, wandering gently so the
+# cross sections are not all alike. Reaches split the valley into equal
+# lengths and cross sections span its full width at a regular spacing.
+
+from __future__ import division
+
+import numpy as np
+
+from .grid import Grid
+from .wse import sample_cross_sections
+
+# Valley shape, in DEM units
+VALLEY_SLOPE = 0.002
+SIDE_SLOPE = 0.05
+CHANNEL_DEPTH = 1.5
+CHANNEL_WIDTH = 6.0
+BASE_ELEVATION = 100.0
+
+
+def valley_dem(rows, cols, cell_size=1.0, seed=0, x_min=0.0, y_max=None):
+    # Grid of the synthetic valley with a little noise
+    if y_max is None:
+        y_max = rows * cell_size
+    x = (np.arange(cols) + 0.5) * cell_size
+    y = (np.arange(rows) + 0.5) * cell_size
+    width = rows * cell_size
+    center = width / 2.0 + width / 10.0 * np.sin(x / max(cols * cell_size, 1.0) * 2 * np.pi)
+    offset = np.abs(y[:, None] - center[None, :])
+    dem = BASE_ELEVATION - VALLEY_SLOPE * x[None, :] + SIDE_SLOPE * offset
+    channel = np.clip(1.0 - offset / CHANNEL_WIDTH, 0.0, 1.0) * CHANNEL_DEPTH
+    noise = np.random.RandomState(seed).normal(0.0, 0.02, size=(rows, cols))
+    return Grid((dem - channel + noise).astype(np.float32), x_min, y_max, cell_size)
+
+
+def _rectangle(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]
+
+
+def make_project(adapter, rows, cols, stages=5, reaches=4, cell_size=1.0, spacing=None,
+                 stage_step=0.5, seed=0):
+    # Writes DEM, Reaches, Cross_Sections and Stage_Data into adapter's
+    # workspace. Stage_Data holds MIN_Z_Value and stages - 1 further stages
+    # named Stage_1, Stage_2, ... each stage_step above the previous one.
+    grid = valley_dem(rows, cols, cell_size, seed)
+    adapter.write_raster("DEM", grid)
+
+    margin = cell_size * 2
+    y0 = grid.y_min + margin
+    y1 = grid.y_max - margin
+    length = (grid.x_max - grid.x_min - 2 * margin) / reaches
+    records = []
+    for index in range(reaches):
+        x0 = grid.x_min + margin + index * length
+        records.append((("R{0}".format(index + 1),),
+                        {"type": "Polygon", "coordinates": [_rectangle(x0, y0, x0 + length, y1)]}))
+    adapter.write_features("Reaches", [("ReachID", "TEXT")], records)
+
+    # Cross sections reach slightly past the valley edges, as drawn by hand
+    spacing = spacing or max(length / 4.0, 10 * cell_size)
+    count = int((grid.x_max - grid.x_min - 2 * margin) // spacing) + 1
+    cross_sections = []
+    records = []
+    for index in range(count):
+        x = grid.x_min + margin + index * spacing
+        line = [[x, grid.y_min + margin / 2.0], [x, grid.y_max - margin / 2.0]]
+        cross_sections.append(("XS{0}".format(index), [line]))
+        records.append((("XS{0}".format(index),), {"type": "LineString", "coordinates": line}))
+    adapter.write_features("Cross_Sections", [("XS_ID", "TEXT")], records)
+
+    min_z = sample_cross_sections(grid, cross_sections)[:, 0]
+    fields = [("XS_ID", "TEXT"), ("MIN_Z_Value", "FLOAT")] + \
+        [("Stage_{0}".format(stage), "FLOAT") for stage in range(1, stages)]
+    rows = [[xs_id, float(z)] + [float(z + stage * stage_step) for stage in range(1, stages)]
+            for (xs_id, parts), z in zip(cross_sections, min_z)]
+    adapter.write_table("Stage_Data", fields, rows)
+    return [field for field, field_type in fields[1:]]
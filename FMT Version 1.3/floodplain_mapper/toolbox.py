@@ -0,0 +1,492 @@
+# Floodplain Mapper Toolbox 1.3
+# The four script tools as functions that can be imported and called again
+#
+# create_inputs, get_wse, analysis and hypsometry take the script tools'
+# parameters as arguments and run their arcpy workflows. The "FMT 1.3 ...
+# - Toolbox.py" scripts only read their parameters and call these. arcpy is
+# imported on the first call, and the 3D and Spatial Analyst extensions are
+# checked out once per process, so a Python session or batch process can run
+# many tools without paying for either again.
+
+from __future__ import division
+
+import logging
+import os
+
+import numpy as np
+
+from .adapters import SCRATCH_BUDGET, ArcpyAdapter, ArcpyMessageHandler
+from .engine import Project, evaluate_window, time_output, write_surface_model
+from .hypsometry import SLICES, hypsometry_tables, joint_histogram, slice_values, value_ranges
+from .instrument import Trace, window_size
+from .journal import RunJournal, stage_fingerprint
+from .polygons import POLYGON_FIELDS, polygon_records
+from .products import plan
+from .reach_index import INDEX_TILE_SIZE, open_reach_index
+from .statistics import STATISTICS_FIELDS, ReachStatistics
+from .wse import stage_data
+
+# Products of the Analysis tool when none are given
+ANALYSIS_PRODUCTS = ("DepthGrid", "Polygon", "Statistics")
+
+# Steps of each Analysis stage and the steps they need. Only the steps needed
+# for the requested products are run, so a statistics-only run never builds
+# depth grids or polygons.
+ANALYSIS_STEPS = {
+    "TIN": (),
+    "Surface": ("TIN",),
+    "Subtracted": ("Surface",),
+    "Extracted": ("Subtracted",),
+    "DepthGrid": ("Extracted",),
+    "Polygon": ("Surface",),
+    "Statistics": ("Surface",),
+}
+
+EXTENSIONS = [("3D", "3D Analyst"), ("spatial", "Spatial Analyst")]
+
+_arcpy = None
+_checked_out = set()
+
+
+def load_arcpy(extensions=()):
+    # arcpy, imported on first use, with the extensions checked out; each
+    # extension is only checked out once per process
+    global _arcpy
+    if _arcpy is None:
+        import arcpy
+        _arcpy = arcpy
+    for extension, label in EXTENSIONS:
+        if extension not in extensions or extension in _checked_out:
+            continue
+        if _arcpy.CheckOutExtension(extension) != "CheckedOut":
+            _arcpy.AddMessage("{0} not available".format(label))
+        else:
+            _arcpy.AddMessage("{0} checked out".format(label))
+            _checked_out.add(extension)
+    return _arcpy
+
+
+def _validate(arcpy, feature_class, field, label):
+    with arcpy.da.SearchCursor(feature_class, field) as cursor:
+        for row in cursor:
+            if row[0] == "" or row[0] is None:
+                message = "{0} feature class has Null values in the {1} field".format(label, field)
+                arcpy.AddError(message)
+                raise RuntimeError(message)
+
+
+def _join_stage_data(arcpy, cross_sections, table):
+    # Feature layer of cross_sections joined to the stage table
+    arcpy.AddMessage("Creating temporary feature layer for {0}".format(cross_sections))
+    layer = "New_Cross_Sections"
+    arcpy.MakeFeatureLayer_management(cross_sections, layer)
+    arcpy.AddMessage("Joining {0} and {1}".format(layer, table))
+    arcpy.AddJoin_management(layer, "XS_ID", table, "XS_ID", "KEEP_ALL")
+    return layer
+
+
+def _remove_join(arcpy, layer, table):
+    arcpy.RemoveJoin_management(layer, table)
+    arcpy.Delete_management(layer)
+
+
+def _tin_expression(reaches, layer, table, stage):
+    if stage == "MIN_Z_Value":
+        field = "MIN_Z_Value"
+    else:
+        field = "{0}.{1}".format(table, stage)
+    return "{0} <None> Soft_Clip <None>;{1} {2} Mass_Points <None>;{1} {2} Hard_Line <None>".format(
+        reaches, layer, field)
+
+
+def _finish(arcpy, trace, output_file_path, output_gdb_name):
+    # Write the trace and list the slowest steps
+    trace.write(os.path.join(output_file_path, "{0}_Trace.json".format(output_gdb_name)))
+    arcpy.AddMessage("")
+    for line in trace.summary():
+        arcpy.AddMessage(line)
+    arcpy.AddMessage("")
+    arcpy.AddMessage("Script finished")
+
+
+def create_inputs(out_location, name, input_raster, create_hillshade=False):
+    # Create Inputs: a file geodatabase with the DEM, an optional hillshade
+    # and empty Cross_Sections and Reaches feature classes to draw
+    arcpy = load_arcpy(["spatial"])
+    path = os.path.join(out_location, name + ".gdb")
+
+    arcpy.AddMessage("Creating File Geodatabase")
+    arcpy.CreateFileGDB_management(out_location, name)
+    arcpy.env.workspace = path
+
+    arcpy.AddMessage("Importing DEM")
+    arcpy.RasterToGeodatabase_conversion(input_raster, path)
+
+    if create_hillshade:
+        arcpy.AddMessage("Creating hillshade")
+        arcpy.sa.Hillshade(input_raster).save("Hillshade")
+
+    arcpy.AddMessage("Extracting spatial reference object from raster")
+    spatial_reference = arcpy.Describe(input_raster).spatialReference
+
+    arcpy.AddMessage("Creating Cross_Sections feature class")
+    arcpy.CreateFeatureclass_management(path, "Cross_Sections", "POLYLINE", "", "", "ENABLED",
+                                        spatial_reference)
+    arcpy.AddField_management("Cross_Sections", "XS_ID", "TEXT")
+
+    arcpy.AddMessage("Creating Reaches feature class")
+    arcpy.CreateFeatureclass_management(path, "Reaches", "POLYGON", "", "", "",
+                                        spatial_reference)
+    arcpy.AddField_management("Reaches", "ReachID", "TEXT")
+
+    arcpy.AddMessage("Script finished")
+    return path
+
+
+def get_wse(input_geodatabase, dem, cross_sections, offsets=(), percentiles=(), replace=False):
+    # Get WSE: creates or updates Stage_Data; an existing table keeps the rows
+    # of cross sections that were not added or edited since it was created.
+    # Fields added by hand under a generated name are only overwritten with
+    # replace.
+    arcpy = load_arcpy()
+    arcpy.env.workspace = input_geodatabase
+    _validate(arcpy, cross_sections, "XS_ID", "Cross_Sections")
+
+    arcpy.AddMessage("Creating Stage_Data table")
+    log = logging.getLogger("floodplain_mapper")
+    log.setLevel(logging.INFO)
+    if not any(isinstance(handler, ArcpyMessageHandler) for handler in log.handlers):
+        log.addHandler(ArcpyMessageHandler(arcpy))
+    workspace = ArcpyAdapter(input_geodatabase)
+    xs_features = workspace.read_features(cross_sections, "XS_ID")
+    stage_data(workspace, workspace.open_raster(dem), xs_features, "Stage_Data", offsets,
+               percentiles, replace=replace)
+
+    arcpy.AddMessage("")
+    arcpy.AddMessage("Script finished")
+
+
+def analysis(input_geodatabase, output_file_path, dem, cell_size, reaches, cross_sections, table,
+             stages, delete_intermediate_data=True, scratch_budget=SCRATCH_BUDGET,
+             products=ANALYSIS_PRODUCTS, simplify=None, output_gdb_name=None, resume=False):
+    # Run Analysis: depth grid, polygons and statistics of every stage in a
+    # new file geodatabase FMT_<time> in output_file_path, or output_gdb_name
+    # when given. Returns the output geodatabase's path.
+    arcpy = load_arcpy(["3D", "spatial"])
+    products = list(products)
+    if not delete_intermediate_data:
+        products = products + ["Subtracted"]
+    steps = plan(products, ANALYSIS_STEPS)
+
+    # Time and memory of every step, written to a JSON trace next to the output
+    trace = Trace()
+
+    # Create output geodatabase, or reopen it when resuming a run
+    if resume and output_gdb_name is None:
+        raise RuntimeError("Resuming a run needs the name of its output geodatabase")
+    named = output_gdb_name is not None
+    if not named:
+        output_gdb_name = "FMT_{0}".format(time_output())
+    output_gdb_path = os.path.join(output_file_path, output_gdb_name + ".gdb")
+    if not arcpy.Exists(output_gdb_path):
+        arcpy.CreateFileGDB_management(output_file_path, output_gdb_name)
+
+    # Journal of the completed stages, kept next to an output geodatabase
+    # given by name. A stage is recorded once all of its outputs are written,
+    # and a resumed run skips the recorded stages.
+    journal = None
+    if named:
+        settings = {"dem": dem, "cell_size": cell_size, "reaches": reaches,
+                    "cross_sections": cross_sections, "table": table,
+                    "products": sorted(products), "simplify": simplify}
+        journal = RunJournal.open(output_file_path, output_gdb_name, settings, resume)
+
+    arcpy.env.workspace = input_geodatabase
+    arcpy.env.overwriteOutput = True
+    _validate(arcpy, reaches, "ReachID", "Reaches")
+    _validate(arcpy, cross_sections, "XS_ID", "Cross_Sections")
+
+    # Snap output rasters to the DEM cells
+    arcpy.env.snapRaster = dem
+
+    # Open the reach label index, rebuilt only when Reaches or the grid changed
+    workspace = ArcpyAdapter(input_geodatabase)
+    with trace.step("reach_index"):
+        reach_features = workspace.read_features(reaches, "ReachID")
+        dem_grid = workspace.open_raster(dem).resample(cell_size)
+        reach_index = open_reach_index(workspace, reaches, reach_features, dem_grid)
+    dem_size = window_size(dem_grid.full_window())
+    reach_ids = [reach_id for reach_id, rings in reach_features]
+    reach_areas = dict(arcpy.da.SearchCursor(reaches, ["ReachID", "Shape_Area"]))
+    total_areas = [reach_areas[reach_id] for reach_id in reach_ids]
+
+    # The cross sections are triangulated once for each set of them that has
+    # values, and the DEM cells of each window are located in it once; every
+    # stage is then a weighted sum of its cross-section elevations, in place
+    # of a CreateTin_3d and TinTriangle_3d per stage. Cells outside Reaches
+    # stay NoData as with the Soft_Clip.
+    with trace.step("read_inputs"):
+        xs_features = workspace.read_features(cross_sections, "XS_ID")
+        project = Project(dem_grid, reach_features, xs_features, workspace.read_table(table),
+                          reach_index)
+
+    # Stages left to run; a resumed run skips those in the journal unless
+    # their Stage_Data values have changed since
+    pending = []
+    fingerprints = dict((stage, stage_fingerprint(project.stage_values(stage)))
+                        for stage in stages)
+    for stage in stages:
+        if journal is not None and journal.completed(stage, fingerprints[stage]):
+            arcpy.AddMessage("Skipping {0}, completed by an earlier run".format(stage))
+        else:
+            if journal is not None and journal.stale(stage, fingerprints[stage]):
+                arcpy.AddWarning("Stage_Data values of {0} changed since it was completed; "
+                                 "running it again".format(stage))
+            pending.append(stage)
+
+    # Every product is written once, straight into the output geodatabase.
+    # Intermediate rasters that are not kept (Subtracted, Reclassified and
+    # ExtractedRaster) live in memory while they fit within the scratch budget
+    # and in the scratch geodatabase otherwise; kept intermediates go to the
+    # output geodatabase like the products. The Subtracted raster (4 bytes a
+    # cell) and wet cells (2 bytes) of every stage are written in one pass
+    # over the DEM, then each stage adds its Reclassified and ExtractedRaster.
+    output = ArcpyAdapter(output_gdb_path)
+    write_surface_model(output, "tin")
+    scratch = ArcpyAdapter.scratch(dem_size["cells"] * (6 * len(pending) + 8), scratch_budget)
+    if delete_intermediate_data:
+        intermediate = scratch
+    else:
+        intermediate = output
+    arcpy.AddMessage("Keeping intermediate data in {0}".format(intermediate.workspace))
+
+    spatial_ref = arcpy.Describe(dem).spatialReference
+
+    # Subtract the water surface of every stage from the DEM window by window.
+    # Statistics for every reach are reduced from the same blocks, keyed by
+    # ReachID so reaches without inundated cells still get a row, and the wet
+    # cells are written to a scratch raster for tracing the polygons, so no
+    # whole-grid array is held in memory.
+    writers = {}
+    statistics = {}
+    for stage in pending:
+        if "Subtracted" in steps:
+            writers[(stage, "Subtracted")] = intermediate.create_raster(
+                "Subtracted_{0}".format(stage), dem_grid)
+        if not delete_intermediate_data:
+            writers[(stage, "RasterFromTIN")] = output.create_raster(
+                "RasterFromTIN_{0}".format(stage), dem_grid)
+        if "Polygon" in steps:
+            writers[(stage, "WetCells")] = scratch.create_raster(
+                "WetCells_{0}".format(stage), dem_grid, np.uint8)
+        if "Statistics" in steps:
+            statistics[stage] = ReachStatistics(len(reach_features))
+    if pending:
+        arcpy.AddMessage("Subtracting the TIN surface from the input DEM for {0}".format(
+            ", ".join(pending)))
+        with trace.step("Surface", stages=len(pending), **dem_size):
+            for window in dem_grid.windows(INDEX_TILE_SIZE):
+                for stage, labels, surface, subtracted, depth in \
+                        evaluate_window(project, pending, window):
+                    blocks = {"Subtracted": subtracted, "RasterFromTIN": surface,
+                              "WetCells": (~np.isnan(depth)).astype(np.uint8)}
+                    for product in blocks:
+                        if (stage, product) in writers:
+                            writers[(stage, product)].write(window, blocks[product])
+                    if stage in statistics:
+                        statistics[stage].add(labels, depth)
+            for writer in writers.values():
+                writer.close()
+
+    for stage in pending:
+        arcpy.AddMessage("")
+        # Outputs are written under a temporary name and renamed once
+        # complete, so a failed run never leaves a partial output under its
+        # final name
+        outputs = []
+        # Temporary data, named per stage so stages never share scratch
+        # datasets
+        subtracted_raster = intermediate.path("Subtracted_{0}".format(stage))
+        reclassified = intermediate.path("Reclassified_{0}".format(stage))
+        extracted_raster = intermediate.path("ExtractedRaster_{0}".format(stage))
+        wet_cells = "WetCells_{0}".format(stage)
+        temporary = [scratch.path(wet_cells)]
+
+        if "Statistics" in steps:
+            arcpy.AddMessage("Creating output table for {0}".format(stage))
+            table_name = "{0}_Statistics".format(stage)
+            with trace.step("Statistics", stage=stage):
+                rows = statistics.pop(stage).rows(reach_ids, total_areas, cell_size)
+                output.write_table(table_name + "_Partial", STATISTICS_FIELDS, rows)
+            outputs.append(table_name)
+
+        if "Extracted" in steps:
+            arcpy.AddMessage("Reclassifing the subtracted raster for {0}".format(stage))
+            with trace.step("Reclassify_3d", stage=stage, **dem_size):
+                arcpy.Reclassify_3d(subtracted_raster, "Value", "-999 0.01 1;0.01 999 0",
+                                    reclassified, "DATA")
+
+            arcpy.AddMessage("Extracting by attributes for {0}".format(stage))
+            with trace.step("ExtractByAttributes", stage=stage, **dem_size):
+                arcpy.gp.ExtractByAttributes_sa(reclassified, "\"Value\" = 0",
+                                                extracted_raster)
+
+        if "DepthGrid" in steps:
+            arcpy.AddMessage("Creating depthgrid for {0}".format(stage))
+            depth_grid_name = "{0}_DepthGrid".format(stage)
+            with trace.step("ExtractByMask", stage=stage, **dem_size):
+                extracted = arcpy.sa.ExtractByMask(subtracted_raster, extracted_raster)
+                extracted.save(output.path(depth_grid_name + "_Partial"))
+            outputs.append(depth_grid_name)
+
+        if "Polygon" in steps:
+            # Trace one polygon per reach from the wet cells, in place of
+            # RasterToPolygon and an Intersect with Reaches
+            arcpy.AddMessage("Tracing inundation polygons for {0}".format(stage))
+            polygon_name = "{0}_Polygon".format(stage)
+            with trace.step("Polygon", stage=stage, **dem_size):
+                records = polygon_records(project, scratch.open_raster(wet_cells), simplify)
+                output.write_features(polygon_name + "_Partial", POLYGON_FIELDS, records,
+                                      spatial_ref)
+            outputs.append(polygon_name)
+
+        for name in outputs:
+            output.rename(name + "_Partial", name)
+        if journal is not None:
+            journal.record(stage, outputs, fingerprints[stage])
+
+        arcpy.AddMessage("Deleting temporary files for {0}".format(stage))
+        if delete_intermediate_data:
+            temporary += [subtracted_raster, reclassified, extracted_raster]
+        for dataset in temporary:
+            if arcpy.Exists(dataset):
+                arcpy.Delete_management(dataset)
+
+    _finish(arcpy, trace, output_file_path, output_gdb_name)
+    return output_gdb_path
+
+
+def hypsometry(input_geodatabase, output_file_path, dem, cell_size, reaches, cross_sections, table,
+               stage, delete_intermediate_data=True, slices=SLICES, scratch_budget=SCRATCH_BUDGET):
+    # Hypsometry: the normalized grid (DEM minus the water surface) of one
+    # stage, its Hypsometry slice raster and the Hypsometry_all table in a
+    # new file geodatabase FMT_<time>. Returns the output geodatabase's path.
+    arcpy = load_arcpy(["3D", "spatial"])
+
+    # Time and memory of every step, written to a JSON trace next to the output
+    trace = Trace()
+
+    output_gdb_name = "FMT_{0}".format(time_output())
+    output_gdb_path = os.path.join(output_file_path, output_gdb_name + ".gdb")
+    arcpy.CreateFileGDB_management(output_file_path, output_gdb_name)
+
+    arcpy.env.workspace = input_geodatabase
+    arcpy.env.overwriteOutput = True
+    # Snap output rasters to the DEM cells
+    arcpy.env.snapRaster = dem
+    _validate(arcpy, reaches, "ReachID", "Reaches")
+    _validate(arcpy, cross_sections, "XS_ID", "Cross_Sections")
+
+    spatial_ref = arcpy.Describe(dem).spatialReference
+    layer = _join_stage_data(arcpy, cross_sections, table)
+    arcpy.AddMessage("")
+
+    # Every product is written once, straight into the output geodatabase.
+    # RasterFromTIN and Subtracted live in memory while they fit within the
+    # scratch budget and in the scratch geodatabase otherwise, unless they are
+    # kept, in which case they go to the output geodatabase.
+    workspace = ArcpyAdapter(input_geodatabase)
+    output = ArcpyAdapter(output_gdb_path)
+    dem_grid = workspace.open_raster(dem).resample(cell_size)
+    if delete_intermediate_data:
+        intermediate = ArcpyAdapter.scratch(dem_grid.rows * dem_grid.cols * 4 * 2, scratch_budget)
+    else:
+        intermediate = output
+
+    # Temporary data
+    tin = os.path.join(arcpy.env.scratchFolder, "TIN")
+    raster_from_tin = intermediate.path("RasterFromTIN_{0}".format(stage))
+    subtracted = intermediate.path("Subtracted_{0}".format(stage))
+
+    try:
+        arcpy.AddMessage("Creating TIN for {0}".format(stage))
+        with trace.step("CreateTin_3d", stage=stage):
+            arcpy.CreateTin_3d(tin, spatial_ref, _tin_expression(reaches, layer, table, stage),
+                               "CONSTRAINED_DELAUNAY")
+
+        arcpy.AddMessage("Converting TIN to raster for {0}".format(stage))
+        with trace.step("TinRaster_3d", stage=stage):
+            arcpy.TinRaster_3d(tin, raster_from_tin, "FLOAT", "LINEAR",
+                               "CELLSIZE {0}".format(cell_size), "1")
+
+        arcpy.AddMessage("Subtracting the raster from TIN with the input DEM for {0}".format(
+            stage))
+        with trace.step("Minus_3d", stage=stage):
+            arcpy.Minus_3d(raster_from_tin, dem, subtracted)
+
+        # Reverse values
+        normalized_name = "{0}_Normalized".format(stage)
+        with trace.step("Times_3d", stage=stage):
+            arcpy.Times_3d(subtracted, -1, output.path(normalized_name))
+    finally:
+        _remove_join(arcpy, layer, table)
+
+    # Bin the normalized grid into a slice histogram for all reaches together
+    # and for each reach over its own range of values. It is read window by
+    # window: one pass finds the value ranges, and a second fills the
+    # histogram and writes the Hypsometry slice raster, as Slice_3d did.
+    arcpy.AddMessage("Calculating hypsometry for {0}".format(stage))
+    with trace.step("reach_index"):
+        reach_features = workspace.read_features(reaches, "ReachID")
+        reach_ids = [reach_id for reach_id, rings in reach_features]
+        reach_index = open_reach_index(workspace, reaches, reach_features, dem_grid)
+    normalized = output.open_raster(normalized_name)
+
+    def blocks(writer=None):
+        for window in normalized.windows(INDEX_TILE_SIZE):
+            values = normalized.read(window)
+            if writer is not None:
+                # Zones numbered from 1 over the range of all reaches; 0 is
+                # NoData
+                valid = ~np.isnan(values)
+                zones = slice_values(np.where(valid, values, low[0]), low[0], high[0], slices)
+                writer.write(window, np.where(valid, zones, 0))
+            yield reach_index.labels_for(normalized, window), values
+
+    with trace.step("Hypsometry", stage=stage, slices=slices,
+                    **window_size(normalized.full_window())):
+        low, high = value_ranges(blocks(), len(reach_ids))
+        if low[0] > high[0]:
+            raise RuntimeError("Water surface for {0} does not overlap the DEM".format(stage))
+        writer = output.create_raster("Hypsometry", normalized, np.int16)
+        counts = joint_histogram(blocks(writer), low, high, slices)
+        writer.close()
+
+    # The Hypsometry raster's attribute table gets the Percent_Elevation,
+    # Cumulative and Percent_Area fields of each slice, and Hypsometry_all is
+    # written in one insert
+    with trace.step("write_tables"):
+        rows, all_fields, all_rows = hypsometry_tables(reach_ids, counts)
+        hypsometry_raster = output.path("Hypsometry")
+        arcpy.SetRasterProperties_management(hypsometry_raster, nodata="1 0")
+        arcpy.BuildRasterAttributeTable_management(hypsometry_raster, "Overwrite")
+        arcpy.AddField_management(hypsometry_raster, "Percent_Elevation", "FLOAT")
+        arcpy.AddField_management(hypsometry_raster, "Cumulative", "LONG")
+        arcpy.AddField_management(hypsometry_raster, "Percent_Area", "FLOAT")
+        slice_rows = dict((row[0], row) for row in rows)
+        with arcpy.da.UpdateCursor(hypsometry_raster, ["Value", "Percent_Elevation",
+                                                       "Cumulative", "Percent_Area"]) as cursor:
+            for row in cursor:
+                value, count, percent_elevation, cumulative, percent_area = \
+                    slice_rows[int(row[0])]
+                cursor.updateRow([row[0], percent_elevation, cumulative, percent_area])
+        output.write_table("Hypsometry_all", all_fields, all_rows)
+
+    arcpy.AddMessage("Deleting temporary files for {0}".format(stage))
+    arcpy.Delete_management(tin)
+    if delete_intermediate_data:
+        arcpy.Delete_management(raster_from_tin)
+        arcpy.Delete_management(subtracted)
+
+    _finish(arcpy, trace, output_file_path, output_gdb_name)
+    return output_gdb_path
@@ -0,0 +1,391 @@
+# Floodplain Mapper Toolbox 1.3
+# Delaunay triangulation of cross-section vertices and linear TIN interpolation
+
+from __future__ import division
+
+import numpy as np
+
+# Times missing cross-section segments are split before the triangulation
+# is used as it is
+CONFORMING_ROUNDS = 8
+
+
+# Bits of each coordinate in the Hilbert curve that orders insertions
+HILBERT_BITS = 16
+
+# Corners of the triangle enclosing every point, in normalized coordinates
+SUPER_TRIANGLE = ((-100.0, -100.0), (100.0, -100.0), (0.0, 100.0))
+
+# Length of the table of random first edges tried by the point location walk
+WALK_TABLE = 4099
+
+
+def _hilbert_order(points, bits=HILBERT_BITS):
+    # Order of points along a Hilbert curve over their bounding box, so each
+    # inserted point lies close to the one before it
+    side = 1 << bits
+    low = points.min(axis=0)
+    scale = max(np.ptp(points, axis=0).max(), 1e-12)
+    xy = np.floor((points - low) / scale * (side - 1)).astype(np.int64)
+    x = xy[:, 0]
+    y = xy[:, 1]
+    d = np.zeros(len(points), dtype=np.int64)
+    s = side // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        flip = ~ry & rx
+        x = np.where(flip, side - 1 - x, x)
+        y = np.where(flip, side - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s //= 2
+    return np.argsort(d, kind="mergesort")
+
+
+class _Triangulation(object):
+    """Incremental Bowyer-Watson Delaunay triangulation.
+
+    Vertices 0-2 are the corners of SUPER_TRIANGLE and every added point
+    follows. Triangles are counterclockwise vertex triples, and neighbors[t][i]
+    is the triangle across the edge opposite vertex i (-1 outside). A new
+    point is located by walking from the last triangle created towards it,
+    and the triangles whose circumcircle holds it are found by spreading
+    from there through neighbors, so each insertion only touches the
+    triangles around the point.
+    """
+
+    def __init__(self):
+        self.x = [corner[0] for corner in SUPER_TRIANGLE]
+        self.y = [corner[1] for corner in SUPER_TRIANGLE]
+        self.vertices = [(0, 1, 2)]
+        self.neighbors = [[-1, -1, -1]]
+        self.last = 0
+        # Random first edges for the walk, used in turn
+        self.first_edges = np.random.RandomState(0).randint(0, 3, WALK_TABLE).tolist()
+        self.step = 0
+
+    def _orient(self, a, b, px, py):
+        # Positive when the point is to the left of the edge a-b
+        x = self.x
+        y = self.y
+        return (x[b] - x[a]) * (py - y[a]) - (y[b] - y[a]) * (px - x[a])
+
+    def _in_circle(self, t, px, py):
+        a, b, c = self.vertices[t]
+        x = self.x
+        y = self.y
+        adx = x[a] - px
+        ady = y[a] - py
+        bdx = x[b] - px
+        bdy = y[b] - py
+        cdx = x[c] - px
+        cdy = y[c] - py
+        return ((adx * adx + ady * ady) * (bdx * cdy - cdx * bdy) +
+                (bdx * bdx + bdy * bdy) * (cdx * ady - adx * cdy) +
+                (cdx * cdx + cdy * cdy) * (adx * bdy - bdx * ady)) > 0
+
+    def _locate(self, px, py):
+        # Remembering stochastic walk: the edges are tried from a random one
+        # and the edge just crossed is skipped, which ends even where
+        # rounding left the triangulation not quite Delaunay
+        t = self.last
+        previous = -1
+        vertices = self.vertices
+        neighbors = self.neighbors
+        while True:
+            corners = vertices[t]
+            first = self.first_edges[self.step % WALK_TABLE]
+            self.step += 1
+            for step in range(3):
+                i = (first + step) % 3
+                across = neighbors[t][i]
+                if across == previous or across < 0:
+                    continue
+                if self._orient(corners[(i + 1) % 3], corners[(i + 2) % 3], px, py) < 0:
+                    previous = t
+                    t = across
+                    break
+            else:
+                return t
+
+    def add(self, px, py):
+        # Insert a point and return its vertex number
+        v = len(self.x)
+        self.x.append(px)
+        self.y.append(py)
+        vertices = self.vertices
+        neighbors = self.neighbors
+        start = self._locate(px, py)
+        # Triangles whose circumcircle holds the point, and the edges around
+        # them with the triangle outside each. A neighbor is also taken in
+        # when the point is not strictly inside the edge, so no new triangle
+        # is flat or turned over by rounding.
+        cavity = [start]
+        taken = set(cavity)
+        boundary = []
+        pending = [start]
+        while pending:
+            t = pending.pop()
+            corners = vertices[t]
+            for i in range(3):
+                outside = neighbors[t][i]
+                if outside in taken:
+                    continue
+                a = corners[(i + 1) % 3]
+                b = corners[(i + 2) % 3]
+                if outside >= 0 and (self._orient(a, b, px, py) <= 0 or
+                                     self._in_circle(outside, px, py)):
+                    taken.add(outside)
+                    cavity.append(outside)
+                    pending.append(outside)
+                else:
+                    boundary.append((a, b, outside))
+        # A fan of new triangles from the point to the boundary edges, reusing
+        # the cavity's slots
+        slots = cavity + list(range(len(vertices), len(vertices) + len(boundary) - len(cavity)))
+        starting = {}
+        ending = {}
+        for slot, (a, b, outside) in zip(slots, boundary):
+            starting[a] = slot
+            ending[b] = slot
+        for slot, (a, b, outside) in zip(slots, boundary):
+            triangle = (a, b, v)
+            links = [starting[b], ending[a], outside]
+            if slot < len(vertices):
+                vertices[slot] = triangle
+                neighbors[slot] = links
+            else:
+                vertices.append(triangle)
+                neighbors.append(links)
+            if outside >= 0:
+                # Point the triangle outside at its new neighbor
+                for j, corner in enumerate(vertices[outside]):
+                    if corner != a and corner != b:
+                        neighbors[outside][j] = slot
+        self.last = slots[0]
+        return v
+
+    def triangles(self):
+        # (n, 3) array of added point numbers (vertex number - 3), leaving out
+        # the triangles on the corners of SUPER_TRIANGLE
+        triangles = np.array(self.vertices, dtype=np.intp).reshape(-1, 3)
+        return triangles[(triangles >= 3).all(axis=1)] - 3
+
+
+def _distinct(points):
+    # Index of the first occurrence of each point's coordinates
+    order = np.lexsort((points[:, 1], points[:, 0]))
+    distinct = np.ones(len(points), dtype=bool)
+    distinct[1:] = (np.diff(points[order], axis=0) != 0).any(axis=1)
+    first = np.empty(len(points), dtype=np.intp)
+    first[order] = order[np.flatnonzero(distinct)[np.cumsum(distinct) - 1]]
+    return first
+
+
+class _Builder(object):
+    """Triangulation of a growing set of points in their original numbering.
+
+    Coordinates are normalized by the first points' bounding box so the
+    circumcircle test stays well conditioned for projected coordinates in
+    the millions. Duplicate points are merged onto their first occurrence.
+    """
+
+    def __init__(self, points):
+        self.first = _distinct(points)
+        unique = np.flatnonzero(self.first == np.arange(len(points)))
+        self.center = (points[unique].min(axis=0) + points[unique].max(axis=0)) / 2.0 \
+            if len(unique) else np.zeros(2)
+        self.scale = max(np.ptp(points[unique], axis=0).max(), 1e-12) if len(unique) else 1.0
+        self.triangulation = _Triangulation()
+        self.point_of = []
+        self.vertex_of = {}
+        if len(unique) >= 3:
+            self.add(points, unique[_hilbert_order(points[unique])])
+
+    def add(self, points, indexes):
+        # Insert points[indexes]; a point at the coordinates of one already
+        # inserted is merged onto it
+        normalized = ((points[indexes] - self.center) / self.scale).tolist()
+        for index, (px, py) in zip(indexes.tolist(), normalized):
+            if (px, py) in self.vertex_of:
+                continue
+            self.vertex_of[(px, py)] = index
+            self.triangulation.add(px, py)
+            self.point_of.append(index)
+
+    def merged(self, points, indexes):
+        # Point each of points[indexes] was merged onto
+        normalized = ((points[indexes] - self.center) / self.scale).tolist()
+        return np.array([self.vertex_of.get((px, py), index)
+                         for index, (px, py) in zip(indexes.tolist(), normalized)],
+                        dtype=np.intp)
+
+    def triangles(self):
+        triangles = self.triangulation.triangles()
+        if not len(self.point_of) or not len(triangles):
+            return np.zeros((0, 3), dtype=np.intp)
+        return np.array(self.point_of, dtype=np.intp)[triangles]
+
+
+def delaunay(points):
+    # Bowyer-Watson insertion in Hilbert order; returns an (n, 3) array of
+    # vertex indices into points. Duplicate points are merged onto their
+    # first occurrence.
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    return _Builder(points).triangles()
+
+
+def conforming_delaunay(points, segments, rounds=CONFORMING_ROUNDS):
+    # Delaunay triangulation in which every segment, a pair of indices into
+    # points, is covered by triangle edges. Segments missing from the
+    # triangulation are split at their midpoint, which is inserted into the
+    # same triangulation, for at most rounds rounds (crossing segments can
+    # never both be edges). Returns the points with the midpoints appended,
+    # the triangles and, for every point, the index of the original point it
+    # was split from, so midpoints can take the values of their segment.
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    segments = np.asarray(segments, dtype=np.intp).reshape(-1, 2)
+    source = np.arange(len(points))
+    # Zero-length segments are always present
+    segments = segments[(points[segments[:, 0]] != points[segments[:, 1]]).any(axis=1)]
+    builder = _Builder(points)
+    # Segment ends as inserted, after duplicates are merged
+    ends = builder.first[segments]
+    for split_round in range(rounds + 1):
+        triangles = builder.triangles()
+        if not len(segments) or not len(triangles):
+            break
+        n = len(points)
+        edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]],
+                                triangles[:, [2, 0]]])
+        edge_keys = np.unique(edges.min(axis=1) * n + edges.max(axis=1))
+        missing = ~np.isin(ends.min(axis=1) * n + ends.max(axis=1), edge_keys)
+        if not missing.any() or split_round == rounds:
+            break
+        split = segments[missing]
+        split_ends = ends[missing]
+        added = np.arange(n, n + len(split))
+        points = np.vstack([points, (points[split[:, 0]] + points[split[:, 1]]) / 2.0])
+        source = np.concatenate([source, source[split[:, 0]]])
+        builder.add(points, added)
+        middle = builder.merged(points, added)
+        segments = np.vstack([segments[~missing], np.column_stack([split[:, 0], added]),
+                              np.column_stack([added, split[:, 1]])])
+        ends = np.vstack([ends[~missing], np.column_stack([split_ends[:, 0], middle]),
+                          np.column_stack([middle, split_ends[:, 1]])])
+    return points, triangles, source
+
+
+def _expand(starts, counts):
+    # Owner index and value of every integer in the ranges
+    # [starts[i], starts[i] + counts[i])
+    total = int(counts.sum())
+    owner = np.repeat(np.arange(len(counts)), counts)
+    offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, starts[owner] + offset
+
+
+def barycentric_weights(points, triangles, grid, window=None, mask=None):
+    # Locate the cell centers of grid (or of one window of it) in the
+    # triangulation. Returns the flat cell indices within the window that are
+    # covered, the three vertex indices of the containing triangle and the
+    # matching barycentric weights, so any set of vertex values can later be
+    # interpolated with one weighted sum. With mask, a boolean block of the
+    # window, only the cells it marks are located.
+    points = np.asarray(points, dtype=float)
+    cs = grid.cell_size
+    window_row_start, window_row_stop, window_col_start, window_col_stop = \
+        window or grid.full_window()
+    window_cols = window_col_stop - window_col_start
+    empty = (np.zeros(0, dtype=np.intp), np.zeros((0, 3), dtype=np.intp), np.zeros((0, 3)))
+
+    # Skip triangles whose bounding box misses the window, and zero-area ones
+    corners = points[triangles]
+    x_min = grid.x_min + window_col_start * cs
+    x_max = grid.x_min + window_col_stop * cs
+    y_max = grid.y_max - window_row_start * cs
+    y_min = grid.y_max - window_row_stop * cs
+    pa, pb, pc = corners[:, 0], corners[:, 1], corners[:, 2]
+    det = (pb[:, 1] - pc[:, 1]) * (pa[:, 0] - pc[:, 0]) + \
+        (pc[:, 0] - pb[:, 0]) * (pa[:, 1] - pc[:, 1])
+    keep = ((corners[:, :, 0].max(axis=1) >= x_min) & (corners[:, :, 0].min(axis=1) <= x_max) &
+            (corners[:, :, 1].max(axis=1) >= y_min) & (corners[:, :, 1].min(axis=1) <= y_max) &
+            (np.abs(det) >= 1e-12))
+    if mask is not None:
+        # Also skip triangles whose bounding box, widened by a cell, holds no
+        # cell of the mask, counted from a summed-area table
+        rows, cols = mask.shape
+        summed = np.zeros((rows + 1, cols + 1), dtype=np.intp)
+        summed[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+        top = np.clip(np.floor((grid.y_max - corners[:, :, 1].max(axis=1)) / cs - 0.5) -
+                      window_row_start, 0, rows).astype(np.intp)
+        bottom = np.clip(np.ceil((grid.y_max - corners[:, :, 1].min(axis=1)) / cs - 0.5) -
+                         window_row_start + 1, 0, rows).astype(np.intp)
+        left = np.clip(np.floor((corners[:, :, 0].min(axis=1) - grid.x_min) / cs - 0.5) -
+                       window_col_start, 0, cols).astype(np.intp)
+        right = np.clip(np.ceil((corners[:, :, 0].max(axis=1) - grid.x_min) / cs - 0.5) -
+                        window_col_start + 1, 0, cols).astype(np.intp)
+        keep &= (summed[bottom, right] - summed[top, right] - summed[bottom, left] +
+                 summed[top, left]) > 0
+    triangles = triangles[keep]
+    corners = corners[keep]
+    det = det[keep]
+    if not len(triangles):
+        return empty
+
+    # Scanlines: every (triangle, row) pair whose row center lies within the
+    # triangle's y range
+    y_low = corners[:, :, 1].min(axis=1)
+    y_high = corners[:, :, 1].max(axis=1)
+    first = np.maximum(np.ceil((grid.y_max - y_high) / cs - 0.5).astype(np.intp), window_row_start)
+    last = np.minimum(np.floor((grid.y_max - y_low) / cs - 0.5).astype(np.intp),
+                      window_row_stop - 1)
+    triangle, row = _expand(first, np.maximum(last - first + 1, 0))
+    y = grid.y_max - (row + 0.5) * cs
+
+    # x extent of each scanline from the edges it crosses, widened slightly so
+    # cells exactly on an edge are kept by the inside test below
+    span_low = np.full(len(row), np.inf)
+    span_high = np.full(len(row), -np.inf)
+    for start, stop in ((0, 1), (1, 2), (2, 0)):
+        x0, y0 = corners[triangle, start, 0], corners[triangle, start, 1]
+        x1, y1 = corners[triangle, stop, 0], corners[triangle, stop, 1]
+        crosses = (np.minimum(y0, y1) <= y) & (y <= np.maximum(y0, y1))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x = np.where(y1 != y0, x0 + (y - y0) * (x1 - x0) / (y1 - y0), np.minimum(x0, x1))
+            x_other = np.where(y1 != y0, x, np.maximum(x0, x1))
+        span_low = np.where(crosses, np.minimum(span_low, x), span_low)
+        span_high = np.where(crosses, np.maximum(span_high, x_other), span_high)
+    tolerance = 1e-9 * cs
+    col_start = np.ceil((span_low - tolerance - grid.x_min) / cs - 0.5)
+    col_stop = np.floor((span_high + tolerance - grid.x_min) / cs - 0.5) + 1
+    valid = np.isfinite(col_start) & np.isfinite(col_stop)
+    col_start = np.where(valid, np.maximum(col_start, window_col_start), 0).astype(np.intp)
+    col_stop = np.where(valid, np.minimum(col_stop, window_col_stop), 0).astype(np.intp)
+    span, col = _expand(col_start, np.maximum(col_stop - col_start, 0))
+    if not len(col):
+        return empty
+    triangle = triangle[span]
+    row = row[span]
+    if mask is not None:
+        marked = mask[row - window_row_start, col - window_col_start]
+        triangle = triangle[marked]
+        row = row[marked]
+        col = col[marked]
+
+    # Barycentric weights of every candidate cell at once
+    x = grid.x_min + (col + 0.5) * cs
+    y = grid.y_max - (row + 0.5) * cs
+    pa, pb, pc = corners[triangle, 0], corners[triangle, 1], corners[triangle, 2]
+    det = det[triangle]
+    wa = ((pb[:, 1] - pc[:, 1]) * (x - pc[:, 0]) + (pc[:, 0] - pb[:, 0]) * (y - pc[:, 1])) / det
+    wb = ((pc[:, 1] - pa[:, 1]) * (x - pc[:, 0]) + (pa[:, 0] - pc[:, 0]) * (y - pc[:, 1])) / det
+    wc = 1.0 - wa - wb
+    inside = (wa >= -1e-9) & (wb >= -1e-9) & (wc >= -1e-9)
+    cells = (row[inside] - window_row_start) * window_cols + col[inside] - window_col_start
+    vertices = triangles[triangle[inside]]
+    weights = np.column_stack([wa[inside], wb[inside], wc[inside]])
+    # Cells on a shared edge were found by both triangles; keep one
+    cells, keep = np.unique(cells, return_index=True)
+    return cells, vertices[keep], weights[keep]
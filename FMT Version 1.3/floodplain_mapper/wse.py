@@ -0,0 +1,228 @@
+# Floodplain Mapper Toolbox 1.3
+# Cross-section elevation sampling and Stage_Data generation for Get WSE
+#
+# Every Cross_Sections polyline is densified to the DEM cell size and all
+# vertices are gathered from the DEM together, one tile at a time, so the
+# minimum (and any percentile) elevation of thousands of sections costs one
+# pass over the DEM. Stage_Data is written in one go with MIN_Z_Value and a
+# ladder of stages at fixed offsets above it. A {table}_Sampled table keeps a
+# fingerprint of each section's geometry, so rerunning only samples the
+# sections that were added or edited and keeps every other row as it was. A
+# {table}_Generated table lists the columns Get WSE wrote, so a rerun never
+# overwrites a column entered by hand and drops generated columns that are
+# no longer asked for.
+
+from __future__ import division
+
+import hashlib
+import logging
+import math
+
+import numpy as np
+
+from .geometry import densify
+from .instrument import step
+from .reach_index import INDEX_TILE_SIZE
+
+log = logging.getLogger(__name__)
+
+SAMPLED_FIELDS = [
+    ("XS_ID", "TEXT"),
+    ("Fingerprint", "TEXT"),
+]
+
+GENERATED_FIELDS = [
+    ("Field", "TEXT"),
+]
+
+# Name the tables are written under until all three are complete
+PARTIAL_NAME = "{0}_Partial"
+
+
+def percentile_field(percentile):
+    return "P{0}_Z_Value".format("{0:g}".format(percentile).replace(".", "_"))
+
+
+def stage_field(offset):
+    # Stage_Data column of MIN_Z_Value plus offset, e.g. Stage_0_5
+    return "Stage_{0}".format("{0:g}".format(offset).replace(".", "_").replace("-", "Minus"))
+
+
+def xs_fingerprint(parts, grid):
+    digest = hashlib.sha1()
+    header = (grid.x_min, grid.y_max, grid.cell_size, grid.rows, grid.cols)
+    digest.update(repr(header).encode("utf-8"))
+    for part in parts:
+        digest.update(np.asarray(part, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def sample_cross_sections(grid, cross_sections, percentiles=(), tile_size=INDEX_TILE_SIZE):
+    # Minimum and percentile DEM values under each cross section, sampled at
+    # the cells of its vertices densified to the cell size. Returns an
+    # (n, 1 + len(percentiles)) array, NaN for sections off the DEM.
+    owners = []
+    vertices = []
+    for index, (xs_id, parts) in enumerate(cross_sections):
+        for part in parts:
+            points = densify(part, grid.cell_size)
+            vertices.append(points.reshape(-1, 2))
+            owners.append(np.full(len(points), index, dtype=np.intp))
+    result = np.full((len(cross_sections), 1 + len(percentiles)), np.nan)
+    if not vertices:
+        return result
+    points = np.vstack(vertices)
+    owner = np.concatenate(owners)
+    rows = np.floor((grid.y_max - points[:, 1]) / grid.cell_size).astype(np.intp)
+    cols = np.floor((points[:, 0] - grid.x_min) / grid.cell_size).astype(np.intp)
+    on_grid = (rows >= 0) & (rows < grid.rows) & (cols >= 0) & (cols < grid.cols)
+
+    # Gather every vertex of a tile from one block read
+    values = np.full(len(points), np.nan)
+    tiles = (rows // tile_size) * int(math.ceil(grid.cols / tile_size)) + cols // tile_size
+    tiles = np.where(on_grid, tiles, -1)
+    for tile in np.unique(tiles[on_grid]):
+        take = np.flatnonzero(tiles == tile)
+        row_start = rows[take[0]] // tile_size * tile_size
+        col_start = cols[take[0]] // tile_size * tile_size
+        window = (row_start, min(row_start + tile_size, grid.rows),
+                  col_start, min(col_start + tile_size, grid.cols))
+        block = grid.read(window)
+        values[take] = block[rows[take] - row_start, cols[take] - col_start]
+
+    # Sort by section then value; each section's statistics are then read
+    # off its run of sorted values
+    valid = ~np.isnan(values)
+    owner = owner[valid]
+    values = values[valid]
+    order = np.lexsort((values, owner))
+    owner = owner[order]
+    values = values[order]
+    starts = np.searchsorted(owner, np.arange(len(cross_sections)), side="left")
+    stops = np.searchsorted(owner, np.arange(len(cross_sections)), side="right")
+    sampled = stops > starts
+    result[sampled, 0] = values[starts[sampled]]
+    for column, percentile in enumerate(percentiles):
+        # Linear interpolation between ranks, as numpy.percentile
+        position = starts[sampled] + (stops[sampled] - starts[sampled] - 1) * percentile / 100.0
+        low = np.floor(position).astype(np.intp)
+        high = np.ceil(position).astype(np.intp)
+        result[sampled, column + 1] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+def _field_type(values):
+    for value in values:
+        if value is None:
+            continue
+        try:
+            float(value)
+        except (TypeError, ValueError):
+            return "TEXT"
+    return "FLOAT"
+
+
+def stage_data(adapter, grid, cross_sections, table="Stage_Data", offsets=(), percentiles=(),
+               update=True, tile_size=INDEX_TILE_SIZE, replace=False):
+    # Writes table with XS_ID, MIN_Z_Value, the percentile columns and one
+    # column per offset above MIN_Z_Value. With update, rows of sections whose
+    # geometry is unchanged since the last run are kept as they are, including
+    # any stage columns added by hand. A column added by hand under the name
+    # of a generated column is refused unless replace is given.
+    sampled_table = "{0}_Sampled".format(table)
+    generated_table = "{0}_Generated".format(table)
+    existing = {}
+    fields = []
+    fingerprints = {}
+    # MIN_Z_Value has always been written by Get WSE
+    generated = set(["MIN_Z_Value"])
+    if adapter.exists(table):
+        rows = adapter.read_table(table)
+        existing = dict((str(row["XS_ID"]), row) for row in rows)
+        fields = [field for field in (rows[0] if rows else {}) if field != "XS_ID"]
+        # A table from an earlier version of Get WSE has no fingerprints, so
+        # every section is sampled again
+        if update and adapter.exists(sampled_table):
+            fingerprints = dict((str(row["XS_ID"]), row["Fingerprint"])
+                                for row in adapter.read_table(sampled_table))
+        if adapter.exists(generated_table):
+            generated.update(str(row["Field"]) for row in adapter.read_table(generated_table))
+
+    sampled_fields = ["MIN_Z_Value"] + [percentile_field(p) for p in percentiles] + \
+        [stage_field(offset) for offset in offsets]
+    clashes = [field for field in sampled_fields if field in fields and field not in generated]
+    if clashes and not replace:
+        raise RuntimeError("{0} already has {1} fields that were not created by Get WSE; rename "
+                           "them, or replace them explicitly".format(table, ", ".join(clashes)))
+    # Generated columns that are no longer asked for would go stale as
+    # sections are sampled again, so they are dropped
+    dropped = [field for field in fields if field in generated and field not in sampled_fields]
+    if dropped:
+        log.info("Dropping {0} from {1}".format(", ".join(dropped), table))
+    fields = sampled_fields + [field for field in fields
+                               if field not in sampled_fields and field not in generated and
+                               not field.startswith("OBJECTID")]
+
+    # Replaced columns are sampled again for every section
+    keys = [xs_fingerprint(parts, grid) for xs_id, parts in cross_sections]
+    changed = [index for index, (xs_id, parts) in enumerate(cross_sections)
+               if clashes or fingerprints.get(str(xs_id)) != keys[index] or
+               any(existing.get(str(xs_id), {}).get(field) is None for field in sampled_fields)]
+    log.info("Sampling {0} of {1} cross sections from the DEM".format(
+        len(changed), len(cross_sections)))
+    with step("sample_cross_sections", cross_sections=len(changed)):
+        samples = sample_cross_sections(grid, [cross_sections[index] for index in changed],
+                                        percentiles, tile_size)
+
+    # Stage ladder of every changed section as one array
+    ladder = samples[:, :1] + np.asarray(offsets, dtype=float).reshape(1, -1)
+    values = np.hstack([samples, ladder])
+    new_rows = {}
+    for position, index in enumerate(changed):
+        xs_id = str(cross_sections[index][0])
+        row = dict(existing.get(xs_id, {}))
+        for column, field in enumerate(sampled_fields):
+            value = values[position, column]
+            row[field] = None if np.isnan(value) else float(value)
+        new_rows[xs_id] = row
+
+    rows = []
+    for xs_id, parts in cross_sections:
+        row = new_rows.get(str(xs_id)) or existing[str(xs_id)]
+        rows.append([str(xs_id)] + [row.get(field) for field in fields])
+    table_fields = [("XS_ID", "TEXT")] + [(field, _field_type([row[column + 1] for row in rows]))
+                                          for column, field in enumerate(fields)]
+    # The tables are written under temporary names and only replace the old
+    # ones once every write has succeeded, so a failed write never loses the
+    # stage values entered by hand
+    tables = [(table, table_fields, rows),
+              (sampled_table, SAMPLED_FIELDS,
+               [(str(xs_id), keys[index]) for index, (xs_id, parts) in enumerate(cross_sections)]),
+              (generated_table, GENERATED_FIELDS, [(field,) for field in sampled_fields])]
+    names = [name for name, columns, content in tables]
+    try:
+        for name, columns, content in tables:
+            adapter.delete(PARTIAL_NAME.format(name))
+            adapter.write_table(PARTIAL_NAME.format(name), columns, content)
+    except BaseException:
+        for name in names:
+            adapter.delete(PARTIAL_NAME.format(name))
+        raise
+    for name in names:
+        adapter.rename(PARTIAL_NAME.format(name), name)
+    return len(changed)
+
+
+def run_stage_data(source, dem, cross_sections, table="Stage_Data", offsets=(), percentiles=(),
+                   cell_size=None, update=True, tile_size=INDEX_TILE_SIZE, replace=False):
+    # Get WSE: fills table in the input workspace from the DEM
+    xs_features = source.read_features(cross_sections, "XS_ID")
+    for xs_id, parts in xs_features:
+        if xs_id == "" or xs_id is None:
+            raise RuntimeError("Cross_Sections feature class has Null values in the XS_ID field")
+    grid = source.open_raster(dem)
+    if cell_size and float(cell_size) != grid.cell_size:
+        grid = grid.resample(cell_size)
+    log.info("Creating {0} table".format(table))
+    stage_data(source, grid, xs_features, table, offsets, percentiles, update, tile_size, replace)
+    log.info("Script finished")
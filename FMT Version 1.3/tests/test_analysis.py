@@ -0,0 +1,164 @@
+# Floodplain Mapper Toolbox 1.3
+# Regression tests of the Analysis results against a reference run
+#
+# A small synthetic project is analysed once serially over the whole DEM.
+# Every other way of getting the same results must agree with that run:
+# exactly where the same cells are evaluated, and within a stated tolerance
+# where the result is an approximation.
+
+from __future__ import division
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from floodplain_mapper.adapters import NumpyAdapter
+from floodplain_mapper.cache import ResultCache
+from floodplain_mapper.curves import StageCurves, curve_rows, relative_elevations
+from floodplain_mapper.engine import load_project, run_analysis
+from floodplain_mapper.geometry import polygon_area
+from floodplain_mapper.stage_index import stage_depth
+from floodplain_mapper.subgrid import build_subgrid
+from floodplain_mapper.synthetic import make_project
+
+NUMERIC_FIELDS = ("Total_Area", "Inundated_Area", "Percent_Inundated", "Inundation_Volume",
+                  "Max_Depth", "Mean_Depth")
+
+PRODUCTS = ("DepthGrid", "Statistics", "Polygon")
+
+# Stage_Data steps between stages of the synthetic project
+STAGE_STEP = 0.5
+
+# Subgrid inundated areas are within this fraction of the reach area of the
+# full analysis, and volumes within this fraction of its volume once the
+# water has spread beyond the channel over this fraction of the reach
+SUBGRID_AREA_TOLERANCE = 0.005
+SUBGRID_VOLUME_TOLERANCE = 0.02
+SUBGRID_SPREAD = 0.05
+
+
+class AnalysisTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp(prefix="FMT_Test_")
+        cls.source = NumpyAdapter.create(cls.folder, "Project")
+        cls.stages = make_project(cls.source, 120, 240, stages=4, reaches=3,
+                                  stage_step=STAGE_STEP)
+        cls.project = load_project(cls.source, "DEM", "Reaches", "Cross_Sections", "Stage_Data")
+        cls.reference = cls.run_analysis()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    @classmethod
+    def run_analysis(cls, **options):
+        # Each run gets its own folder, as outputs are named by the minute
+        options.setdefault("products", PRODUCTS)
+        return run_analysis(cls.source, tempfile.mkdtemp(dir=cls.folder), "DEM", None,
+                            "Reaches", "Cross_Sections", "Stage_Data", cls.stages, **options)
+
+    def statistics(self, output, stage):
+        return output.read_table("{0}_Statistics".format(stage))
+
+    def assertRowsEqual(self, rows, expected, places=7):
+        self.assertEqual([row["ReachID"] for row in rows],
+                         [row["ReachID"] for row in expected])
+        for row, expected_row in zip(rows, expected):
+            for field in NUMERIC_FIELDS:
+                self.assertAlmostEqual(float(row[field]), float(expected_row[field]),
+                                       places=places,
+                                       msg="{0} of {1}".format(field, row["ReachID"]))
+
+    def assertSameResults(self, output):
+        for stage in self.stages:
+            np.testing.assert_array_equal(
+                output.read_raster("{0}_DepthGrid".format(stage)).array,
+                self.reference.read_raster("{0}_DepthGrid".format(stage)).array)
+            self.assertRowsEqual(self.statistics(output, stage),
+                                 self.statistics(self.reference, stage))
+            name = "{0}_Polygon".format(stage)
+            self.assertEqual(output.read_records(name, [("ReachID", "TEXT"),
+                                                        ("Inundated_Area", "FLOAT")]),
+                             self.reference.read_records(name, [("ReachID", "TEXT"),
+                                                                ("Inundated_Area", "FLOAT")]))
+
+    def test_tiled_matches_untiled(self):
+        self.assertSameResults(self.run_analysis(tile_size=50))
+
+    def test_workers_match_serial(self):
+        self.assertSameResults(self.run_analysis(workers=2))
+
+    def test_pyramid_matches_full_resolution(self):
+        self.assertSameResults(self.run_analysis(pyramid=8))
+        self.assertSameResults(self.run_analysis(pyramid=16, tile_size=50))
+
+    def test_cache_hit_matches_fresh_run(self):
+        cache = ResultCache(tempfile.mkdtemp(dir=self.folder))
+        self.assertSameResults(self.run_analysis(cache=cache))
+        keys = cache.stage_keys(self.source, "DEM", self.project, self.stages)
+        for stage in self.stages:
+            self.assertIsNotNone(cache.lookup(keys[stage], ["DepthGrid", "Polygon"]))
+        self.assertSameResults(self.run_analysis(cache=cache))
+
+    def test_stage_depth_matches_depth_grid(self):
+        output = self.run_analysis(stage_index=True, products=("DepthGrid",))
+        for stage in self.stages:
+            expected = self.reference.read_raster("{0}_DepthGrid".format(stage)).array
+            depth = stage_depth(output, stage)
+            np.testing.assert_array_equal(np.isnan(depth), np.isnan(expected))
+            np.testing.assert_allclose(depth[~np.isnan(depth)], expected[~np.isnan(expected)],
+                                       atol=1e-4)
+
+    def test_curves_match_statistics(self):
+        # Every stage of the synthetic project is STAGE_STEP above the last
+        labels, relative = relative_elevations(self.project, self.stages[0])
+        curves = StageCurves(labels, relative, len(self.project.reaches))
+        offsets = [index * STAGE_STEP for index in range(len(self.stages))]
+        rows = curve_rows(curves, self.project.reach_ids, self.project.total_areas,
+                          self.project.dem.cell_size, offsets)
+        for index, stage in enumerate(self.stages):
+            expected = self.statistics(self.reference, stage)
+            at_offset = [row for row in rows if row[1] == offsets[index]]
+            self.assertEqual([row[0] for row in at_offset],
+                             [row["ReachID"] for row in expected])
+            for row, expected_row in zip(at_offset, expected):
+                self.assertEqual(row[2], float(expected_row["Inundated_Area"]))
+                self.assertAlmostEqual(row[3], float(expected_row["Percent_Inundated"]))
+                self.assertAlmostEqual(row[4], float(expected_row["Inundation_Volume"]),
+                                       delta=0.02)
+
+    def test_polygon_area_equals_wet_cells(self):
+        cell_area = self.project.dem.cell_size ** 2
+        labels = self.project.labels()
+        for stage in self.stages:
+            depth = self.reference.read_raster("{0}_DepthGrid".format(stage)).array
+            areas = dict((reach_id, polygon_area(rings)) for reach_id, rings in
+                         self.reference.read_features("{0}_Polygon".format(stage), "ReachID"))
+            for reach, reach_id in enumerate(self.project.reach_ids):
+                wet = np.count_nonzero((labels == reach + 1) & ~np.isnan(depth))
+                self.assertAlmostEqual(areas.get(reach_id, 0.0), wet * cell_area)
+            for row in self.statistics(self.reference, stage):
+                self.assertAlmostEqual(areas.get(row["ReachID"], 0.0),
+                                       float(row["Inundated_Area"]))
+
+    def test_subgrid_within_tolerance(self):
+        subgrid = build_subgrid(self.project, self.stages[0], factor=16)
+        for stage in self.stages:
+            rows = subgrid.statistics(self.project, stage)
+            for row, expected in zip(rows, self.statistics(self.reference, stage)):
+                self.assertLessEqual(abs(row[2] - float(expected["Inundated_Area"])),
+                                     SUBGRID_AREA_TOLERANCE * float(expected["Total_Area"]))
+                if float(expected["Percent_Inundated"]) >= SUBGRID_SPREAD:
+                    volume = float(expected["Inundation_Volume"])
+                    self.assertLessEqual(abs(row[4] - volume), SUBGRID_VOLUME_TOLERANCE * volume)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+# Floodplain Mapper Toolbox 1.3
+# Tests of the resident what-if server against the Analysis results
+#
+# A small synthetic project is analysed once with run_analysis, then served
+# from memory on a free localhost port. Answers must match the statistics
+# tables and polygons of the analysis, and malformed queries must be
+# answered with HTTP 400 rather than a server error.
+
+from __future__ import division
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from floodplain_mapper.adapters import NumpyAdapter
+from floodplain_mapper.engine import load_project, run_analysis
+from floodplain_mapper.server import ResidentProject, make_server
+from floodplain_mapper.synthetic import make_project
+
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+except ImportError:
+    from urllib import urlencode
+    from urllib2 import HTTPError, urlopen
+
+NUMERIC_FIELDS = ("Total_Area", "Inundated_Area", "Percent_Inundated", "Inundation_Volume",
+                  "Max_Depth", "Mean_Depth")
+
+# Stage_Data steps between stages of the synthetic project
+STAGE_STEP = 0.5
+
+
+class ServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp(prefix="FMT_Test_")
+        source = NumpyAdapter.create(cls.folder, "Project")
+        cls.stages = make_project(source, 120, 240, stages=3, reaches=2, stage_step=STAGE_STEP)
+        cls.output = run_analysis(source, cls.folder, "DEM", None, "Reaches", "Cross_Sections",
+                                  "Stage_Data", cls.stages, products=("Polygon", "Statistics"))
+        project = load_project(source, "DEM", "Reaches", "Cross_Sections", "Stage_Data")
+        cls.resident = ResidentProject(project)
+        cls.resident.warm()
+        cls.server = make_server(cls.resident, port=0)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = "http://{0}:{1}".format(*cls.server.server_address[:2])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def get(self, path, **parameters):
+        # (status, JSON body) of a GET request
+        url = self.url + path
+        if parameters:
+            url += "?" + urlencode(parameters)
+        try:
+            response = urlopen(url)
+        except HTTPError as error:
+            return error.code, json.loads(error.read().decode("utf-8"))
+        return response.getcode(), json.loads(response.read().decode("utf-8"))
+
+    def assertRowsEqual(self, rows, expected):
+        self.assertEqual([row["ReachID"] for row in rows],
+                         [row["ReachID"] for row in expected])
+        for row, expected_row in zip(rows, expected):
+            for field in NUMERIC_FIELDS:
+                self.assertAlmostEqual(float(row[field]), float(expected_row[field]), places=4,
+                                       msg="{0} of {1}".format(field, row["ReachID"]))
+
+    def test_statistics_match_analysis(self):
+        for stage in self.stages:
+            status, body = self.get("/query", stage=stage)
+            self.assertEqual(status, 200)
+            self.assertRowsEqual(body["rows"],
+                                 self.output.read_table("{0}_Statistics".format(stage)))
+
+    def test_offset_matches_higher_stage(self):
+        # Every stage of the synthetic project is STAGE_STEP above the last
+        status, body = self.get("/query", stage=self.stages[0], offset=STAGE_STEP)
+        self.assertEqual(status, 200)
+        self.assertRowsEqual(body["rows"],
+                             self.output.read_table("{0}_Statistics".format(self.stages[1])))
+
+    def test_reach_query(self):
+        expected = self.output.read_table("{0}_Statistics".format(self.stages[-1]))
+        status, body = self.get("/query", stage=self.stages[-1], reach=expected[1]["ReachID"])
+        self.assertEqual(status, 200)
+        self.assertRowsEqual(body["rows"], expected[1:2])
+
+    def test_polygons_match_analysis(self):
+        stage = self.stages[-1]
+        status, body = self.get("/query", stage=stage, product="polygon")
+        self.assertEqual(status, 200)
+        features = body["features"]["features"]
+        with open(self.output.path("{0}_Polygon".format(stage), ".geojson")) as f:
+            expected = json.load(f)["features"]
+        self.assertEqual(len(features), len(expected))
+        for feature, expected_feature in zip(features, expected):
+            self.assertEqual(feature["properties"]["ReachID"],
+                             expected_feature["properties"]["ReachID"])
+            self.assertAlmostEqual(feature["properties"]["Inundated_Area"],
+                                   expected_feature["properties"]["Inundated_Area"])
+            self.assertEqual(feature["geometry"]["coordinates"],
+                             expected_feature["geometry"]["coordinates"])
+
+    def test_depth_grid(self):
+        reach = self.resident.project.reach_ids[0]
+        status, body = self.get("/query", stage=self.stages[-1], reach=reach, product="depth")
+        self.assertEqual(status, 200)
+        values = [value for row in body["depth"]["values"] for value in row if value is not None]
+        expected = self.output.read_table("{0}_Statistics".format(self.stages[-1]))[0]
+        cell_area = body["depth"]["cell_size"] ** 2
+        self.assertAlmostEqual(len(values) * cell_area, float(expected["Inundated_Area"]))
+        self.assertAlmostEqual(max(values), float(expected["Max_Depth"]), places=4)
+
+    def test_repeated_query_is_cached(self):
+        hits = self.resident.hits
+        first = self.get("/query", stage=self.stages[0], offset=0.25)[1]
+        second = self.get("/query", stage=self.stages[0], offset=0.25)[1]
+        self.assertEqual(self.resident.hits, hits + 1)
+        self.assertEqual(first["rows"], second["rows"])
+
+    def test_project(self):
+        status, body = self.get("/project")
+        self.assertEqual(status, 200)
+        self.assertEqual(body["stages"], self.stages)
+        self.assertEqual(body["reaches"], self.resident.project.reach_ids)
+
+    def test_bad_queries(self):
+        for parameters in ({},
+                           {"stage": "No_Such_Stage"},
+                           {"stage": self.stages[0], "product": "volume"},
+                           {"stage": self.stages[0], "reach": "No_Such_Reach"},
+                           {"stage": self.stages[0], "offset": "high"},
+                           {"stage": self.stages[0], "product": "depth"}):
+            status, body = self.get("/query", **parameters)
+            self.assertEqual(status, 400, msg=repr(parameters))
+            self.assertIn("error", body)
+
+    def test_unknown_path(self):
+        status, body = self.get("/stages")
+        self.assertEqual(status, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+# Floodplain Mapper Toolbox 1.3
+# Tests of the incremental Delaunay triangulation behind the TIN surface
+#
+# Triangulations must be valid (counterclockwise triangles tiling the convex
+# hull with every edge used at most twice), satisfy the empty-circumcircle
+# property, merge duplicate points and cover every cross-section segment
+# once conformed. A scaling check guards against insertion falling back to
+# quadratic time.
+
+from __future__ import division
+
+import os
+import sys
+import time
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from floodplain_mapper.geometry import densify
+from floodplain_mapper.triangulation import conforming_delaunay, delaunay
+
+# Projected coordinates of the test points, as in a State Plane DEM
+ORIGIN = np.array([500000.0, 4000000.0])
+
+
+def _areas(points, triangles):
+    a = points[triangles[:, 0]]
+    b = points[triangles[:, 1]]
+    c = points[triangles[:, 2]]
+    return 0.5 * ((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) -
+                  (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+
+
+def _hull_area(points):
+    # Monotone chain convex hull
+    ordered = sorted(set(map(tuple, points.tolist())))
+
+    def half(chain):
+        hull = []
+        for p in chain:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (p[1] - hull[-2][1]) -
+                                      (hull[-1][1] - hull[-2][1]) * (p[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull[:-1]
+    hull = np.array(half(ordered) + half(ordered[::-1]))
+    x = hull[:, 0]
+    y = hull[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def _cross_sections(count, gap, length=200.0):
+    # Densified parallel cross sections, the segments between their vertices
+    # and the cross section of every vertex
+    points = []
+    segments = []
+    lines = []
+    n = 0
+    for k in range(count):
+        line = densify(np.array([[k * gap, 5.0 * (k % 2)],
+                                 [k * gap + 40.0, length + 5.0 * (k % 2)]]), 10.0)
+        points.append(line + ORIGIN)
+        segments.append(np.column_stack([np.arange(n, n + len(line) - 1),
+                                         np.arange(n + 1, n + len(line))]))
+        lines.append(np.full(len(line), k))
+        n += len(line)
+    return np.vstack(points), np.vstack(segments), np.concatenate(lines)
+
+
+class TriangulationTest(unittest.TestCase):
+
+    def assertValid(self, points, triangles):
+        areas = _areas(points, triangles)
+        self.assertTrue((areas > 0).all())
+        # Within rounding, or a sliver along the hull left out by the finite
+        # enclosing triangle
+        self.assertAlmostEqual(areas.sum() / _hull_area(points), 1.0, places=6)
+        edges = np.sort(np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]],
+                                        triangles[:, [2, 0]]]), axis=1)
+        counts = np.unique(edges, axis=0, return_counts=True)[1]
+        self.assertLessEqual(counts.max(), 2)
+
+    def test_empty_circumcircles(self):
+        points = np.random.RandomState(1).rand(300, 2) * 1000.0 + ORIGIN
+        triangles = delaunay(points)
+        self.assertValid(points, triangles)
+        # No point lies strictly inside the circumcircle of a counterclockwise
+        # triangle, where the lifted determinant would be positive
+        for corners in points[triangles]:
+            offsets = corners[np.newaxis, :, :] - points[:, np.newaxis, :]
+            lifted = np.concatenate([offsets, (offsets ** 2).sum(axis=2)[:, :, np.newaxis]],
+                                    axis=2)
+            determinants = np.linalg.det(lifted)
+            self.assertLessEqual(determinants.max(), np.abs(determinants).max() * 1e-9)
+
+    def test_duplicates_merged(self):
+        points = np.random.RandomState(2).rand(100, 2) * 100.0 + ORIGIN
+        triangles = delaunay(np.vstack([points, points[:10]]))
+        np.testing.assert_array_equal(np.sort(triangles.ravel()) < 100, True)
+        self.assertValid(points, triangles)
+
+    def test_too_few_points(self):
+        self.assertEqual(delaunay(ORIGIN + [[0.0, 0.0], [1.0, 1.0]]).shape, (0, 3))
+
+    def test_conforming_covers_segments(self):
+        # Cross sections closer than their vertex spacing need splitting
+        points, segments, lines = _cross_sections(30, 1.5)
+        conformed, triangles, source = conforming_delaunay(points, segments)
+        self.assertGreater(len(conformed), len(points))
+        self.assertValid(conformed, triangles)
+        np.testing.assert_array_equal(conformed[:len(points)], points)
+        np.testing.assert_array_equal(source[:len(points)], np.arange(len(points)))
+        # Every point added lies on the cross section of its source
+        added = np.arange(len(points), len(conformed))
+        along = conformed[added] - points[source[added]]
+        slope = np.array([40.0, 200.0])
+        self.assertLess(np.abs(along[:, 0] * slope[1] - along[:, 1] * slope[0]).max(), 1e-6)
+        # Each cross section is a chain of triangle edges
+        edges = set(map(tuple, np.sort(np.concatenate(
+            [triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]]), axis=1).tolist()))
+        line_of = lines[source]
+        order = np.lexsort((conformed[:, 1], line_of))
+        for line in np.split(order, np.flatnonzero(np.diff(line_of[order])) + 1):
+            for a, b in zip(line[:-1].tolist(), line[1:].tolist()):
+                self.assertIn((min(a, b), max(a, b)), edges)
+
+    def test_scaling(self):
+        # Sixteen times the points must take well under the 256 times a
+        # quadratic insertion would
+        seconds = []
+        for count in (1000, 16000):
+            points = np.random.RandomState(count).rand(count, 2) * 10000.0 + ORIGIN
+            start = time.time()
+            delaunay(points)
+            seconds.append(time.time() - start)
+        self.assertLess(seconds[1], 48 * seconds[0])
+
+
+if __name__ == "__main__":
+    unittest.main()